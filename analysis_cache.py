@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from loguru import logger
+
+from analysis_model import CompactAnalysis
+from utils import ANALYSIS_CACHE_DIR, ANALYSIS_CACHE_MAX_BYTES, ANALYSIS_CACHE_MEMORY_ITEMS
+
+# Files start with a magic tag followed by the SHA-256 digest of the compressed payload
+CACHE_MAGIC = b"EMYEE-AA2"
+CACHE_SUFFIX = ".npz"
+TRACK_ID_PATTERN = re.compile(r"^[A-Za-z0-9]{1,64}$")
+
+
+class AnalysisCache:
+    def __init__(self, cache_dir: Optional[str] = ANALYSIS_CACHE_DIR, max_bytes: int = ANALYSIS_CACHE_MAX_BYTES,
+                 memory_items: int = ANALYSIS_CACHE_MEMORY_ITEMS):
+        """
+        Two-tier cache of Spotify audio analyses keyed by track ID.
+
+        The hot tier keeps the most recently used analyses in memory. The disk tier stores
+        compressed CompactAnalysis .npz files with an integrity digest, evicting the least
+        recently used files once their total size exceeds max_bytes.
+
+        :param cache_dir: Directory where cached analyses are stored, or None to only keep them in memory.
+        :param max_bytes: Maximum total size of the disk tier in bytes.
+        :param memory_items: Maximum number of analyses kept in memory.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self._memory: OrderedDict[str, CompactAnalysis] = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    async def get(self, track_id: str) -> Optional[CompactAnalysis]:
+        """
+        Returns the cached analysis for a track, or None if it is not cached.
+        """
+        if track_id in self._memory:
+            self._memory.move_to_end(track_id)
+            self.memory_hits += 1
+            return self._memory[track_id]
+
+        analysis = await asyncio.to_thread(self._read, track_id) if self.cache_dir is not None else None
+        if analysis is None:
+            self.misses += 1
+            return None
+
+        self.disk_hits += 1
+        self._remember(track_id, analysis)
+        return analysis
+
+    async def put(self, track_id: str, analysis: CompactAnalysis):
+        """
+        Stores an analysis in both the memory and the disk tiers.
+        """
+        self._remember(track_id, analysis)
+        if self.cache_dir is None:
+            return
+        try:
+            await asyncio.to_thread(self._write, track_id, analysis)
+        except OSError as e:
+            logger.error(f"Failed to write analysis cache for {track_id}: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the hit/miss counters of the cache.
+        """
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_items": len(self._memory),
+        }
+
+    def _remember(self, track_id: str, analysis: CompactAnalysis):
+        self._memory[track_id] = analysis
+        self._memory.move_to_end(track_id)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def _path(self, track_id: str) -> str:
+        if not TRACK_ID_PATTERN.match(track_id):
+            raise ValueError(f"Invalid track ID: {track_id!r}")
+        return os.path.join(self.cache_dir, f"{track_id}{CACHE_SUFFIX}")
+
+    def _read(self, track_id: str) -> Optional[CompactAnalysis]:
+        path = self._path(track_id)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        header_size = len(CACHE_MAGIC) + hashlib.sha256().digest_size
+        digest, payload = data[len(CACHE_MAGIC):header_size], data[header_size:]
+        if not data.startswith(CACHE_MAGIC) or hashlib.sha256(payload).digest() != digest:
+            logger.warning(f"Discarding corrupted analysis cache entry for {track_id}")
+            os.remove(path)
+            return None
+
+        try:
+            analysis = CompactAnalysis.from_bytes(payload)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Discarding unreadable analysis cache entry for {track_id}: {e}")
+            os.remove(path)
+            return None
+
+        # Refresh the modification time so eviction follows recency of use
+        os.utime(path)
+        return analysis
+
+    def _write(self, track_id: str, analysis: CompactAnalysis):
+        path = self._path(track_id)
+        payload = analysis.to_bytes()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(CACHE_MAGIC + hashlib.sha256(payload).digest() + payload)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            stat = os.stat(os.path.join(self.cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+            logger.debug(f"Evicted {name} from analysis cache")
@@ -0,0 +1,122 @@
+import io
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from preprocessing import SegmentArrays, SEGMENT_FIELDS
+
+# Bars, beats, tatums and sections only keep their timing and confidence
+EVENT_DTYPE = np.dtype([("start", np.float64), ("duration", np.float32), ("confidence", np.float32)])
+EVENT_KINDS = ("sections", "bars", "beats", "tatums")
+
+
+def events_from_raw(items: List[Dict[str, Any]]) -> np.ndarray:
+    """
+    Converts a list of bar/beat/tatum/section dictionaries to a structured array.
+    """
+    return np.array([(item["start"], item["duration"], item.get("confidence", 0.0)) for item in items],
+                    dtype=EVENT_DTYPE)
+
+
+@dataclass
+class CompactAnalysis:
+    """
+    Compact in-memory representation of a Spotify audio analysis.
+
+    Only the fields the effects use are kept: timing and confidence of sections, bars, beats
+    and tatums as structured arrays, and the segments as columnar SegmentArrays. Items can be
+    read like the raw response, e.g. analysis['bars'][0]['start'].
+
+    For a typical 4-minute track (~870 segments, ~1600 bars, beats and tatums) the parsed raw
+    response takes about 1.8 MB of Python objects in steady state and peaks at 2.6 MB while
+    parsing, on top of the ~0.8 MB body. A CompactAnalysis of the same track takes about
+    140 KB: 132 bytes per segment and 16 bytes per bar, beat, tatum or section.
+
+    Attributes:
+        segments: The segments of the track.
+        sections: Structured array of sections (start, duration, confidence).
+        bars: Structured array of bars.
+        beats: Structured array of beats.
+        tatums: Structured array of tatums.
+        duration: The duration of the track in seconds.
+        tempo: The estimated tempo of the track in BPM.
+    """
+    segments: SegmentArrays
+    sections: np.ndarray
+    bars: np.ndarray
+    beats: np.ndarray
+    tatums: np.ndarray
+    duration: float = 0.0
+    tempo: float = 0.0
+
+    @classmethod
+    def from_raw(cls, raw: Dict[str, Any]) -> "CompactAnalysis":
+        """
+        Builds a CompactAnalysis from a raw audio analysis response.
+        """
+        track = raw.get("track") or {}
+        return cls(
+            segments=SegmentArrays.from_segments(raw.get("segments", [])),
+            duration=float(track.get("duration", 0.0)),
+            tempo=float(track.get("tempo", 0.0)),
+            **{kind: events_from_raw(raw.get(kind, [])) for kind in EVENT_KINDS},
+        )
+
+    def to_raw(self) -> Dict[str, Any]:
+        """
+        Rebuilds a raw audio analysis response with the kept fields, e.g. to serve it again.
+        """
+        raw: Dict[str, Any] = {"track": {"duration": self.duration, "tempo": self.tempo}}
+        for kind in EVENT_KINDS:
+            events = getattr(self, kind)
+            raw[kind] = [{field: float(item[field]) for field in EVENT_DTYPE.names} for item in events]
+        raw["segments"] = self.segments.to_segments()
+        return raw
+
+    def __getitem__(self, kind: str):
+        if kind == "segments" or kind in EVENT_KINDS:
+            return getattr(self, kind)
+        raise KeyError(kind)
+
+    def get(self, kind: str, default: Optional[Any] = None):
+        try:
+            return self[kind]
+        except KeyError:
+            return default
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory used by the arrays of the analysis, in bytes.
+        """
+        return self.segments.nbytes + sum(getattr(self, kind).nbytes for kind in EVENT_KINDS)
+
+    def to_bytes(self) -> bytes:
+        """
+        Serializes the analysis to a compressed .npz payload.
+        """
+        arrays = {f"segments_{field}": getattr(self.segments, field) for field in SEGMENT_FIELDS}
+        arrays.update(segments_pitches=self.segments.pitches, segments_timbre=self.segments.timbre)
+        arrays.update({kind: getattr(self, kind) for kind in EVENT_KINDS})
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, duration=self.duration, tempo=self.tempo, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "CompactAnalysis":
+        """
+        Deserializes an analysis written by to_bytes.
+        """
+        with np.load(io.BytesIO(data), allow_pickle=False) as npz:
+            segments = SegmentArrays(
+                pitches=npz["segments_pitches"],
+                timbre=npz["segments_timbre"],
+                **{field: npz[f"segments_{field}"] for field in SEGMENT_FIELDS},
+            )
+            return cls(
+                segments=segments,
+                duration=float(npz["duration"]),
+                tempo=float(npz["tempo"]),
+                **{kind: npz[kind] for kind in EVENT_KINDS},
+            )
@@ -0,0 +1,283 @@
+import codecs
+import json
+import re
+from array import array
+from typing import Dict, Optional
+
+import numpy as np
+
+from analysis_model import CompactAnalysis, EVENT_DTYPE, EVENT_KINDS
+from preprocessing import SegmentArrays, FEATURE_SIZE, SEGMENT_FIELDS, TIME_FIELDS, FEATURE_DTYPE
+
+# Fields of each event kind written into the compact representation
+EVENT_FIELDS = ("start", "duration", "confidence")
+# Fields of the track object kept in the compact representation
+TRACK_FIELDS = ("duration", "tempo")
+# Consumed text is dropped from the buffer once it grows past this many characters
+COMPACT_THRESHOLD = 1 << 16
+
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+SCALAR = re.compile(r"-?[0-9][0-9.eE+-]*|true|false|null")
+# What a scalar cut off by the end of a chunk can look like, besides a number cut after a digit
+SCALAR_PREFIX = re.compile(r"-|t(?:r(?:ue?)?)?|f(?:a(?:l(?:se?)?)?)?|n(?:u(?:ll?)?)?")
+STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL)
+STRUCTURAL = re.compile(r'[{}\[\]",:]')
+
+
+class AnalysisStreamParser:
+    def __init__(self):
+        """
+        Incremental parser of audio-analysis responses into a CompactAnalysis.
+
+        Bytes are fed as they arrive from the network. Each element of the segments, bars,
+        beats, tatums and sections arrays is decoded on its own and only the whitelisted
+        fields are appended to typed columns; every other top-level value is skipped without
+        building Python objects, so the whole body and object graph never exist at once.
+        The scan of a skipped value resumes where the previous chunk ended and the text it
+        consumed is dropped, so the large strings of the track object are scanned only once.
+        """
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._state = "start"
+        self._key: Optional[str] = None
+        self._segments: Dict[str, array] = {field: array("d") for field in SEGMENT_FIELDS}
+        self._pitches = array("f")
+        self._timbre = array("f")
+        self._events: Dict[str, Dict[str, array]] = {kind: {field: array("d") for field in EVENT_FIELDS}
+                                                      for kind in EVENT_KINDS}
+        self._track: Dict[str, float] = {}
+        # Progress through the value being skipped, kept between chunks
+        self._depth = 0
+        self._container = ""
+        self._in_string = False
+        self._expect_member = False
+        self._member: Optional[str] = None
+        # Offset of a member name of the track object still being received
+        self._member_start: Optional[int] = None
+
+    def feed(self, data: bytes):
+        """
+        Parses as much as possible of the response received so far.
+        """
+        self._buffer += self._decoder.decode(data)
+        self._parse()
+        keep = self._pos if self._member_start is None else self._member_start
+        if keep > COMPACT_THRESHOLD:
+            self._buffer = self._buffer[keep:]
+            self._pos -= keep
+            if self._member_start is not None:
+                self._member_start -= keep
+
+    def close(self) -> CompactAnalysis:
+        """
+        Finishes parsing and returns the compact analysis.
+
+        :raises ValueError: If the response was truncated or malformed.
+        """
+        self._buffer += self._decoder.decode(b"", final=True)
+        self._parse()
+        if self._state != "done":
+            raise ValueError(f"Truncated or malformed audio analysis (stopped in state {self._state!r})")
+        return self._build()
+
+    def _parse(self):
+        while self._state != "done":
+            self._pos = WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos >= len(self._buffer):
+                return
+            char = self._buffer[self._pos]
+
+            if self._state == "start":
+                self._expect(char, "{")
+                self._state = "key"
+            elif self._state == "key":
+                if char == ",":
+                    self._pos += 1
+                elif char == "}":
+                    self._pos += 1
+                    self._state = "done"
+                else:
+                    match = STRING.match(self._buffer, self._pos)
+                    if match is None:
+                        self._check_incomplete_string()
+                        return
+                    self._key = json.loads(match.group())
+                    self._pos = match.end()
+                    self._state = "colon"
+            elif self._state == "colon":
+                self._expect(char, ":")
+                self._state = "array" if self._key == "segments" or self._key in EVENT_KINDS else "value"
+            elif self._state == "array":
+                self._expect(char, "[")
+                self._state = "element"
+            elif self._state == "element":
+                if char == ",":
+                    self._pos += 1
+                elif char == "]":
+                    self._pos += 1
+                    self._state = "key"
+                elif not self._parse_element():
+                    return
+            elif self._state == "value":
+                if not self._parse_value():
+                    return
+
+    def _expect(self, char: str, expected: str):
+        if char != expected:
+            raise ValueError(f"Expected {expected!r} at offset {self._pos}, found {char!r}")
+        self._pos += 1
+
+    def _check_incomplete_string(self):
+        if self._buffer[self._pos] != '"':
+            raise ValueError(f"Expected a key at offset {self._pos}, found {self._buffer[self._pos]!r}")
+
+    def _parse_element(self) -> bool:
+        if self._buffer[self._pos] != "{":
+            raise ValueError(f"Expected an object in {self._key!r} at offset {self._pos}")
+        if self._buffer.find("}", self._pos) < 0:
+            # Not even the first object closed yet; a failed decode costs a scan of the whole buffer
+            return False
+        try:
+            item, self._pos = self._json.raw_decode(self._buffer, self._pos)
+        except json.JSONDecodeError:
+            # The element continues in the next chunk; malformed input is reported by close()
+            return False
+
+        if self._key == "segments":
+            for field, column in self._segments.items():
+                column.append(item.get(field, 0.0))
+            self._pitches.extend(_feature(item.get("pitches")))
+            self._timbre.extend(_feature(item.get("timbre")))
+        else:
+            for field, column in self._events[self._key].items():
+                column.append(item.get(field, 0.0))
+        return True
+
+    def _parse_value(self) -> bool:
+        if not self._skip():
+            return False
+        self._state = "key"
+        return True
+
+    def _skip(self) -> bool:
+        """
+        Advances past the value at the current offset, or as far as the buffer goes. Only the
+        numeric members of the track object are decoded; its large codestrings are skipped.
+
+        :return: Whether the end of the value was reached.
+        """
+        buffer = self._buffer
+        pos = self._pos
+        if self._depth == 0 and not self._in_string:
+            char = buffer[pos]
+            if char == '"':
+                self._in_string = True
+                pos += 1
+            elif char not in "{[":
+                match = SCALAR.match(buffer, pos)
+                if match is None:
+                    if _scalar_prefix_at_end(buffer, pos):
+                        return False
+                    raise ValueError(f"Unexpected {char!r} at offset {pos}")
+                # A scalar at the end of the buffer may continue in the next chunk
+                if match.end() >= len(buffer):
+                    return False
+                self._pos = match.end()
+                return True
+
+        capture = self._key == "track"
+        while True:
+            if self._in_string:
+                pos = STRING_BODY.match(buffer, pos).end()
+                if pos >= len(buffer) or buffer[pos] == "\\":
+                    # The string, or an escape sequence, continues in the next chunk
+                    self._pos = pos
+                    return False
+                pos += 1
+                self._in_string = False
+                if self._member_start is not None:
+                    self._member = json.loads(buffer[self._member_start:pos])
+                    self._member_start = None
+                if self._depth == 0:
+                    break
+                continue
+
+            match = STRUCTURAL.search(buffer, pos)
+            if match is None:
+                self._pos = len(buffer)
+                return False
+            char = match.group()
+            pos = match.end()
+            if char == '"':
+                self._in_string = True
+                if capture and self._depth == 1 and self._expect_member:
+                    self._member_start = match.start()
+                    self._expect_member = False
+            elif char in "{[":
+                self._depth += 1
+                if self._depth == 1:
+                    self._container = char
+                    self._expect_member = char == "{"
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    break
+            elif self._depth != 1:
+                continue
+            elif char == ",":
+                self._expect_member = self._container == "{"
+            elif self._member in TRACK_FIELDS:
+                start = WHITESPACE.match(buffer, pos).end()
+                value = SCALAR.match(buffer, start)
+                if value is not None:
+                    complete = value.end() < len(buffer)
+                else:
+                    complete = start < len(buffer) and not _scalar_prefix_at_end(buffer, start)
+                if not complete:
+                    # Resume from the colon once the whole value arrived
+                    self._pos = match.start()
+                    return False
+                if value is not None and value.group() not in ("true", "false", "null"):
+                    self._track[self._member] = float(value.group())
+                    pos = value.end()
+                self._member = None
+
+        self._pos = pos
+        self._member = None
+        self._expect_member = False
+        return True
+
+    def _build(self) -> CompactAnalysis:
+        count = len(self._segments["start"])
+        segments = SegmentArrays(
+            pitches=np.frombuffer(self._pitches, dtype=np.float32).astype(FEATURE_DTYPE).reshape(count, FEATURE_SIZE),
+            timbre=np.frombuffer(self._timbre, dtype=np.float32).astype(FEATURE_DTYPE).reshape(count, FEATURE_SIZE),
+            **{field: np.frombuffer(column, dtype=np.float64).astype(np.float64 if field in TIME_FIELDS else FEATURE_DTYPE)
+               for field, column in self._segments.items()},
+        )
+        events = {}
+        for kind, columns in self._events.items():
+            events[kind] = np.empty(len(columns["start"]), dtype=EVENT_DTYPE)
+            for field, column in columns.items():
+                events[kind][field] = np.frombuffer(column, dtype=np.float64)
+        return CompactAnalysis(segments=segments, duration=self._track.get("duration", 0.0),
+                               tempo=self._track.get("tempo", 0.0), **events)
+
+
+def _scalar_prefix_at_end(buffer: str, pos: int) -> bool:
+    """
+    Returns whether the buffer ends with the beginning of a scalar at pos, e.g. "-" or "tru".
+    """
+    match = SCALAR_PREFIX.match(buffer, pos)
+    return match is not None and match.end() == len(buffer)
+
+
+def _feature(values) -> list:
+    """
+    Pads or truncates a pitches/timbre vector to FEATURE_SIZE values.
+    """
+    values = list(values or [])[:FEATURE_SIZE]
+    return values + [0.0] * (FEATURE_SIZE - len(values))
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Drives the whole pipeline through synthetic songs against simulated bulbs.
+
+Each scenario replays a generated track through SessionReplayer into LightsController,
+which commands local fake bulbs with configurable latency and drop rate. Reports the CPU
+time of each controller tick, the latency from dispatching a show entry to the bulb applying
+it, the error between that moment and the entry's time in the analysis, commands per second
+and memory use.
+
+    python benchmarks/bench_pipeline.py --output before.json
+    python benchmarks/bench_pipeline.py --output after.json --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from dataclasses import asdict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from analysis_model import CompactAnalysis  # noqa: E402
+from device_manager import DeviceManager  # noqa: E402
+from fake_bulb import FakeBulb  # noqa: E402
+from latency import LatencyModel  # noqa: E402
+from light_controller import LightsController  # noqa: E402
+from models import Device  # noqa: E402
+from playback_clock import PlaybackClock  # noqa: E402
+from session_recording import Session, SessionReplayer  # noqa: E402
+from song_compiler import prepare_song  # noqa: E402
+from utils import setup_logging  # noqa: E402
+from synthetic import DEFAULT_SEGMENT_DENSITY, make_analysis  # noqa: E402
+
+SCENARIOS = {
+    "baseline": {"bulbs": 1},
+    "four-bulbs-latency": {"bulbs": 4, "latency": 0.03},
+    "lossy": {"bulbs": 2, "latency": 0.01, "drop_rate": 0.05},
+    "dense": {"bulbs": 1, "density": 8.0},
+    "many-bulbs": {"bulbs": 24, "latency": 0.01},
+}
+# Yeelight methods that carry show entries, as opposed to probes and set_music
+EFFECT_METHODS = ("set_bright", "set_hsv", "set_scene", "start_cf")
+# Interval between the recorded currently-playing responses, in song seconds
+POLL_INTERVAL = 0.5
+
+
+class CommandLog:
+    def __init__(self):
+        """
+        Collects the commands the bulbs' command queues send, like a SessionRecorder.
+        """
+        self.sent: Dict[str, List[float]] = defaultdict(list)
+
+    def record_command(self, device: str, command):
+        self.sent[device].append(time.monotonic())
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"count": 0, "p50": None, "p90": None, "p99": None, "max": None}
+    array = np.asarray(values, dtype=float)
+    return {
+        "count": len(values),
+        "p50": float(np.percentile(array, 50)),
+        "p90": float(np.percentile(array, 90)),
+        "p99": float(np.percentile(array, 99)),
+        "max": float(array.max()),
+    }
+
+
+def make_session(analysis: CompactAnalysis, track_id: str = "synthetic") -> Session:
+    session = Session(analyses={track_id: analysis})
+    duration_ms = int(analysis.duration * 1000)
+    for i in range(int(analysis.duration / POLL_INTERVAL)):
+        session.playing.append((i * POLL_INTERVAL, {"is_playing": True, "progress_ms": int(i * POLL_INTERVAL * 1000),
+                                                    "item": {"id": track_id, "duration_ms": duration_ms}}))
+    return session
+
+
+async def run_scenario(name: str, bulbs: int = 1, latency: float = 0.0, drop_rate: float = 0.0,
+                       minutes: float = 1.0, density: float = DEFAULT_SEGMENT_DENSITY, speed: float = 4.0,
+                       seed: int = 0) -> Dict[str, Any]:
+    raw = make_analysis(minutes, seed=seed, density=density)
+    analysis = CompactAnalysis.from_raw(raw)
+    del raw
+
+    tracemalloc.start()
+    song = prepare_song(analysis, "synthetic")
+    _, prepare_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    fake_bulbs = [FakeBulb(latency=latency, drop_rate=drop_rate, seed=seed + i) for i in range(bulbs)]
+    for bulb in fake_bulbs:
+        await bulb.start()
+    command_log = CommandLog()
+    latency_model = LatencyModel(path=None)
+    device_manager = DeviceManager(latency_model=latency_model, recorder=command_log)
+    devices = await device_manager.initialize_devices([Device(bulb.host, bulb.port, bulb.model) for bulb in fake_bulbs])
+
+    events_queue = asyncio.Queue()
+    clock = PlaybackClock(speed=speed)
+    replayer = SessionReplayer(make_session(analysis), events_queue, clock, speed, latency_model)
+    replayer.prepared_songs["synthetic"] = song
+    controller = LightsController(devices, events_queue, clock, latency_model)
+
+    # Instrument the controller: CPU time of every tick and every entry dispatched
+    tick_times: List[float] = []
+    dispatches: Dict[str, List[tuple]] = defaultdict(list)
+    on_entry_due, apply_frame = controller._on_entry_due, controller.apply_frame
+
+    def timed_on_entry_due():
+        started = time.thread_time()
+        on_entry_due()
+        tick_times.append(time.thread_time() - started)
+
+    def logged_apply_frame(frame):
+        now = time.monotonic()
+        for row, index in zip(frame.devices.tolist(), frame.index.tolist()):
+            dispatches[controller.devices[row].name].append((now, index))
+        apply_frame(frame)
+
+    controller._on_entry_due = timed_on_entry_due
+    controller.apply_frame = logged_apply_frame
+
+    cpu_started, wall_started = time.process_time(), time.monotonic()
+    control_task = asyncio.create_task(controller.control_lights())
+    try:
+        await replayer.listen()
+        # Let the last commands reach the bulbs
+        await asyncio.sleep(0.2 + latency * 5)
+    finally:
+        control_task.cancel()
+        await asyncio.gather(control_task, return_exceptions=True)
+    cpu_time, wall_time = time.process_time() - cpu_started, time.monotonic() - wall_started
+
+    def song_position(at: float) -> float:
+        return (at - replayer._started_at) * speed
+
+    # Bulbs receive the commands of their queue in order, so arrivals pair up with sends
+    show = song.show
+    event_to_command, boundary_errors = [], []
+    drops = 0
+    for device, bulb in zip(devices, fake_bulbs):
+        arrivals = sorted(
+            [(command["id"], at, False) for at, command in bulb.received if command.get("method") in EFFECT_METHODS] +
+            [(command["id"], at, True) for at, command in bulb.dropped if command.get("method") in EFFECT_METHODS]
+        )
+        device_dispatches = dispatches[device.name]
+        dispatch_times = [at for at, _ in device_dispatches]
+        for sent_at, (_, arrived_at, dropped) in zip(command_log.sent[device.name], arrivals):
+            if dropped:
+                drops += 1
+                continue
+            dispatch = int(np.searchsorted(dispatch_times, sent_at, side="right")) - 1
+            if dispatch < 0:
+                continue
+            dispatched_at, index = device_dispatches[dispatch]
+            event_to_command.append((arrived_at - dispatched_at) * 1000)
+            entry_time = float(show.times[index])
+            # Resyncs apply entries that are already due; only entries scheduled ahead have a target time
+            if song_position(dispatched_at) < entry_time:
+                boundary_errors.append((song_position(arrived_at) - entry_time) / speed * 1000)
+
+    stats = [device.stats() for device in devices]
+    sent = sum(stat["sent"] for stat in stats)
+    for device in devices:
+        await device.close()
+    for bulb in fake_bulbs:
+        await bulb.stop()
+
+    return {
+        "scenario": name,
+        "parameters": {"bulbs": bulbs, "latency": latency, "drop_rate": drop_rate, "minutes": minutes,
+                       "density": density, "speed": speed, "seed": seed},
+        "entries": len(show),
+        "wall_time_s": wall_time,
+        "cpu_time_s": cpu_time,
+        "tick_cpu_us": {key: value * 1e6 if value is not None and key != "count" else value
+                        for key, value in percentiles(tick_times).items()},
+        # A tick may update any number of bulbs, so compare the total too
+        "tick_cpu_total_ms": {"sum": sum(tick_times) * 1000},
+        "event_to_command_ms": percentiles(event_to_command),
+        "boundary_error_ms": percentiles(boundary_errors),
+        "boundary_abs_error_ms": percentiles([abs(error) for error in boundary_errors]),
+        "song_change_ms": controller.song_change_latencies[0] * 1000 if controller.song_change_latencies else None,
+        "commands": {
+            "sent": sent,
+            "per_second": sent / wall_time,
+            "coalesced": sum(stat["coalesced"] for stat in stats),
+            "dropped_by_queue": sum(stat["dropped"] for stat in stats),
+            "suppressed": sum(stat["suppressed"] for stat in stats),
+            "lost_by_bulbs": drops,
+            "failed": sum(stat["failed"] for stat in stats),
+        },
+        "memory": {
+            "analysis_bytes": analysis.nbytes,
+            "show_bytes": sum(getattr(show, field).nbytes for field in asdict(show)),
+            "prepare_peak_bytes": prepare_peak,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        },
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(result: Dict[str, Any]) -> str:
+    def fmt(value, unit=""):
+        return "-" if value is None else f"{value:.2f}{unit}"
+    return (f"{result['scenario']:>20}: tick p50 {fmt(result['tick_cpu_us']['p50'], 'us')} "
+            f"(total {fmt(result['tick_cpu_total_ms']['sum'], 'ms')}), "
+            f"event->command p50/p99 {fmt(result['event_to_command_ms']['p50'])}/{fmt(result['event_to_command_ms']['p99'], 'ms')}, "
+            f"boundary |err| p50/p99 {fmt(result['boundary_abs_error_ms']['p50'])}/{fmt(result['boundary_abs_error_ms']['p99'], 'ms')}, "
+            f"{result['commands']['per_second']:.1f} cmd/s, cpu {result['cpu_time_s']:.2f}s")
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = {result["scenario"]: result for result in json.load(f)["results"]}
+    metrics = (("tick_cpu_us", "p50"), ("tick_cpu_total_ms", "sum"), ("event_to_command_ms", "p50"), ("event_to_command_ms", "p99"),
+               ("boundary_abs_error_ms", "p50"), ("boundary_abs_error_ms", "p99"), ("commands", "per_second"))
+    for result in results:
+        old = baseline.get(result["scenario"])
+        if old is None:
+            continue
+        changes = []
+        for group, key in metrics:
+            before, after = old.get(group, {}).get(key), result[group][key]
+            if before and after is not None:
+                changes.append(f"{group}.{key} {(after - before) / before * 100:+.1f}%")
+        print(f"{result['scenario']:>20}: " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Scenarios to run (default: all)")
+    parser.add_argument("--minutes", type=float, default=1.0, help="Length of the synthetic tracks")
+    parser.add_argument("--speed", type=float, default=4.0, help="Replay speed relative to real time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", metavar="JSON", help="Compare with the results of an earlier run")
+    args = parser.parse_args()
+    setup_logging("WARNING")
+
+    results = []
+    for name in args.scenario or SCENARIOS:
+        parameters = {"minutes": args.minutes, "speed": args.speed, "seed": args.seed, **SCENARIOS[name]}
+        result = asyncio.run(run_scenario(name, **parameters))
+        print(summarize(result))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"revision": git_revision(), "created": time.time(), "results": results}, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Compares the dictionary-based and the vectorized segment preprocessing.
+
+    python benchmarks/bench_preprocessing.py --minutes 20
+
+Analyses are parsed straight into SegmentArrays (see analysis_stream.py), so preparing a song
+only pays for the merge; the conversion from dictionaries is timed for reference.
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from preprocessing import SegmentArrays, merge_short_segments_arrays  # noqa: E402
+from utils import merge_short_segments  # noqa: E402
+from synthetic import make_segments  # noqa: E402
+
+
+def old_pipeline(segments):
+    merged = merge_short_segments(segments)
+    return np.array([10 ** (seg["loudness_start"] / 20) for seg in merged])
+
+
+def new_pipeline(segments):
+    return merge_short_segments_arrays(SegmentArrays.from_segments(segments)).linear_loudness
+
+
+def check_equivalence(minutes: float, seeds: int):
+    """
+    Checks both pipelines merge the same segments, with continuous durations and with durations
+    quantized to 10 ms, where groups often add up to exactly MIN_SEGMENT_DURATION.
+    """
+    for resolution in (None, 0.01):
+        for seed in range(seeds):
+            segments = make_segments(minutes, seed=seed, resolution=resolution)
+            old, new = old_pipeline(segments), new_pipeline(segments)
+            assert len(old) == len(new) and np.allclose(old, new), \
+                f"Pipelines disagree (seed {seed}, resolution {resolution}): {len(old)} vs {len(new)} segments"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--minutes", type=float, default=20, help="Length of the synthetic track")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seeds", type=int, default=50, help="Number of random tracks the equivalence check covers")
+    args = parser.parse_args()
+
+    check_equivalence(4, args.seeds)
+    segments = make_segments(args.minutes)
+
+    arrays = SegmentArrays.from_segments(segments)
+    results = {
+        "dicts (utils.merge_short_segments)": lambda: old_pipeline(segments),
+        "arrays (per song)": lambda: merge_short_segments_arrays(arrays).linear_loudness,
+        "dicts to arrays (reference only)": lambda: SegmentArrays.from_segments(segments),
+    }
+    print(f"{len(segments)} segments ({args.minutes:g} minutes)")
+    for name, func in results.items():
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print(f"{name:>36}: {best * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Synthetic Spotify audio analyses for benchmarks.
+"""
+import random
+from typing import Any, Dict, List, Optional
+
+# Average number of segments per second in Spotify's analyses of typical pop tracks
+DEFAULT_SEGMENT_DENSITY = 3.6
+
+
+def make_segments(minutes: float, seed: int = 0, density: float = DEFAULT_SEGMENT_DENSITY,
+                  resolution: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Generates random segments covering a track.
+
+    :param minutes: The length of the track.
+    :param seed: The seed of the random generator.
+    :param density: The average number of segments per second.
+    :param resolution: If given, durations are rounded to multiples of it, like the fixed decimals
+        of Spotify's analyses, so consecutive segments often add up to exactly MIN_SEGMENT_DURATION.
+    """
+    rng = random.Random(seed)
+    mean = 1 / density
+    segments, start = [], 0.0
+    while start < minutes * 60:
+        duration = rng.uniform(0.18 * mean, 1.82 * mean)
+        if resolution:
+            duration = max(1, round(duration / resolution)) * resolution
+        segments.append({
+            "start": start,
+            "duration": duration,
+            "confidence": rng.random(),
+            "loudness_start": rng.uniform(-40, -5),
+            "loudness_max_time": rng.uniform(0, duration),
+            "loudness_max": rng.uniform(-30, 0),
+            "loudness_end": rng.uniform(-40, -5),
+            "pitches": [rng.random() for _ in range(12)],
+            "timbre": [rng.uniform(-50, 50) for _ in range(12)],
+        })
+        start += duration
+    return segments
+
+
+def _events(rng: random.Random, length: float, interval: float) -> List[Dict[str, float]]:
+    count = int(length / interval)
+    return [{"start": i * interval, "duration": interval, "confidence": rng.random()} for i in range(count)]
+
+
+def make_analysis(minutes: float, seed: int = 0, density: float = DEFAULT_SEGMENT_DENSITY, tempo: float = 120.0,
+                  section_length: float = 30.0) -> Dict[str, Any]:
+    """
+    Generates a raw audio analysis response with segments, tatums, beats, bars and sections.
+
+    :param minutes: The length of the track.
+    :param seed: The seed of the random generator.
+    :param density: The average number of segments per second.
+    :param tempo: The tempo in BPM; beats are evenly spaced, with two tatums per beat and four beats per bar.
+    :param section_length: The length of each section in seconds.
+    """
+    rng = random.Random(seed + 1)
+    length = minutes * 60
+    beat = 60 / tempo
+    return {
+        "meta": {"analyzer_version": "synthetic"},
+        "track": {"duration": length, "tempo": tempo, "codestring": "x" * 1024},
+        "bars": _events(rng, length, beat * 4),
+        "beats": _events(rng, length, beat),
+        "tatums": _events(rng, length, beat / 2),
+        "sections": _events(rng, length, section_length) or [{"start": 0.0, "duration": length, "confidence": 1.0}],
+        "segments": make_segments(minutes, seed, density),
+    }
@@ -0,0 +1,51 @@
+from typing import Tuple
+
+import numpy as np
+
+from preprocessing import SegmentArrays
+from utils import BRIGHTNESS_OUTLIER_STD, BRIGHTNESS_RANGE
+
+
+class BrightnessCurve:
+    def __init__(self, segments: SegmentArrays, outlier_std: float = BRIGHTNESS_OUTLIER_STD,
+                 output_range: Tuple[int, int] = BRIGHTNESS_RANGE):
+        """
+        Precomputes the brightness of every segment of a song from its loudness.
+
+        Loudness is converted from decibels to a linear scale and normalized between the
+        minimum and maximum values found within outlier_std standard deviations of the mean.
+
+        :param segments: The (merged) segments of the song, in playback order.
+        :param outlier_std: Width of the window, in standard deviations, used to discard outliers.
+        :param output_range: The (min, max) brightness the normalized loudness is mapped to.
+        """
+        self.outlier_std = outlier_std
+        self.output_range = output_range
+
+        loudness = segments.linear_loudness
+        self.min_loudness, self.max_loudness = self._normalization_bounds(loudness)
+
+        low, high = output_range
+        span = self.max_loudness - self.min_loudness
+        if span > 0:
+            normalized = (loudness - self.min_loudness) / span
+        else:
+            normalized = np.zeros_like(loudness)
+        self.values = np.clip(normalized * (high - low) + low, low, high).astype(int)
+
+    def _normalization_bounds(self, loudness: np.ndarray) -> Tuple[float, float]:
+        if loudness.size == 0:
+            return 0.0, 0.0
+        mean, std = loudness.mean(), loudness.std()
+        lower_bound = mean - self.outlier_std * std
+        upper_bound = mean + self.outlier_std * std
+        filtered = loudness[(loudness >= lower_bound) & (loudness <= upper_bound)]
+        if filtered.size == 0:
+            filtered = loudness
+        return float(filtered.min()), float(filtered.max())
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, index: int) -> int:
+        return int(self.values[index])
@@ -0,0 +1,122 @@
+import colorsys
+import time
+from dataclasses import replace
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+from utils import BRIGHTNESS_THRESHOLD, HUE_THRESHOLD, SATURATION_THRESHOLD, BULB_NOTIFICATION_GRACE
+
+if TYPE_CHECKING:
+    from command_queue import DeviceCommand
+
+
+def hue_distance(a: int, b: int) -> int:
+    """
+    Returns the distance in degrees between two hues on the color wheel.
+    """
+    difference = abs(a - b) % 360
+    return min(difference, 360 - difference)
+
+
+class BulbState:
+    def __init__(self, supports_color: bool = True, brightness_threshold: int = BRIGHTNESS_THRESHOLD,
+                 hue_threshold: int = HUE_THRESHOLD, saturation_threshold: int = SATURATION_THRESHOLD):
+        """
+        Shadow of the state a bulb is believed to be in, to avoid sending it commands that
+        would not visibly change anything.
+
+        Updated with every command written to the bulb and with the property notifications
+        the bulb sends on its control connection. Notifications lag behind the commands, so
+        they are only trusted once no command was written for BULB_NOTIFICATION_GRACE seconds,
+        e.g. after a change from another app. Unknown values (None) never match, so after a
+        failure the next command is always sent.
+
+        :param supports_color: Whether the bulb can show colors, or only white.
+        :param brightness_threshold: Smallest brightness change in percent worth sending.
+        :param hue_threshold: Smallest hue change in degrees worth sending.
+        :param saturation_threshold: Smallest saturation change in percent worth sending.
+        """
+        self.supports_color = supports_color
+        self.brightness_threshold = brightness_threshold
+        self.hue_threshold = hue_threshold
+        self.saturation_threshold = saturation_threshold
+        self.power: Optional[bool] = None
+        self.brightness: Optional[int] = None
+        self.hue: Optional[int] = None
+        self.saturation: Optional[int] = None
+        self._written_at = float("-inf")
+
+    def invalidate(self):
+        self.power = self.brightness = self.hue = self.saturation = None
+
+    def _same_brightness(self, brightness: Optional[int]) -> bool:
+        return brightness is None or (self.brightness is not None and
+                                      abs(brightness - self.brightness) < self.brightness_threshold)
+
+    def _same_color(self, hue: int, saturation: int) -> bool:
+        if self.hue is None or self.saturation is None:
+            return False
+        return (hue_distance(hue, self.hue) < self.hue_threshold and
+                abs(saturation - self.saturation) < self.saturation_threshold)
+
+    def reduce(self, command: "DeviceCommand") -> Optional["DeviceCommand"]:
+        """
+        Strips the changes a command would not perceptibly make.
+
+        :return: The smallest command reaching the requested state, or None if the bulb already has it.
+        """
+        if command.kind == "power":
+            return None if command.power == self.power else command
+        if command.kind == "color" and not self.supports_color:
+            command = replace(command, kind="brightness", hue=None, saturation=None)
+
+        same_brightness = self._same_brightness(command.brightness)
+        if command.kind == "brightness":
+            return None if same_brightness else command
+        if self._same_color(command.hue, command.saturation):
+            if same_brightness:
+                return None
+            return replace(command, kind="brightness", hue=None, saturation=None)
+        if same_brightness and command.brightness is not None:
+            # Only the color changes, which set_hsv does on its own
+            return replace(command, brightness=None)
+        return command
+
+    def apply(self, command: "DeviceCommand"):
+        """
+        Records the state after a command was written to the bulb.
+        """
+        self._written_at = time.monotonic()
+        if command.power is not None:
+            self.power = command.power
+        if command.brightness is not None:
+            self.brightness = command.brightness
+        if command.hue is not None:
+            self.hue, self.saturation = command.hue, command.saturation
+
+    def update_from_props(self, props: Dict[str, Any]):
+        """
+        Updates the state from a property notification of the bulb, e.g. after a change from another app.
+
+        :param props: The "params" of the bulb's "props" notification, e.g. {"bright": "50"}.
+        """
+        if time.monotonic() - self._written_at < BULB_NOTIFICATION_GRACE:
+            # Most likely the echo of a command of ours, possibly older than the last one
+            return
+        try:
+            if "power" in props:
+                self.power = props["power"] == "on"
+            if "bright" in props:
+                self.brightness = int(props["bright"])
+            if "hue" in props:
+                self.hue = int(props["hue"])
+            if "sat" in props:
+                self.saturation = int(props["sat"])
+            if "rgb" in props and "hue" not in props:
+                rgb = int(props["rgb"])
+                hue, saturation, _ = colorsys.rgb_to_hsv((rgb >> 16 & 0xFF) / 255, (rgb >> 8 & 0xFF) / 255, (rgb & 0xFF) / 255)
+                self.hue, self.saturation = int(round(hue * 360)) % 360, int(round(saturation * 100))
+            elif "ct" in props and "hue" not in props:
+                # White mode, so any color has to be sent again
+                self.hue = self.saturation = None
+        except (TypeError, ValueError):
+            self.invalidate()
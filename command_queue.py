@@ -0,0 +1,164 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, Optional
+
+from loguru import logger
+
+from bulb_state import BulbState
+from metrics import DEVICE_COMMAND_SECONDS
+from tracing import tracer
+from utils import DEVICE_COMMAND_RATE
+from yeelight_transport import YeelightTransport
+
+
+@dataclass(frozen=True)
+class DeviceCommand:
+    """
+    Represents a state change to send to a bulb.
+
+    Attributes:
+        kind: "brightness", "color" or "power". Pending commands of the same kind replace each other.
+        duration: The duration of the transition in seconds.
+        brightness: The brightness level (0-100), if it changes.
+        hue: The hue (0-359) for color commands.
+        saturation: The saturation (0-100) for color commands.
+        power: Whether to turn the bulb on or off for power commands.
+    """
+    kind: str
+    duration: float = 0.05
+    brightness: Optional[int] = None
+    hue: Optional[int] = None
+    saturation: Optional[int] = None
+    power: Optional[bool] = None
+
+
+class CommandQueue:
+    def __init__(self, transport: YeelightTransport, rate: float = DEVICE_COMMAND_RATE,
+                 on_sent: Optional[Callable[[str, DeviceCommand], None]] = None, state: Optional[BulbState] = None):
+        """
+        Per-bulb command pipeline that coalesces pending commands and paces output.
+
+        A newer command replaces a pending one of the same kind (latest wins), and brightness
+        changes are folded into pending color commands, which carry brightness too. Commands
+        are written to the transport at most `rate` times per second. Before a command is
+        written it is reduced against the shadow state of the bulb, so changes the bulb already
+        has, or too small to see, are not sent and do not use up the rate.
+
+        :param transport: The transport commands are sent through.
+        :param rate: Maximum number of commands per second sent to the bulb.
+        :param on_sent: Called with the bulb's name and every command once it was sent, e.g. to record it.
+        :param state: The shadow state of the bulb. Defaults to a color bulb in an unknown state.
+        """
+        self.transport = transport
+        self.rate = rate
+        self.on_sent = on_sent
+        self.state = state or BulbState()
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.suppressed = 0
+        self.failed = 0
+        self._pending: OrderedDict[str, DeviceCommand] = OrderedDict()
+        # When the oldest change merged into each pending command was submitted
+        self._submitted: Dict[str, float] = {}
+        self._latency = DEVICE_COMMAND_SECONDS.labels(transport.name)
+        self._ready = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+        self._last_sent = 0.0
+
+    def submit(self, command: DeviceCommand):
+        """
+        Queues a command, merging it with or replacing pending commands where possible.
+        """
+        now = time.monotonic()
+        if command.kind == "brightness" and "color" in self._pending:
+            # Pending color commands carry brightness, so fold this change into them, without
+            # cutting the color fade short
+            pending = self._pending["color"]
+            self._pending["color"] = replace(pending, brightness=command.brightness,
+                                             duration=max(pending.duration, command.duration))
+            self.coalesced += 1
+        else:
+            if command.kind == "color" and "brightness" in self._pending:
+                pending_brightness = self._pending.pop("brightness")
+                if command.brightness is None:
+                    command = replace(command, brightness=pending_brightness.brightness)
+                now = min(now, self._submitted.pop("brightness", now))
+                self.coalesced += 1
+            if command.kind in self._pending:
+                self.dropped += 1
+            self._pending[command.kind] = command
+            self._submitted.setdefault(command.kind, now)
+
+        self._ready.set()
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run(), name=f"commands {self.transport.name}")
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the sent, coalesced, dropped, suppressed and failed command counters.
+        """
+        return {
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "suppressed": self.suppressed,
+            "failed": self.failed,
+            "pending": len(self._pending),
+        }
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        self._pending.clear()
+        self._submitted.clear()
+
+    async def _run(self):
+        interval = 1 / self.rate
+        while True:
+            await self._ready.wait()
+            # Pace output: commands arriving in the meantime keep coalescing
+            wait = self._last_sent + interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if not self._pending:
+                self._ready.clear()
+                continue
+
+            kind, command = self._pending.popitem(last=False)
+            submitted = self._submitted.pop(kind, None)
+            if not self._pending:
+                self._ready.clear()
+            command = self.state.reduce(command)
+            if command is None:
+                self.suppressed += 1
+                continue
+            self._last_sent = time.monotonic()
+            try:
+                await self._send(command)
+                self.state.apply(command)
+                self.sent += 1
+                if submitted is not None:
+                    self._latency.observe(time.monotonic() - submitted)
+                if self.on_sent is not None:
+                    self.on_sent(self.transport.name, command)
+            except Exception as e:
+                self.failed += 1
+                # The bulb may or may not have applied it
+                self.state.invalidate()
+                logger.error(f"Failed to send {command.kind} command to {self.transport.name}: {e}")
+
+    async def _send(self, command: DeviceCommand):
+        with tracer.span("send", kind=command.kind):
+            await self._write(command)
+
+    async def _write(self, command: DeviceCommand):
+        if command.kind == "power":
+            await self.transport.set_power(command.power, duration=command.duration)
+        elif command.kind == "color":
+            await self.transport.set_hsv(command.hue, command.saturation, command.brightness, duration=command.duration)
+        else:
+            await self.transport.set_brightness(command.brightness, duration=command.duration)
@@ -0,0 +1,350 @@
+import asyncio
+import json
+import multiprocessing
+import pickle
+import signal
+from dataclasses import replace
+from typing import Any, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+from device_manager import DeviceManager
+from latency import LatencyModel
+from light_controller import LightsController
+from models import Device, DeviceGroup, EventSongChanged
+from playback_clock import PlaybackClock
+from song_preparer import SongPreparer
+from tracing import tracer
+from utils import setup_logging, DEFAULT_GROUP_NAME, CLOCK_SYNC_INTERVAL, WORKER_STOP_TIMEOUT
+
+# A group with the devices assigned to it, Device records or LightDevices
+Assignment = Tuple[DeviceGroup, List[Any]]
+
+
+def load_groups(path: str) -> List[DeviceGroup]:
+    """
+    Loads device groups from a JSON file, e.g.
+    {"groups": [{"name": "living room", "devices": ["192.168.1.20", "192.168.1.21"], "effect": "sudden"}]}
+
+    :raises ValueError: If the file does not describe groups.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    entries = config.get("groups", []) if isinstance(config, dict) else config
+    try:
+        groups = [DeviceGroup(**entry) for entry in entries]
+    except TypeError as e:
+        raise ValueError(f"Invalid device group in {path}: {e}") from e
+    names = [group.name for group in groups]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate device group names in {path}")
+    return groups
+
+
+def default_group(groups: Sequence[DeviceGroup]) -> DeviceGroup:
+    """
+    Returns the group of the devices no group lists: the one named DEFAULT_GROUP_NAME if configured.
+    """
+    return next((group for group in groups if group.name == DEFAULT_GROUP_NAME), None) or DeviceGroup(DEFAULT_GROUP_NAME)
+
+
+def find_group(groups: Sequence[DeviceGroup], device_name: str) -> DeviceGroup:
+    """
+    Returns the first group listing a device by name or IP, or the default group.
+    """
+    return next((group for group in groups if group.includes(device_name)), None) or default_group(groups)
+
+
+def assign_devices(groups: Sequence[DeviceGroup], devices: Sequence[Any], keep_empty: bool = False) -> List[Assignment]:
+    """
+    Assigns every device to the first group listing its name or IP. Devices no group lists
+    go to the group named DEFAULT_GROUP_NAME, which is created if needed.
+
+    :param groups: The configured groups.
+    :param devices: Device records or LightDevices, which both have a name.
+    :param keep_empty: Whether to also return the groups without devices, including the default
+        one, e.g. so devices found later have a controller to join.
+    :return: The groups that have devices, with their devices.
+    """
+    assignments = {group.name: (group, []) for group in [*groups, default_group(groups)]}
+    listed = set()
+    for device in devices:
+        assignments[find_group(groups, device.name).name][1].append(device)
+        listed.update((device.name, device.name.split(":")[0]))
+
+    for group in groups:
+        missing = [name for name in group.devices if name not in listed]
+        if missing:
+            logger.warning(f"Devices of group {group.name} not found: {', '.join(missing)}")
+    return [(group, group_devices) for group, group_devices in assignments.values() if group_devices or keep_empty]
+
+
+def shard_groups(assignments: Sequence[Assignment], workers: int) -> List[List[Assignment]]:
+    """
+    Distributes groups over worker processes. Groups pinned to a worker stay there, the others
+    go to the worker with the fewest devices, largest groups first. The default group is split
+    into one part per worker first, as the devices no group lists need not move together; so
+    without any groups configured the devices are simply spread over the workers. The parts
+    keep the positions of their devices in the whole group, so its pattern spans all of them.
+    """
+    split: List[Assignment] = []
+    for group, group_devices in assignments:
+        parts = min(workers, len(group_devices))
+        if group.name != DEFAULT_GROUP_NAME or group.worker is not None or parts < 2:
+            split.append((group, group_devices))
+            continue
+        positions = [index / (len(group_devices) - 1) for index in range(len(group_devices))]
+        split += [(replace(group, name=f"{group.name} {part + 1}", positions=positions[part::parts]), group_devices[part::parts])
+                  for part in range(parts)]
+
+    shards: List[List[Assignment]] = [[] for _ in range(workers)]
+    loads = [0] * workers
+    pinned = [assignment for assignment in split if assignment[0].worker is not None]
+    unpinned = sorted((assignment for assignment in split if assignment[0].worker is None),
+                      key=lambda assignment: len(assignment[1]), reverse=True)
+    for assignment in pinned + unpinned:
+        group, group_devices = assignment
+        index = group.worker % workers if group.worker is not None else loads.index(min(loads))
+        shards[index].append(assignment)
+        loads[index] += len(group_devices)
+    return [shard for shard in shards if shard]
+
+
+def run_worker(connection, assignments: List[Assignment], speed: float, log_level: str):
+    """
+    Entry point of a worker process: connects to the bulbs of its groups and drives them from
+    the events and clock states the main process sends.
+    """
+    # The main process handles Ctrl+C and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_logging(log_level)
+    asyncio.run(_serve(connection, assignments, speed))
+
+
+async def _serve(connection, assignments: List[Assignment], speed: float):
+    latency_model = LatencyModel()
+    clock = PlaybackClock(speed=speed)
+
+    async def start_group(group: DeviceGroup, group_devices: List[Device]) -> LightsController:
+        devices = await DeviceManager(effect=group.effect, latency_model=latency_model).initialize_devices(group_devices)
+        if group.positions is not None:
+            # Bulbs that failed to connect leave a gap in the layout
+            positions = dict(zip((device.name for device in group_devices), group.positions))
+            group = replace(group, positions=[positions[device.name] for device in devices])
+        return LightsController(devices, asyncio.Queue(), clock, latency_model, group=group)
+
+    controllers = await asyncio.gather(*(start_group(group, group_devices) for group, group_devices in assignments))
+    logger.info(f"Worker driving {sum(len(controller.devices) for controller in controllers)} bulb(s) in "
+                f"{', '.join(controller.group.name for controller in controllers)}")
+    tasks = [asyncio.create_task(controller.control_lights(), name=f"controller {controller.group.name}")
+             for controller in controllers]
+    connection.send(len(controllers))
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                message = await loop.run_in_executor(None, connection.recv)
+            except EOFError:
+                break
+            if message is None:
+                break
+            kind, payload = message
+            if kind == "clock":
+                clock.restore(payload)
+            else:
+                for controller in controllers:
+                    controller.events_queue.put_nowait(payload)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for controller in controllers:
+            for device in controller.devices:
+                await device.close()
+        # The main process saves the latency profile
+        try:
+            connection.send(("latency", latency_model.device_samples()))
+        except OSError:
+            pass
+        connection.close()
+
+
+class GroupWorker:
+    def __init__(self, index: int, assignments: List[Assignment], speed: float = 1.0, log_level: str = "DEBUG",
+                 latency_model: Optional[LatencyModel] = None):
+        """
+        Runs device groups in a separate process, which owns the connections to their bulbs.
+
+        Messages are pickled once by the GroupBroadcaster and written to the worker's pipe from a
+        thread, in order, so a slow worker never blocks the event loop.
+
+        :param index: The number of the worker, for logs.
+        :param assignments: The groups the worker runs, with their Device records.
+        :param speed: The nominal playback rate, above 1 when replaying faster than real time.
+        :param log_level: The log level of the worker process.
+        :param latency_model: Where the latencies the worker measured are recorded once it stopped.
+        """
+        self.index = index
+        self.assignments = assignments
+        self.latency_model = latency_model
+        # Forking a process running an event loop and threads is unsafe
+        context = multiprocessing.get_context("spawn")
+        self._connection, self._child = context.Pipe()
+        self.process = context.Process(target=run_worker, args=(self._child, assignments, speed, log_level),
+                                       name=f"group worker {index}", daemon=True)
+        self._outbox: asyncio.Queue = asyncio.Queue()
+        self._sender: Optional[asyncio.Task] = None
+        self._exit: Optional[asyncio.Future] = None
+        self._closing = False
+
+    def start(self):
+        self.process.start()
+        self._child.close()
+        loop = asyncio.get_running_loop()
+        self._exit = loop.create_future()
+        # The sentinel becomes readable when the process exits
+        loop.add_reader(self.process.sentinel, self._on_exit)
+        self._sender = asyncio.create_task(self._send_loop(), name=f"sender {self.index}")
+        groups = ", ".join(f"{group.name} ({len(devices)})" for group, devices in self.assignments)
+        logger.info(f"Started group worker {self.index} (pid {self.process.pid}) for {groups}")
+
+    async def wait_ready(self):
+        """
+        Waits until the worker is connected to its bulbs and drives them.
+
+        :raises RuntimeError: If the worker exited before.
+        """
+        try:
+            await asyncio.to_thread(self._connection.recv)
+        except EOFError:
+            raise RuntimeError(f"Group worker {self.index} exited before it was ready") from None
+
+    def send(self, payload: bytes):
+        """
+        Queues a pickled message for the worker.
+        """
+        self._outbox.put_nowait(payload)
+
+    async def _send_loop(self):
+        while True:
+            payload = await self._outbox.get()
+            try:
+                await asyncio.to_thread(self._connection.send_bytes, payload)
+            except OSError as e:
+                logger.error(f"Lost connection to group worker {self.index}: {e!r}")
+                return
+            finally:
+                self._outbox.task_done()
+
+    def _on_exit(self):
+        asyncio.get_running_loop().remove_reader(self.process.sentinel)
+        self.process.join()
+        if not self._exit.done():
+            self._exit.set_result(self.process.exitcode)
+
+    async def watch(self):
+        """
+        Waits for the worker to exit, which is an error unless it was closed.
+
+        :raises RuntimeError: If the worker exited on its own.
+        """
+        exitcode = await asyncio.shield(self._exit)
+        if not self._closing:
+            raise RuntimeError(f"Group worker {self.index} exited with code {exitcode}")
+
+    async def close(self, timeout: float = WORKER_STOP_TIMEOUT):
+        """
+        Asks the worker to close its bulb connections and exit, terminating it after timeout seconds.
+        """
+        self._closing = True
+        if self._exit is not None and not self._exit.done():
+            self.send(pickle.dumps(None))
+            try:
+                await asyncio.wait_for(asyncio.shield(self._exit), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Group worker {self.index} did not stop, terminating it")
+                asyncio.get_running_loop().remove_reader(self.process.sentinel)
+                self.process.terminate()
+                self.process.join()
+        if self._sender is not None:
+            self._sender.cancel()
+        self._receive_latencies()
+        self._connection.close()
+
+    def _receive_latencies(self):
+        try:
+            while self._connection.poll():
+                kind, payload = self._connection.recv()
+                if kind == "latency" and self.latency_model is not None:
+                    self.latency_model.record_device_samples(payload)
+        except (EOFError, OSError):
+            pass
+
+
+class GroupBroadcaster:
+    def __init__(self, events_queue: asyncio.Queue, clock: PlaybackClock, queues: Sequence[asyncio.Queue] = (),
+                 workers: Sequence[GroupWorker] = (), sync_interval: float = CLOCK_SYNC_INTERVAL,
+                 preparer: Optional[SongPreparer] = None):
+        """
+        Forwards the events of the single listener to the controllers of every device group.
+
+        Controllers in this process get the events on their own queue and share the clock. Worker
+        processes get every event and the state of the clock, on each correction and every
+        sync_interval seconds in between, as the filter also refines it without correcting.
+        Songs that were not prepared ahead of time are prepared here before they are sent to the
+        workers, so the song is compiled once and every group plays the same show.
+
+        :param events_queue: The queue the listener puts events in.
+        :param clock: The playback clock fed by the listener.
+        :param queues: The events queues of the controllers in this process.
+        :param workers: The worker processes running the other groups.
+        :param sync_interval: Seconds between clock states sent to the workers.
+        :param preparer: Prepares the songs sent to the workers.
+        """
+        self.events_queue = events_queue
+        self.clock = clock
+        self.queues = list(queues)
+        self.workers = list(workers)
+        self.sync_interval = sync_interval
+        self.preparer = preparer or SongPreparer(workers=0)
+        if self.workers:
+            clock.add_listener(self._send_clock)
+
+    async def run(self):
+        sync = asyncio.create_task(self._sync_clock(), name="clock sync") if self.workers else None
+        try:
+            while True:
+                event = await self.events_queue.get()
+                if self.workers and isinstance(event, EventSongChanged) and event.song is None:
+                    event = await self._prepare(event)
+                for queue in self.queues:
+                    queue.put_nowait(event)
+                if self.workers:
+                    with tracer.span("broadcast", event=type(event).__name__):
+                        self._send(("event", event))
+                self.events_queue.task_done()
+        finally:
+            if sync is not None:
+                sync.cancel()
+
+    async def _prepare(self, event: EventSongChanged) -> EventSongChanged:
+        try:
+            return replace(event, song=await self.preparer.prepare(event.analysis, event.track_id))
+        except Exception as e:
+            # The controllers prepare it themselves
+            logger.exception(f"Failed to prepare song {event.track_id} for the group workers: {e!r}")
+            return event
+
+    async def _sync_clock(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            self._send_clock()
+
+    def _send_clock(self):
+        self._send(("clock", self.clock.snapshot()))
+
+    def _send(self, message: Tuple[str, Any]):
+        # Pickled once for all workers
+        payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+        for worker in self.workers:
+            worker.send(payload)
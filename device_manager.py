@@ -1,42 +1,134 @@
-from typing import List
-from yeelight import discover_bulbs, Bulb
+import asyncio
+from typing import Callable, List, Optional, Sequence
+from yeelight import discover_bulbs
 from loguru import logger
 from light_device import LightDevice  # Import the new LightDevice class
+from yeelight_transport import YeelightTransport
+from device_registry import DeviceRegistry
+from latency import LatencyModel
+from models import Device, DeviceGroup
+from utils import YEELIGHT_DEFAULT_PORT, DEVICE_DISCOVERY_TIMEOUT, DEVICE_INIT_TIMEOUT, DEFAULT_GROUP_NAME
 
 class DeviceManager:
-    def __init__(self, effect="smooth", auto_on=False):
+    def __init__(self, effect="smooth", auto_on=False, registry: Optional[DeviceRegistry] = None,
+                 latency_model: Optional[LatencyModel] = None, recorder=None, groups: Sequence[DeviceGroup] = ()):
         """
         Initializes the DeviceManager with default settings for bulbs.
 
         :param effect: The effect to use when changing the bulb's state. Default is "smooth".
-        :param auto_on: Whether to automatically turn on the bulb if it's off when setting states. Default is False.
+        :param auto_on: Whether to turn the bulbs on when connecting to them, as the lights controller
+            only changes their color and brightness. Default is False.
+        :param registry: The registry of known devices. Defaults to the one in the user's cache directory.
+        :param latency_model: Where the devices record their measured latencies, if anywhere.
+        :param recorder: A session_recording.SessionRecorder capturing the commands sent, if any.
+        :param groups: The configured device groups, whose effect the bulbs they list use instead.
         """
         self.effect = effect
         self.auto_on = auto_on
+        self.registry = registry or DeviceRegistry()
+        self.latency_model = latency_model
+        self.recorder = recorder
+        self.groups = groups
+        # Called with the devices the background rediscovery connected to, after they were appended
+        self.on_added: Optional[Callable[[List[LightDevice]], None]] = None
+        self._rediscovery: Optional[asyncio.Task] = None
 
-    def discover_devices(self) -> List[LightDevice]:
+    async def discover_devices(self) -> List[LightDevice]:
         """
-        Discovers Yeelight bulbs on the local network.
+        Connects to the Yeelight bulbs on the local network.
 
-        :return: A list of initialized LightDevice objects ready for use.
+        Known bulbs from the registry are connected to right away while a background scan
+        reconciles the registry. Without a registry, waits for the scan to finish.
+
+        :return: A list of initialized LightDevice objects ready for use. Bulbs found by the
+            background rediscovery are appended to it later.
         """
-        logger.info("Discovering bulbs...")
-        bulbs_info = discover_bulbs()
-        devices = []
-
-        for bulb_info in bulbs_info:
-            ip = bulb_info["ip"]
-            port = bulb_info.get("port", 55443)  # Default port for Yeelight bulbs
-
-            try:
-                bulb = Bulb(ip, port, effect=self.effect, auto_on=self.auto_on)
-                # Initialize LightDevice with the Bulb instance
-                light_device = LightDevice(bulb)
-                bulb.start_music()
-                devices.append(light_device)
-                logger.info(f"Initialized LightDevice at {ip}:{port}")
-            except Exception as e:
-                logger.error(f"Failed to initialize bulb at {ip}:{port}: {e}")
+        known = self.registry.load()
+        if known:
+            logger.info(f"Connecting to {len(known)} known bulb(s) while rediscovering...")
+            devices = await self.initialize_devices(known)
+            self._rediscovery = asyncio.create_task(self._rediscover(devices))
+        else:
+            found = await self.scan()
+            devices = await self.initialize_devices(found)
+            self.registry.save(found)
 
         logger.info(f"Found and initialized {len(devices)} LightDevice(s).")
         return devices
+
+    async def find_devices(self) -> List[Device]:
+        """
+        Returns the known bulbs without connecting to them, scanning for bulbs when none are known,
+        e.g. to hand them to the worker processes that connect to them.
+        """
+        known = self.registry.load()
+        if known:
+            return known
+        found = await self.scan()
+        self.registry.save(found)
+        return found
+
+    async def scan(self) -> List[Device]:
+        """
+        Runs an SSDP scan for Yeelight bulbs without blocking the event loop.
+        """
+        logger.info("Discovering bulbs...")
+        bulbs_info = await asyncio.to_thread(discover_bulbs, timeout=DEVICE_DISCOVERY_TIMEOUT)
+        return [
+            Device(
+                ip_address=bulb_info["ip"],
+                port=bulb_info.get("port", YEELIGHT_DEFAULT_PORT),  # Default port for Yeelight bulbs
+                model=bulb_info.get("capabilities", {}).get("model", "unknown"),
+                capabilities=bulb_info.get("capabilities", {}),
+            )
+            for bulb_info in bulbs_info
+        ]
+
+    async def initialize_devices(self, devices: List[Device]) -> List[LightDevice]:
+        """
+        Connects to the given bulbs concurrently, skipping those that fail or time out.
+        """
+        results = await asyncio.gather(*(self._initialize_device(device) for device in devices))
+        return [light_device for light_device in results if light_device is not None]
+
+    async def _initialize_device(self, device: Device) -> Optional[LightDevice]:
+        ip, port = device.ip_address, device.port
+        transport = YeelightTransport(ip, port, effect=self._effect_for(device))
+        try:
+            await asyncio.wait_for(transport.connect(), DEVICE_INIT_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Failed to initialize bulb at {ip}:{port}: {e!r}")
+            await transport.close()
+            return None
+        logger.info(f"Initialized LightDevice at {ip}:{port}")
+        light_device = LightDevice(transport, device.model, latency_model=self.latency_model, recorder=self.recorder)
+        if self.auto_on:
+            light_device.turn_on()
+        return light_device
+
+    def _effect_for(self, device: Device) -> str:
+        """
+        Returns the effect of the group listing the device, or of the default group if configured.
+        """
+        group = next((group for group in self.groups if group.includes(device.name)), None)
+        group = group or next((group for group in self.groups if group.name == DEFAULT_GROUP_NAME), None)
+        return group.effect if group is not None else self.effect
+
+    async def _rediscover(self, devices: List[LightDevice]):
+        try:
+            found = await self.scan()
+        except Exception as e:
+            logger.error(f"Background rediscovery failed: {e!r}")
+            return
+
+        connected = {device.ip for device in devices}
+        new_devices = await self.initialize_devices([device for device in found if device.ip_address not in connected])
+        devices.extend(new_devices)
+        if new_devices and self.on_added is not None:
+            self.on_added(new_devices)
+
+        # Keep bulbs we are connected to even if they did not answer this scan
+        found_ips = {device.ip_address for device in found}
+        kept = [device for device in self.registry.load() if device.ip_address in connected - found_ips]
+        self.registry.save(found + kept)
+        logger.info(f"Rediscovery added {len(new_devices)} LightDevice(s); {len(found + kept)} known in total.")
@@ -0,0 +1,40 @@
+import json
+import os
+from dataclasses import asdict
+from typing import List
+
+from loguru import logger
+
+from models import Device
+from utils import DEVICE_REGISTRY_PATH
+
+
+class DeviceRegistry:
+    def __init__(self, path: str = DEVICE_REGISTRY_PATH):
+        """
+        Persists the bulbs found on the network so restarts can connect to them right away.
+
+        :param path: The JSON file where known devices are stored.
+        """
+        self.path = path
+
+    def load(self) -> List[Device]:
+        """
+        Returns the known devices, or an empty list if the registry is missing or unreadable.
+        """
+        try:
+            with open(self.path) as f:
+                return [Device(**entry) for entry in json.load(f)]
+        except FileNotFoundError:
+            return []
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable device registry {self.path}: {e}")
+            return []
+
+    def save(self, devices: List[Device]):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([asdict(device) for device in devices], f, indent=2)
+        os.replace(tmp_path, self.path)
+        logger.debug(f"Saved {len(devices)} device(s) to {self.path}")
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import random
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+
+from utils import setup_logging
+
+
+class FakeBulb:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, model: str = "color", latency: float = 0.0,
+                 drop_rate: float = 0.0, seed: Optional[int] = None):
+        """
+        Local stand-in for a Yeelight bulb speaking the JSON-over-TCP protocol.
+
+        Answers commands on the control connection, connects back on set_music like a real
+        bulb and records every command it applies with the time it was applied.
+
+        :param host: The address to listen on.
+        :param port: The port to listen on. 0 picks a free port.
+        :param model: The model reported by the bulb.
+        :param latency: Seconds the bulb takes to process each command. Commands are processed
+            one at a time per connection, so they queue up behind slow ones.
+        :param drop_rate: Probability of silently losing a command sent in music mode.
+        :param seed: Seed of the random drops.
+        """
+        self.host = host
+        self.port = port
+        self.model = model
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+        self.received: List[Tuple[float, Dict[str, Any]]] = []
+        self.dropped: List[Tuple[float, Dict[str, Any]]] = []
+        self.properties: Dict[str, Any] = {"power": "on", "bright": "50", "hue": "0", "sat": "0"}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._music_tasks: List[asyncio.Task] = []
+        self._control_tasks: Set[asyncio.Task] = set()
+        self._control_writers: Set[asyncio.StreamWriter] = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_control, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Fake {self.model} bulb listening on {self.host}:{self.port}")
+
+    async def stop(self):
+        for task in self._music_tasks:
+            task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        # Let the connection handlers finish instead of being cancelled at shutdown
+        for writer in self._control_writers:
+            writer.close()
+        await asyncio.gather(*self._music_tasks, *self._control_tasks, return_exceptions=True)
+
+    async def handle_command(self, command: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Applies a command and returns the reply a real bulb would send.
+        """
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        self.received.append((time.monotonic(), command))
+        method, params = command.get("method"), command.get("params", [])
+        if method == "get_prop":
+            return {"id": command.get("id"), "result": [self.properties.get(name, "") for name in params]}
+        changes = {}
+        if method == "set_bright":
+            changes = {"bright": str(params[0])}
+        elif method == "set_hsv":
+            changes = {"hue": str(params[0]), "sat": str(params[1])}
+        elif method == "set_scene" and params and params[0] == "hsv":
+            changes = {"hue": str(params[1]), "sat": str(params[2]), "bright": str(params[3])}
+        elif method == "start_cf" and len(params) == 3:
+            # Only one-step flows, which end in the state of their step
+            _, mode, value, bright = params[2].split(",")[:4]
+            changes = {"rgb" if mode == "1" else "ct": value, "bright": bright}
+        elif method == "set_power":
+            changes = {"power": params[0]}
+        elif method == "set_music" and params and params[0] == 1:
+            self._music_tasks.append(asyncio.create_task(self._connect_music(params[1], params[2])))
+        self._notify({name: value for name, value in changes.items() if self.properties.get(name) != value})
+        return {"id": command.get("id"), "result": ["ok"]}
+
+    def _notify(self, changes: Dict[str, Any]):
+        """
+        Applies property changes and notifies them on every control connection, like a real bulb.
+        """
+        if not changes:
+            return
+        self.properties.update(changes)
+        notification = (json.dumps({"method": "props", "params": changes}) + "\r\n").encode()
+        for writer in self._control_writers:
+            if not writer.is_closing():
+                writer.write(notification)
+
+    async def _handle_control(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._control_tasks.add(task)
+        self._control_writers.add(writer)
+        try:
+            while line := await reader.readline():
+                try:
+                    command = json.loads(line)
+                except ValueError:
+                    continue
+                reply = await self.handle_command(command)
+                writer.write((json.dumps(reply) + "\r\n").encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self._control_tasks.discard(task)
+            self._control_writers.discard(writer)
+            writer.close()
+
+    async def _connect_music(self, host: str, port: int):
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            # Commands in music mode are never answered
+            while line := await reader.readline():
+                try:
+                    command = json.loads(line)
+                except ValueError:
+                    continue
+                if self.drop_rate > 0 and self._random.random() < self.drop_rate:
+                    self.dropped.append((time.monotonic(), command))
+                    continue
+                await self.handle_command(command)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(count: int, host: str, latency: float, drop_rate: float):
+    bulbs = [FakeBulb(host, latency=latency, drop_rate=drop_rate) for _ in range(count)]
+    for bulb in bulbs:
+        await bulb.start()
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve fake Yeelight bulbs on the local machine.")
+    parser.add_argument("--count", type=int, default=1)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each command takes to process")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="probability of losing a music mode command")
+    args = parser.parse_args()
+    setup_logging("DEBUG")
+    asyncio.run(serve(args.count, args.host, args.latency, args.drop_rate))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import time
+from typing import Dict, Optional
+
+from aiohttp import web
+from loguru import logger
+
+from session_recording import Session
+from utils import API_AUDIO_ANALYSIS, API_CURRENT_PLAYING, API_PLAYER_QUEUE, setup_logging
+
+
+class FakeSpotifyServer:
+    def __init__(self, session: Session, host: str = "127.0.0.1", port: int = 0, speed: float = 1.0):
+        """
+        Local stand-in for the Spotify Web API serving a recorded session.
+
+        The currently-playing endpoint answers with the recorded response at the replayed time,
+        the audio-analysis endpoint rebuilds the recorded analyses as JSON, and the queue
+        endpoint lists the tracks played after the current one.
+
+        :param session: The session to serve.
+        :param host: The address to listen on.
+        :param port: The port to listen on. 0 picks a free port.
+        :param speed: How many times faster than real time to replay the session.
+        """
+        self.session = session
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.requests = 0
+        self._started_at: Optional[float] = None
+        self._analysis_bodies: Dict[str, bytes] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def api_base(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def session_time(self) -> float:
+        return (time.monotonic() - self._started_at) * self.speed if self._started_at is not None else 0.0
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get(API_CURRENT_PLAYING, self._currently_playing)
+        app.router.add_get(API_PLAYER_QUEUE, self._queue)
+        app.router.add_get(API_AUDIO_ANALYSIS + "{track_id}", self._audio_analysis)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        self._started_at = time.monotonic()
+        logger.info(f"Fake Spotify API serving {self.session.duration:.1f}s of session on {self.api_base} at {self.speed}x")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def wait_finished(self):
+        """
+        Waits until the whole session has been replayed.
+        """
+        await asyncio.sleep(max(self.session.duration - self.session_time(), 0) / self.speed)
+
+    async def _currently_playing(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        response = self.session.response_at(self.session_time())
+        if not response:
+            return web.Response(status=204)
+        return web.json_response(response)
+
+    async def _queue(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        current = self.session.response_at(self.session_time()).get("item", {}).get("id")
+        upcoming = self.session.upcoming(current)
+        return web.json_response({"queue": [{"id": track_id, "type": "track"} for track_id in upcoming]})
+
+    async def _audio_analysis(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        track_id = request.match_info["track_id"]
+        if track_id not in self.session.analyses:
+            raise web.HTTPNotFound()
+        if track_id not in self._analysis_bodies:
+            self._analysis_bodies[track_id] = json.dumps(self.session.analyses[track_id].to_raw()).encode()
+        return web.Response(body=self._analysis_bodies[track_id], content_type="application/json")
+
+
+async def serve(path: str, host: str, port: int, speed: float):
+    server = FakeSpotifyServer(Session.load(path), host, port, speed)
+    await server.start()
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Serve a recorded session as a fake Spotify Web API.")
+    parser.add_argument("session")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--speed", type=float, default=1.0)
+    args = parser.parse_args()
+    setup_logging("DEBUG")
+    asyncio.run(serve(args.session, args.host, args.port, args.speed))
@@ -0,0 +1,156 @@
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from light_device import LightDevice
+from song_compiler import CompiledShow, ENTRY_COLOR
+from utils import FRAME_HUE_SPREAD, FRAME_WAVE_DELAY
+
+
+@dataclass
+class Frame:
+    """
+    The devices whose light state changes at a tick, and their new state.
+
+    Attributes:
+        devices: Indexes of the devices to update into FrameRenderer.devices.
+        index: The show entry each device is at.
+        full_state: Whether to send the color too, or only the brightness.
+        hue: Hue (0-359) of each device.
+        saturation: Saturation (0-100) of each device.
+        brightness: Brightness (0-100) of each device.
+        duration: Duration of each transition in seconds.
+    """
+    devices: np.ndarray
+    index: np.ndarray
+    full_state: np.ndarray
+    hue: np.ndarray
+    saturation: np.ndarray
+    brightness: np.ndarray
+    duration: np.ndarray
+
+    def __len__(self):
+        return len(self.devices)
+
+
+class FrameRenderer:
+    def __init__(self, devices: List[LightDevice], hue_spread: int = FRAME_HUE_SPREAD,
+                 wave_delay: float = FRAME_WAVE_DELAY, layout: Optional[Sequence[float]] = None):
+        """
+        Renders the light state of every device from the compiled show in one vectorized step.
+
+        Keeps each device's cursor into the show and its last rendered state in arrays, so a
+        tick costs a few NumPy operations however many bulbs there are, and only the devices
+        whose state changed are returned. Devices are laid out along a line in the order given;
+        the spatial pattern interpolates a hue offset and a delay along it, so the colors form
+        a gradient and changes ripple from the first bulb to the last.
+
+        :param devices: The devices to render frames for.
+        :param hue_spread: Hue difference in degrees between the first and the last device.
+        :param wave_delay: Delay in song seconds between the first and the last device.
+        :param layout: The position of each device along the line, from 0 to 1, e.g. when the
+            devices are only part of a group. By default they are spread evenly.
+        """
+        self.devices = devices
+        self.hue_spread = hue_spread
+        self.wave_delay = wave_delay
+        self.layout = layout
+        self.show: Optional[CompiledShow] = None
+        self._times: Optional[np.ndarray] = None
+        self._states: Optional[np.ndarray] = None
+        self._color_counts: Optional[np.ndarray] = None
+        # Index of the next entry to apply per device
+        self.next_index = np.zeros(0, dtype=np.int64)
+        self.rendered = np.zeros(0, dtype=bool)
+        # Last rendered hue, saturation and brightness per device
+        self.state = np.zeros((0, 3), dtype=np.int64)
+        self._layout()
+
+    def _layout(self):
+        """
+        Lays the devices out again when some were added, e.g. by the background rediscovery.
+        The new devices start from the beginning of the show and catch up on the next tick.
+        """
+        count = len(self.devices)
+        added = count - len(self.rendered)
+        # Position of each device along the installation, from 0 to 1
+        if self.layout is not None and len(self.layout) == count:
+            positions = np.array(self.layout, dtype=np.float64)
+        else:
+            positions = np.linspace(0, 1, count) if count > 1 else np.zeros(count)
+        self.hue_offsets = np.rint(positions * self.hue_spread).astype(np.int64)
+        self.time_offsets = positions * self.wave_delay
+        self.color_capable = np.array([device.supports_color for device in self.devices], dtype=bool)
+        self.next_index = np.append(self.next_index, np.zeros(added, dtype=np.int64))
+        self.rendered = np.append(self.rendered, np.zeros(added, dtype=bool))
+        self.state = np.vstack((self.state, np.zeros((added, 3), dtype=np.int64)))
+        self._offsets = np.zeros((count, 3), dtype=np.int64)
+        self._offsets[:, 0] = self.hue_offsets
+
+    def load(self, show: CompiledShow):
+        self.show = show
+        # Padded so devices past the last entry are never due
+        self._times = np.append(show.times, np.inf)
+        self._states = np.stack((show.hue, show.saturation, show.brightness), axis=1).astype(np.int64)
+        # Number of color entries before each index, to tell whether a range of entries changes the color
+        self._color_counts = np.concatenate(([0], np.cumsum(show.kinds == ENTRY_COLOR)))
+        self.next_index[:] = 0
+        self.rendered[:] = False
+
+    def positions(self, progress: float, lead_times: np.ndarray, rate: float) -> np.ndarray:
+        """
+        Returns the show position each device should be at for a playback position.
+
+        :param progress: The playback position in seconds.
+        :param lead_times: The lead time of every device in real seconds.
+        :param rate: The playback rate of the clock.
+        """
+        if len(self.devices) != len(self.rendered):
+            self._layout()
+        return progress + lead_times * rate - self.time_offsets
+
+    def render(self, positions: np.ndarray, resync: bool = False) -> Frame:
+        """
+        Advances the devices to their positions and returns the ones whose state changed.
+
+        :param positions: The show position of every device, see positions().
+        :param resync: Whether the positions jumped (song change or seek), in which case every
+            device gets the full state of the entry preceding its position.
+        """
+        index = self.show.times.searchsorted(positions, side="right")
+        if resync:
+            due = index > 0
+            full_state = self.color_capable
+        else:
+            # Small corrections of the clock must not replay entries already applied
+            index = np.maximum(index, self.next_index)
+            due = index > self.next_index
+            # Entries due together collapse into the state after the last one
+            full_state = (self._color_counts[index] > self._color_counts[self.next_index]) & self.color_capable
+        self.next_index = index
+
+        rows = due.nonzero()[0]
+        entry = index[rows] - 1
+        full_state = full_state[rows]
+        state = self._states[entry] + self._offsets[rows]
+        state[:, 0] %= 360
+
+        # Brightness changes always count, color changes only if the color is sent
+        difference = state != self.state[rows]
+        changed = ~self.rendered[rows] | difference[:, 2] | (full_state & (difference[:, 0] | difference[:, 1]))
+        if not changed.all():
+            rows, entry, full_state, state = rows[changed], entry[changed], full_state[changed], state[changed]
+
+        self.rendered[rows] = True
+        self.state[rows, 2] = state[:, 2]
+        self.state[rows[full_state], :2] = state[full_state, :2]
+        return Frame(rows, entry, full_state, state[:, 0], state[:, 1], state[:, 2], self.show.durations[entry])
+
+    def time_to_next(self, positions: np.ndarray) -> Optional[float]:
+        """
+        Returns how many song seconds remain until the next entry is due for any device,
+        or None if no device has entries left.
+        """
+        remaining = float((self._times[self.next_index] - positions).min())
+        return None if remaining == np.inf else remaining
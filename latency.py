@@ -0,0 +1,139 @@
+import json
+import os
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from loguru import logger
+
+from utils import (
+    COMMAND_LEAD_TIME,
+    LATENCY_WINDOW,
+    LATENCY_MIN_SAMPLES,
+    LEAD_TIME_PERCENTILE,
+    LATENCY_PROFILE_PATH,
+)
+
+
+class RollingPercentiles:
+    def __init__(self, window: int = LATENCY_WINDOW):
+        """
+        Keeps the last `window` samples of a latency and computes percentiles over them.
+        """
+        self.samples = deque(maxlen=window)
+        # Percentiles are read on every tick but only change with new samples
+        self._percentiles: Dict[float, float] = {}
+
+    def add(self, value: float):
+        self.samples.append(value)
+        self._percentiles.clear()
+
+    def __len__(self):
+        return len(self.samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        if p not in self._percentiles:
+            self._percentiles[p] = float(np.percentile(np.fromiter(self.samples, dtype=float, count=len(self.samples)), p))
+        return self._percentiles[p]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": len(self.samples),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+
+class LatencyModel:
+    def __init__(self, path: Optional[str] = LATENCY_PROFILE_PATH, default_lead: float = COMMAND_LEAD_TIME,
+                 percentile: float = LEAD_TIME_PERCENTILE):
+        """
+        Tracks Spotify round-trip times and per-bulb command-to-ack latencies.
+
+        The lead time of a bulb, i.e. how early its commands are sent, is its measured latency
+        percentile once enough samples exist, unless it was overridden by hand.
+
+        :param path: JSON file the profile is exported to and lead time overrides are loaded from.
+        :param default_lead: Lead time in seconds used until a bulb has enough samples.
+        :param percentile: The latency percentile used as lead time.
+        """
+        self.path = path
+        self.default_lead = default_lead
+        self.percentile = percentile
+        self.spotify_rtt = RollingPercentiles()
+        self.devices: Dict[str, RollingPercentiles] = {}
+        self.overrides: Dict[str, float] = {}
+        if path is not None:
+            self._load_overrides()
+
+    def record_spotify_rtt(self, rtt: float):
+        self.spotify_rtt.add(rtt)
+
+    def record_device_latency(self, device_id: str, latency: float):
+        self.devices.setdefault(device_id, RollingPercentiles()).add(latency)
+
+    def device_samples(self) -> Dict[str, List[float]]:
+        """
+        Returns the latency samples of every bulb, e.g. to hand them to another process.
+        """
+        return {device_id: list(samples.samples) for device_id, samples in self.devices.items()}
+
+    def record_device_samples(self, device_samples: Dict[str, List[float]]):
+        """
+        Adds latency samples measured elsewhere, e.g. by a worker process driving the bulbs.
+        """
+        for device_id, latencies in device_samples.items():
+            for latency in latencies:
+                self.record_device_latency(device_id, latency)
+
+    def set_lead_time(self, device_id: str, lead_time: Optional[float]):
+        """
+        Overrides the lead time of a bulb, or restores the measured one when lead_time is None.
+        """
+        if lead_time is None:
+            self.overrides.pop(device_id, None)
+        else:
+            self.overrides[device_id] = lead_time
+
+    def lead_time(self, device_id: str) -> float:
+        """
+        Returns how many seconds ahead of time commands should be sent to a bulb.
+        """
+        if device_id in self.overrides:
+            return self.overrides[device_id]
+        samples = self.devices.get(device_id)
+        if samples is None or len(samples) < LATENCY_MIN_SAMPLES:
+            return self.default_lead
+        return samples.percentile(self.percentile)
+
+    def export(self) -> Dict[str, Any]:
+        """
+        Returns the measured latencies and lead times as a JSON-serializable dictionary.
+        """
+        return {
+            "spotify_rtt": self.spotify_rtt.summary(),
+            "devices": {
+                device_id: {**samples.summary(), "lead_time": self.lead_time(device_id)}
+                for device_id, samples in self.devices.items()
+            },
+            "overrides": dict(self.overrides),
+        }
+
+    def save(self, path: Optional[str] = None):
+        path = path or self.path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.export(), f, indent=2)
+        logger.debug(f"Saved latency profile to {path}")
+
+    def _load_overrides(self):
+        try:
+            with open(self.path) as f:
+                self.overrides = {device_id: float(lead) for device_id, lead in json.load(f).get("overrides", {}).items()}
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"Ignoring unreadable latency profile {self.path}: {e}")
@@ -1,161 +1,204 @@
 import asyncio
 import time
-from typing import List
-from dotenv import load_dotenv
+from typing import List, Optional
 from loguru import logger
-from models import EventSongChanged, EventAdjustProgressTime, EventStop
+from models import DeviceGroup, EventSongChanged, EventAdjustProgressTime, EventStop
 from utils import (
-    get_current_item,
-    get_new_color,
-    COLORS,
-    get_next_item,
-    CONTROLLER_TICK,
-    get_vibrant_color,
-    merge_short_segments,
-    visualize_segments
+    DEFAULT_GROUP_NAME,
+    COMPILED_SHOW_CACHE_SIZE,
+    LATENCY_WINDOW,
 )
-import random
+from collections import OrderedDict, deque
+
 import numpy as np
 
+from scheduler import DeadlineScheduler, TimerHandle
+from song_compiler import CompiledShow, PreparedSong
+from frame_renderer import Frame, FrameRenderer
+from song_preparer import SongPreparer
+from playback_clock import PlaybackClock
+from latency import LatencyModel
+from tracing import tracer
 from light_device import LightDevice  # Import the LightDevice class
 
 class LightsController:
-    def __init__(self, devices: List[LightDevice], events_queue: asyncio.Queue):
+    def __init__(self, devices: List[LightDevice], events_queue: asyncio.Queue, clock: PlaybackClock,
+                 latency_model: Optional[LatencyModel] = None, preparer: Optional[SongPreparer] = None,
+                 group: Optional[DeviceGroup] = None):
         self.devices = devices
+        # The group of devices this controller drives, with its effect settings
+        self.group = group or DeviceGroup(DEFAULT_GROUP_NAME)
         self.events_queue = events_queue
-        self.last_section_num_next = 0
-        self.last_index = -1  # Initialize to -1 to ensure the first index is processed
-        self.current_hue = random.randint(0, 359)
-        self.current_saturation = random.randint(50, 80)
-        self.current_brightness = 0
-        self.sections = []   # List of song sections
-        self.last_bar = {}
-        self.last_next_segment = None
-        self.current_section = None
-        self.analysis = None
-        self.current_progress = 0
-
-        # Initialize current parameters for comparison
-        self._current_params = {
-            'hue': self.current_hue,
-            'saturation': self.current_saturation,
-            'brightness': self.current_brightness
-        }
+        self.clock = clock
+        self.show: CompiledShow | None = None
+        self._compiled_shows: OrderedDict[str, PreparedSong] = OrderedDict()
+        self.preparer = preparer or SongPreparer(workers=0)
+        # Preparation of the latest song that was not prepared ahead of time, if still running
+        self._preparing: asyncio.Task | None = None
+        # Renders the state of all devices at once; each has its own cursor into the show, as lead times differ per bulb
+        self.renderer = FrameRenderer(devices, self.group.hue_spread, self.group.wave_delay, self.group.positions)
+        self._next_timer: TimerHandle | None = None
+        # Song-change-to-first-effect latencies in seconds
+        self.song_change_latencies = deque(maxlen=LATENCY_WINDOW)
+        self._song_detected_at: float | None = None
+        self.latency_model = latency_model or LatencyModel(path=None)
+        self.scheduler = DeadlineScheduler()
+        # Corrections of the position estimate reschedule the next wake-up
+        self.clock.add_listener(self._schedule_next_entry)
 
     async def control_lights(self):
-        event = EventStop()
-        while True:
-            event = await self.events_queue.get()
-            if isinstance(event, EventSongChanged):
-                logger.debug("Song changed!")
-                self.handle_song_changed(event)
-            elif isinstance(event, EventAdjustProgressTime):
-                if self.analysis is not None:
-                    # logger.debug(f"Received event: {event}")
-                    self.current_progress = event.progress_time_ms
-                    await self.handle_adjust_progress(self.current_progress)
-            elif isinstance(event, EventStop):
-                logger.warning("Song stopped!")
-            self.events_queue.task_done()
-            await asyncio.sleep(CONTROLLER_TICK)
+        scheduler_task = asyncio.create_task(self.scheduler.run(), name=f"scheduler {self.group.name}")
+        try:
+            while True:
+                event = await self.events_queue.get()
+                if isinstance(event, EventSongChanged):
+                    logger.debug("Song changed!")
+                    self.handle_song_changed(event)
+                elif isinstance(event, EventAdjustProgressTime):
+                    if self.show is not None:
+                        logger.debug(f"Seeked to {event.progress_time_ms:.2f}s")
+                        self._schedule_next_entry(resync=True)
+                elif isinstance(event, EventStop):
+                    logger.warning("Song stopped!")
+                    self._cancel_preparation()
+                    self._cancel_next_entries()
+                self.events_queue.task_done()
+        finally:
+            self._cancel_preparation()
+            scheduler_task.cancel()
 
     def handle_song_changed(self, event: EventSongChanged):
-        self.analysis = event.analysis
-        self.sections = self.analysis['sections']
-        # visualize_segments(self.analysis['segments'])
-        self.segments = merge_short_segments(self.analysis['segments'])
-        self.bars = self.analysis['bars']
-        self.last_bar = self.bars[0]
-        self.current_section = self.sections[0]
-        self.beats = self.analysis['beats']
-
-    def map_brightness(self, segment):
-        decibel_to_linear = lambda x: 10**(x / 20)
-        next_loudness = decibel_to_linear(segment["loudness_start"])
-
-        # Calculate mean and standard deviation of loudness values
-        loudness_values = [decibel_to_linear(seg['loudness_start']) for seg in self.segments]
-        mean_loudness = np.mean(loudness_values)
-        std_dev_loudness = np.std(loudness_values)
-
-        # Define the range within which to consider values
-        lower_bound = mean_loudness - 2 * std_dev_loudness
-        upper_bound = mean_loudness + 2 * std_dev_loudness
-        filtered_loudness_values = [loudness for loudness in loudness_values if lower_bound <= loudness <= upper_bound]
-
-        min_loudness = min(filtered_loudness_values)
-        max_loudness = max(filtered_loudness_values)
-        brightness = int((next_loudness - min_loudness) / (max_loudness - min_loudness) * 50)
-
-        # logger.trace(f"Segment loudness: {next_loudness:.5f} (min: {min_loudness:.2f}, max: {max_loudness:.2f})")
-        return brightness
-
-    async def handle_adjust_progress(self, current_time: float):
-        next_segment = get_next_item(self.segments, current_time)
-        current_bar = get_current_item(self.bars, current_time)
-        if not next_segment or not current_bar:
-            logger.debug("skipping adjust progress")
+        """
+        Switches to the new song, right away if it was prepared ahead of time, otherwise once the
+        preparer has prepared it. A newer song change cancels a preparation still running.
+        """
+        self._cancel_preparation()
+        song: PreparedSong | None = event.song
+        if song is None and event.track_id is not None and event.track_id in self._compiled_shows:
+            self._compiled_shows.move_to_end(event.track_id)
+            song = self._compiled_shows[event.track_id]
+            logger.debug(f"Reusing prepared song {event.track_id}")
+        if song is not None:
+            with tracer.span("song changed", track_id=event.track_id):
+                self._load_song(song, event.detected_at)
+            self._schedule_next_entry(resync=True)
+            return
+
+        # Keep the bulbs from playing the previous song's show over the new one meanwhile
+        self.show = None
+        self._cancel_next_entries()
+        self._preparing = asyncio.create_task(self._prepare_song(event), name=f"prepare {event.track_id}")
+
+    async def _prepare_song(self, event: EventSongChanged):
+        try:
+            song = await self.preparer.prepare(event.analysis, event.track_id)
+        except asyncio.CancelledError:
+            logger.debug(f"Cancelled preparation of {event.track_id}")
+            raise
+        except Exception as e:
+            logger.exception(f"Failed to prepare song {event.track_id}: {e!r}")
             return
-        self.last_next_segment = next_segment
-        current_bar_duration = current_bar["duration"] - (current_time - current_bar['start'])
-        brightness = self.map_brightness(next_segment)
-
-        # Check if we need to move to the next bar
-        if self.last_bar != current_bar and current_bar['confidence'] > 0.5:
-            logger.warning(f"Transitioning from bar {self.bars.index(self.last_bar)} to bar {self.bars.index(current_bar)} in {current_bar_duration:.2f}s")
-            asyncio.create_task(self.set_parameters(current_bar_duration, change_color=True))
-            self.last_bar = current_bar
-        # Check if we need to move to the next segment
-        elif next_segment['start']:
-            asyncio.create_task(self.set_parameters(next_segment['duration'], brightness=brightness))
-
-    async def set_parameters(self, duration: float = 0.05, brightness: int | None = None, change_color: bool = False):
-        # Determine new parameters
-        if change_color:
-            new_hue, new_saturation = get_vibrant_color(self._current_params['hue'])
-        else:
-            new_hue = self._current_params['hue']
-            new_saturation = self._current_params['saturation']
-
-        new_brightness = brightness if brightness is not None else self._current_params['brightness']
-
-        # Check if any parameter has changed
-        params_changed = (
-            new_hue != self._current_params['hue'] or
-            new_saturation != self._current_params['saturation'] or
-            new_brightness != self._current_params['brightness']
-        )
-
-        if not params_changed or (not change_color and brightness is None):
-            # logger.trace("No parameter changes detected. Skipping set_parameters to prevent blinking.")
+        logger.debug(f"Compiled show with {len(song.show)} entries")
+        with tracer.span("song changed", track_id=event.track_id):
+            self._load_song(song, event.detected_at)
+        # The song played on while it was being prepared
+        self._schedule_next_entry(resync=True)
+
+    def _cancel_preparation(self):
+        if self._preparing is not None and not self._preparing.done():
+            self._preparing.cancel()
+        self._preparing = None
+
+    def _load_song(self, song: PreparedSong, detected_at: Optional[float] = None):
+        if song.track_id is not None:
+            self._compiled_shows[song.track_id] = song
+            self._compiled_shows.move_to_end(song.track_id)
+            while len(self._compiled_shows) > COMPILED_SHOW_CACHE_SIZE:
+                self._compiled_shows.popitem(last=False)
+
+        self.show = song.show
+        self.renderer.load(song.show)
+        self._song_detected_at = detected_at
+
+    def _cancel_next_entries(self):
+        if self._next_timer is not None:
+            self._next_timer.cancel()
+            self._next_timer = None
+
+    def _positions(self, progress: float) -> np.ndarray:
+        """
+        Returns the show position of every device, ahead of the playback position by its lead time.
+        """
+        lead_times = np.fromiter((self.latency_model.lead_time(device.name) for device in self.devices),
+                                 dtype=float, count=len(self.devices))
+        # Lead times are in real seconds, the show in playback seconds
+        return self.renderer.positions(progress, lead_times, self.clock.rate)
+
+    def _schedule_next_entry(self, resync: bool = False):
+        """
+        Schedules a wake-up for when the next show entry is due for any device, minus the
+        lead time measured for that device.
+
+        :param resync: Whether the playback position jumped (song change or seek), in which
+            case the light state at the new position is applied right away.
+        """
+        self._cancel_next_entries()
+        progress = self.clock.position()
+        if progress is None or self.show is None or not self.devices:
             return
 
-        # Update current parameters
-        if change_color:
-            self._current_params['hue'] = new_hue
-            self._current_params['saturation'] = new_saturation
-        elif brightness is not None:
-            self._current_params['brightness'] = new_brightness
-        else:
-            logger.debug("No parameter changes detected. Skipping set_parameters to prevent blinking.")
+        positions = self._positions(progress)
+        if resync:
+            self.apply_frame(self.renderer.render(positions, resync=True))
+        self._schedule_after(positions)
+
+    def _schedule_after(self, positions: np.ndarray):
+        remaining = self.renderer.time_to_next(positions)
+        if remaining is None:
+            logger.debug("No entries left in the current song")
             return
+        self._next_timer = self.scheduler.call_later(remaining / self.clock.rate, self._on_entry_due)
 
-        logger.info(f"Setting parameters: duration={duration:.2f}s, brightness={new_brightness}%, hue={new_hue}, saturation={new_saturation}")
+    def _on_entry_due(self):
+        with tracer.span("tick"):
+            self._advance()
 
-        # Apply settings to devices using LightDevice's asynchronous methods
-        set_tasks = []
-        for device in self.devices:
-            if device.bulb.model == "ct_bulb":
-                logger.info(f"Setting parameters: duration={duration:.2f}s, brightness={new_brightness}%")
-                set_tasks.append(device.set_brightness(new_brightness, duration=duration))
-            else:
-                if change_color:
-                    set_tasks.append(device.set_hsv(new_hue, new_saturation, new_brightness, duration=duration))
-                elif brightness is not None:
-                    set_tasks.append(device.set_brightness(new_brightness, duration=duration))
+    def _advance(self):
+        self._next_timer = None
+        progress = self.clock.position()
+        if progress is None or self.show is None or not self.devices:
+            return
 
-        # Execute all state changes concurrently
-        await asyncio.gather(*set_tasks)
+        positions = self._positions(progress)
+        self.apply_frame(self.renderer.render(positions))
+        self._schedule_after(positions)
 
-        # Optionally, wait for the duration minus the controller tick
-        await asyncio.sleep(0)
+    def apply_frame(self, frame: Frame):
+        """
+        Sends the light state of a rendered frame to the devices it changed.
+        """
+        if not len(frame):
+            return
+        last = len(frame) - 1
+        logger.info(f"Setting parameters on {len(frame)} device(s) in {self.group.name}: duration={float(frame.duration[last]):.2f}s, "
+                    f"brightness={frame.brightness[last]}%, hue={frame.hue[last]}, saturation={frame.saturation[last]}")
+
+        if self._song_detected_at is not None:
+            self._report_song_change_latency(time.monotonic() - self._song_detected_at)
+            self._song_detected_at = None
+
+        for row, full_state, hue, saturation, brightness, duration in zip(
+                frame.devices.tolist(), frame.full_state.tolist(), frame.hue.tolist(), frame.saturation.tolist(),
+                frame.brightness.tolist(), frame.duration.tolist()):
+            # Only queues the command; each device's command queue sends it
+            if full_state:
+                self.devices[row].set_hsv(hue, saturation, brightness, duration=duration)
+            else:
+                self.devices[row].set_brightness(brightness, duration=duration)
+
+    def _report_song_change_latency(self, latency: float):
+        self.song_change_latencies.append(latency)
+        latencies = sorted(self.song_change_latencies)
+        logger.info(f"Song change to first effect: {latency * 1000:.1f}ms "
+                    f"(median {latencies[len(latencies) // 2] * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms "
+                    f"over {len(latencies)} song(s))")
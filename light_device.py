@@ -1,137 +1,110 @@
 import asyncio
-from yeelight import Bulb
+from typing import Dict, Optional
+
 from loguru import logger
 
-from custom_lock import CustomLock  # Import the CustomLock class
-from utils import CONTROLLER_TICK
+from bulb_state import BulbState
+from command_queue import CommandQueue, DeviceCommand
+from latency import LatencyModel
+from utils import DEVICE_COMMAND_RATE, LATENCY_PROBE_INTERVAL
+from yeelight_transport import YeelightTransport
 
 class LightDevice:
-    def __init__(self, bulb: Bulb):
+    def __init__(self, transport: YeelightTransport, model: str, command_rate: float = DEVICE_COMMAND_RATE,
+                 latency_model: Optional[LatencyModel] = None, recorder=None):
         """
-        Initializes the LightDevice with a Yeelight Bulb instance.
+        Initializes the LightDevice with an asyncio Yeelight transport.
 
-        :param bulb: An instance of yeelight.Bulb.
+        :param transport: The YeelightTransport connected (or connecting lazily) to the bulb.
+        :param model: The model identifier of the bulb, as reported by discovery.
+        :param command_rate: Maximum number of commands per second sent to the bulb.
+        :param latency_model: Where to record the measured command-to-ack latency of the bulb.
+            When given, the bulb is probed every LATENCY_PROBE_INTERVAL seconds once it is in use.
+        :param recorder: A session_recording.SessionRecorder capturing the commands sent, if any.
         """
-        self.bulb = bulb
-        self.ip = bulb._ip
-        self.model = bulb.get_capabilities()["model"]  # type: ignore
-        self.lock = CustomLock()
+        self.transport = transport
+        self.ip = transport.ip
+        self.name = transport.name
+        self.model = model
+        self.supports_color = model != "ct_bulb"
+        # What the bulb currently shows, as far as we know, to skip commands that would not change it
+        self.state = BulbState(supports_color=self.supports_color)
+        transport.on_props = self.state.update_from_props
+        self.commands = CommandQueue(transport, rate=command_rate,
+                                     on_sent=recorder.record_command if recorder is not None else None,
+                                     state=self.state)
+        self.latency_model = latency_model
+        self._probe: Optional[asyncio.Task] = None
+
+    def _ensure_probe(self):
+        if self.latency_model is not None and (self._probe is None or self._probe.done()):
+            self._probe = asyncio.create_task(self._probe_latency(), name=f"latency probe {self.name}")
+
+    async def _probe_latency(self):
+        while True:
+            try:
+                latency = await self.transport.measure_latency()
+                self.latency_model.record_device_latency(self.name, latency)
+                logger.trace(f"Latency of {self.name}: {latency * 1000:.1f}ms")
+            except Exception as e:
+                logger.debug(f"Latency probe of {self.name} failed: {e!r}")
+            await asyncio.sleep(LATENCY_PROBE_INTERVAL)
 
-    async def set_brightness(self, brightness: int, duration: float = 0.05):
+    def set_brightness(self, brightness: int, duration: float = 0.05):
         """
-        Asynchronously sets the brightness of the bulb.
-        Ignores the request if the device is currently handling another state change.
+        Queues a brightness change for the bulb.
+        Replaces any pending brightness change and is merged into a pending color change.
 
         :param brightness: Brightness level (0-100).
         :param duration: Duration of the transition in seconds.
         """
-        if self.lock.locked():
-            logger.trace(f"Brightness change ignored for {self.ip} because it's currently locked.")
-            return
-
-        await self.lock.acquire()
-        try:
-            logger.trace(f"Setting brightness to {brightness}% over {duration}s for {self.ip}")
-            await asyncio.to_thread(
-                self.bulb.set_brightness, brightness, duration=int(duration * 1000)
-            )
-            logger.trace(f"Brightness set to {brightness}% for {self.ip}")
-        except asyncio.CancelledError:
-            logger.trace(f"Brightness change task was cancelled for {self.ip}.")
-            raise
-        except Exception as e:
-            logger.error(f"Failed to set brightness for {self.ip}: {e}")
-        finally:
-            await asyncio.sleep(CONTROLLER_TICK)  # Adjust sleep as needed
-            self.lock.release()
-
-    async def set_hsv(self, hue: int, saturation: int, brightness: int, duration: float = 0.05):
+        logger.trace(f"Queueing brightness {brightness}% over {duration}s for {self.name}")
+        self._ensure_probe()
+        self.commands.submit(DeviceCommand("brightness", duration=duration, brightness=brightness))
+
+    def set_hsv(self, hue: int, saturation: int, brightness: int, duration: float = 0.05):
         """
-        Asynchronously sets the HSV color of the bulb.
-        Overrides any ongoing state change by cancelling it and forcing the new state.
+        Queues an HSV color change for the bulb.
+        Replaces any pending color change and absorbs a pending brightness change.
 
         :param hue: Hue value (0-359).
         :param saturation: Saturation level (0-100).
         :param brightness: Brightness level (0-100).
         :param duration: Duration of the transition in seconds.
         """
-        if self.lock.locked():
-            logger.trace(f"HSV change attempting to override current state change for {self.ip}.")
-            holder_task = self.lock.holder
-            if holder_task and not holder_task.done():
-                logger.trace(f"Cancelling current state change task for {self.ip}.")
-                holder_task.cancel()
-                try:
-                    await holder_task
-                except asyncio.CancelledError:
-                    logger.trace(f"Cancelled task holding the lock for {self.ip}.")
-                except Exception as e:
-                    logger.error(f"Error while cancelling task for {self.ip}: {e}")
-
-        await self.lock.acquire()
-        try:
-            logger.trace(f"Setting HSV to ({hue}, {saturation}, {brightness}) over {duration}s for {self.ip}")
-            await asyncio.to_thread(
-                self.bulb.set_hsv, hue, saturation, brightness, duration=int(duration * 1000)
-            )
-            logger.trace(f"HSV set to ({hue}, {saturation}, {brightness}) for {self.ip}")
-        except asyncio.CancelledError:
-            logger.trace(f"HSV change task was cancelled for {self.ip}.")
-            raise
-        except Exception as e:
-            logger.error(f"Failed to set HSV for {self.ip}: {e}")
-        finally:
-            await asyncio.sleep(CONTROLLER_TICK)  # Adjust sleep as needed
-            self.lock.release()
-
-    async def turn_on(self, duration: float = 0.05):
+        logger.trace(f"Queueing HSV ({hue}, {saturation}, {brightness}) over {duration}s for {self.name}")
+        self._ensure_probe()
+        self.commands.submit(DeviceCommand("color", duration=duration, brightness=brightness, hue=hue, saturation=saturation))
+
+    def turn_on(self, duration: float = 0.05):
         """
-        Asynchronously turns on the bulb.
-        Ignores the request if the device is currently handling another state change.
+        Queues turning on the bulb.
 
         :param duration: Duration of the transition in seconds.
         """
-        if self.lock.locked():
-            logger.trace(f"Turn on ignored for {self.ip} because it's currently locked.")
-            return
-
-        await self.lock.acquire()
-        try:
-            logger.trace(f"Turning on bulb {self.ip} over {duration}s")
-            await asyncio.to_thread(
-                self.bulb.turn_on, duration=int(duration * 1000)
-            )
-            logger.trace(f"Bulb {self.ip} turned on")
-        except asyncio.CancelledError:
-            logger.trace(f"Turn on task was cancelled for {self.ip}.")
-            raise
-        except Exception as e:
-            logger.error(f"Failed to turn on bulb {self.ip}: {e}")
-        finally:
-            self.lock.release()
-
-    async def turn_off(self, duration: float = 0.05):
+        logger.trace(f"Queueing turn on for {self.name} over {duration}s")
+        self._ensure_probe()
+        self.commands.submit(DeviceCommand("power", duration=duration, power=True))
+
+    def turn_off(self, duration: float = 0.05):
         """
-        Asynchronously turns off the bulb.
-        Ignores the request if the device is currently handling another state change.
+        Queues turning off the bulb.
 
         :param duration: Duration of the transition in seconds.
         """
-        if self.lock.locked():
-            logger.trace(f"Turn off ignored for {self.ip} because it's currently locked.")
-            return
-
-        await self.lock.acquire()
-        try:
-            logger.trace(f"Turning off bulb {self.ip} over {duration}s")
-            await asyncio.to_thread(
-                self.bulb.turn_off, duration=int(duration * 1000)
-            )
-            logger.trace(f"Bulb {self.ip} turned off")
-        except asyncio.CancelledError:
-            logger.trace(f"Turn off task was cancelled for {self.ip}.")
-            raise
-        except Exception as e:
-            logger.error(f"Failed to turn off bulb {self.ip}: {e}")
-        finally:
-            self.lock.release()
+        logger.trace(f"Queueing turn off for {self.name} over {duration}s")
+        self._ensure_probe()
+        self.commands.submit(DeviceCommand("power", duration=duration, power=False))
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the command counters of the bulb.
+        """
+        return self.commands.stats()
+
+    async def close(self):
+        if self._probe is not None:
+            self._probe.cancel()
+            self._probe = None
+        await self.commands.close()
+        await self.transport.close()
@@ -1,35 +1,181 @@
 #!/usr/bin/env python3
+import argparse
 import asyncio
 import os
+import signal
 from dotenv import load_dotenv
 from loguru import logger
 from spotify_listener import SpotifyChangesListener
+from analysis_cache import AnalysisCache
 from light_controller import LightsController
 from device_manager import DeviceManager
-from utils import setup_logging
+from playback_clock import PlaybackClock
+from latency import LatencyModel
+from models import Device, DeviceGroup
+from device_groups import GroupBroadcaster, GroupWorker, assign_devices, find_group, load_groups, shard_groups
+from fake_bulb import FakeBulb
+from fake_spotify import FakeSpotifyServer
+from session_recording import Session, SessionRecorder, SessionReplayer
+from metrics import MetricsServer, registry, register_pipeline_gauges
+from song_preparer import SongPreparer
+from tracing import tracer
+from utils import setup_logging, METRICS_PORT, DEFAULT_GROUP_NAME
+
+async def run(user_id, client_id, client_secret, record=None, replay=None, replay_mode="http", speed=1.0, fake_bulbs=0,
+              metrics_port=None, trace=None, groups=None, workers=0):
+    """
+    Runs the listener and the lights controller until interrupted, or until a replayed session ends.
+
+    :param record: Path of a session file to record the run into, if any.
+    :param replay: Path of a recorded session to replay instead of polling Spotify, if any.
+    :param replay_mode: "http" to serve the session through a local fake Spotify API, or
+        "direct" to feed it straight into the events queue.
+    :param speed: How many times faster than real time to replay the session.
+    :param fake_bulbs: Number of local fake bulbs to use instead of discovering real ones.
+    :param metrics_port: Port to serve Prometheus metrics on, if any.
+    :param trace: Path to write a Chrome trace of the pipeline to on exit and on SIGUSR1, if any.
+    :param groups: Path of a JSON file defining device groups, if any. Each group gets its own controller.
+    :param workers: Number of worker processes to shard the device groups across, or 0 to drive
+        all bulbs from this process.
+    """
+    if trace:
+        tracer.enable()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, tracer.dump, trace)
+    # Songs are prepared in worker processes, away from the loop driving the bulbs
+    preparer = SongPreparer()
+    await preparer.start()
+    latency_model = LatencyModel()
+    recorder = SessionRecorder(record) if record else None
+    device_groups = load_groups(groups) if groups else []
+    device_manager = DeviceManager(latency_model=latency_model, recorder=recorder, groups=device_groups)
+
+    bulbs = [FakeBulb() for _ in range(fake_bulbs)]
+    for bulb in bulbs:
+        await bulb.start()
+    fake_devices = [Device(bulb.host, bulb.port, bulb.model) for bulb in bulbs]
+
+    events_queue = asyncio.Queue()
+    clock = PlaybackClock(speed=speed if replay else 1.0)
+
+    group_workers = []
+    if workers:
+        # The workers connect to the bulbs, this process only polls Spotify and broadcasts
+        devices = []
+        records = fake_devices or await device_manager.find_devices()
+        shards = shard_groups(assign_devices(device_groups, records), workers)
+        if len(shards) < workers:
+            logger.warning(f"Only {len(shards)} of {workers} worker(s) have bulbs to drive")
+        for index, shard in enumerate(shards):
+            group_worker = GroupWorker(index, shard, speed=clock.speed, latency_model=latency_model)
+            group_worker.start()
+            group_workers.append(group_worker)
+        await asyncio.gather(*(group_worker.wait_ready() for group_worker in group_workers))
+        if recorder is not None:
+            logger.warning("Commands sent by group workers are not recorded")
+    elif fake_devices:
+        devices = await device_manager.initialize_devices(fake_devices)
+    else:
+        devices = await device_manager.discover_devices()
+
+    fake_spotify = None
+    if replay and replay_mode == "direct":
+        spotify_listener = SessionReplayer(Session.load(replay), events_queue, clock, speed, latency_model, recorder, preparer)
+    elif replay:
+        fake_spotify = FakeSpotifyServer(Session.load(replay), speed=speed)
+        await fake_spotify.start()
+        spotify_listener = SpotifyChangesListener(user_id, client_id, client_secret, events_queue, clock, latency_model,
+                                                  api_base=fake_spotify.api_base, access_token="replay", recorder=recorder,
+                                                  preparer=preparer, analysis_cache=AnalysisCache(cache_dir=None))
+    else:
+        spotify_listener = SpotifyChangesListener(user_id, client_id, client_secret, events_queue, clock, latency_model,
+                                                  recorder=recorder, preparer=preparer)
+
+    if workers:
+        assignments = []
+    elif device_groups:
+        # Every group gets a controller, which bulbs found by the background rediscovery join
+        assignments = assign_devices(device_groups, devices, keep_empty=True)
+    else:
+        assignments = [(DeviceGroup(DEFAULT_GROUP_NAME), devices)]
+    broadcast = len(assignments) > 1 or bool(group_workers)
+    light_controllers = []
+    for group, group_devices in assignments:
+        light_controllers.append(LightsController(group_devices, asyncio.Queue() if broadcast else events_queue, clock,
+                                                  latency_model, preparer, group))
+    if device_groups and not workers:
+        controllers = {light_controller.group.name: light_controller for light_controller in light_controllers}
+
+        def add_devices(new_devices):
+            for device in new_devices:
+                controllers[find_group(device_groups, device.name).name].devices.append(device)
+
+        device_manager.on_added = add_devices
+    if metrics_port is not None:
+        register_pipeline_gauges(events_queue, clock, spotify_listener, devices)
+        MetricsServer(registry, port=metrics_port).start()
+
+    tasks = [asyncio.create_task(spotify_listener.listen(), name="listener")]
+    tasks += [asyncio.create_task(light_controller.control_lights(), name=f"controller {light_controller.group.name}")
+              for light_controller in light_controllers]
+    tasks += [asyncio.create_task(group_worker.watch(), name=f"group worker {group_worker.index}")
+              for group_worker in group_workers]
+    if broadcast:
+        broadcaster = GroupBroadcaster(events_queue, clock, [light_controller.events_queue for light_controller in light_controllers],
+                                       group_workers, preparer=preparer)
+        tasks.append(asyncio.create_task(broadcaster.run(), name="broadcaster"))
+    if fake_spotify is not None:
+        tasks.append(asyncio.create_task(fake_spotify.wait_finished(), name="replay"))
+    try:
+        # Only a replay ever finishes on its own
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for device in devices:
+            await device.close()
+        for group_worker in group_workers:
+            await group_worker.close()
+        preparer.close()
+        if fake_spotify is not None:
+            await fake_spotify.stop()
+        for bulb in bulbs:
+            await bulb.stop()
+        # Keep the measured latencies for inspection and hand-tuning of lead times
+        latency_model.save()
+        if recorder is not None:
+            recorder.save()
+        if trace:
+            tracer.dump(trace)
 
 def main():
+    parser = argparse.ArgumentParser(description="Synchronize Yeelight bulbs with the music playing on Spotify.")
+    parser.add_argument("--record", metavar="SESSION", help="record the Spotify responses, analyses and bulb commands to a session file")
+    parser.add_argument("--replay", metavar="SESSION", help="replay a recorded session instead of polling Spotify")
+    parser.add_argument("--replay-mode", choices=("http", "direct"), default="http",
+                        help="serve the session through a local fake Spotify API, or feed it straight into the controller")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed relative to real time")
+    parser.add_argument("--metrics", action="store_true", help="serve Prometheus metrics at /metrics")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="port of the metrics endpoint")
+    parser.add_argument("--trace", metavar="PATH", help="record a Chrome trace of the pipeline, written on exit and on SIGUSR1")
+    parser.add_argument("--groups", metavar="JSON", help="drive the bulbs in named groups with their own effect settings")
+    parser.add_argument("--workers", type=int, default=0, metavar="N",
+                        help="shard the device groups across N worker processes that each own their bulbs")
+    parser.add_argument("--fake-bulbs", type=int, default=0, metavar="N", help="use N local fake bulbs instead of discovering real ones")
+    args = parser.parse_args()
+
     load_dotenv(".env")
     user_id = os.getenv('USER_ID')
     client_id = os.getenv('CLIENT_ID')
     client_secret = os.getenv('CLIENT_SECRET')
     setup_logging("DEBUG")
 
-    device_manager = DeviceManager()
-    devices = device_manager.discover_devices()
-
-    events_queue = asyncio.Queue()
-
-    spotify_listener = SpotifyChangesListener(user_id, client_id, client_secret, events_queue)
-    light_controller = LightsController(devices, events_queue)
-
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(
-        asyncio.gather(
-            spotify_listener.listen(),
-            light_controller.control_lights()
-        )
-    )
+    asyncio.run(run(user_id, client_id, client_secret, record=args.record, replay=args.replay,
+                    replay_mode=args.replay_mode, speed=args.speed, fake_bulbs=args.fake_bulbs,
+                    metrics_port=args.metrics_port if args.metrics else None, trace=args.trace,
+                    groups=args.groups, workers=args.workers))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,224 @@
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import bottle
+from loguru import logger
+
+from utils import METRICS_HOST, METRICS_PORT
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+GaugeValue = Union[float, Dict[Tuple[str, ...], float], None]
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # One slot per bucket plus the +Inf bucket, allocated once
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricFamily:
+    def __init__(self, name: str, help_text: str, kind: str, label_names: Tuple[str, ...] = (),
+                 factory: Optional[Callable[[], object]] = None, function: Optional[Callable[[], GaugeValue]] = None):
+        """
+        A named metric with one child per combination of label values.
+
+        :param kind: The Prometheus type: "counter", "gauge" or "histogram".
+        :param factory: Creates the child metric for new label values.
+        :param function: For gauges read at scrape time, returns the value, or a dictionary of
+            values keyed by label values.
+        """
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.label_names = label_names
+        self.factory = factory
+        self.function = function
+        self.children: Dict[Tuple[str, ...], object] = {}
+        if factory is not None and not label_names:
+            self.children[()] = factory()
+
+    def labels(self, *values: str):
+        """
+        Returns the child metric for the given label values, creating it on first use.
+        Callers should keep the child instead of looking it up on every observation.
+        """
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+    def inc(self, amount: float = 1.0):
+        self.children[()].inc(amount)
+
+    def observe(self, value: float):
+        self.children[()].observe(value)
+
+    def _label_string(self, values: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help_text}"
+        yield f"# TYPE {self.name} {self.kind}"
+        if self.function is not None:
+            value = self.function()
+            values = value if isinstance(value, dict) else {(): value}
+            for labels, sample in values.items():
+                if sample is not None:
+                    yield f"{self.name}{self._label_string(labels)} {float(sample)}"
+            return
+
+        for labels, child in list(self.children.items()):
+            if isinstance(child, Histogram):
+                cumulative = 0
+                for bound, count in zip(child.buckets + (float("inf"),), child.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    bucket_label = f'le="{le}"'
+                    yield f"{self.name}_bucket{self._label_string(labels, bucket_label)} {cumulative}"
+                yield f"{self.name}_sum{self._label_string(labels)} {child.sum}"
+                yield f"{self.name}_count{self._label_string(labels)} {child.count}"
+            else:
+                yield f"{self.name}{self._label_string(labels)} {child.value}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """
+        The metrics of the pipeline, rendered in the Prometheus text exposition format.
+
+        Counters and histograms are plain attributes updated in place on the hot path; values
+        that already exist elsewhere (queue depths, device counters, the playback clock) are
+        read by gauge functions only when the metrics are scraped.
+        """
+        self.families: List[MetricFamily] = []
+
+    def _add(self, family: MetricFamily) -> MetricFamily:
+        self.families.append(family)
+        return family
+
+    def counter(self, name: str, help_text: str, label_names: Tuple[str, ...] = ()) -> MetricFamily:
+        return self._add(MetricFamily(name, help_text, "counter", label_names, factory=Counter))
+
+    def histogram(self, name: str, help_text: str, label_names: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> MetricFamily:
+        return self._add(MetricFamily(name, help_text, "histogram", label_names, factory=lambda: Histogram(buckets)))
+
+    def gauge(self, name: str, help_text: str, function: Callable[[], GaugeValue],
+              label_names: Tuple[str, ...] = (), kind: str = "gauge") -> MetricFamily:
+        """
+        Registers a metric read by calling function at scrape time, replacing one of the same name.
+        """
+        self.families = [family for family in self.families if family.name != name]
+        return self._add(MetricFamily(name, help_text, kind, label_names, function=function))
+
+    def render(self) -> str:
+        lines = []
+        for family in self.families:
+            try:
+                lines.extend(family.render())
+            except Exception as e:
+                logger.warning(f"Failed to collect metric {family.name}: {e!r}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsServer:
+    def __init__(self, registry: MetricsRegistry, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        """
+        Serves the metrics at /metrics from a background thread, off the event loop.
+
+        :param registry: The metrics to serve.
+        :param host: The address to listen on.
+        :param port: The port to listen on.
+        """
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.app = bottle.Bottle()
+        self.app.route("/metrics", callback=self._metrics)
+        self._thread: Optional[threading.Thread] = None
+
+    def _metrics(self):
+        bottle.response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+        return self.registry.render()
+
+    def start(self):
+        self._thread = threading.Thread(target=bottle.run, name="metrics", daemon=True,
+                                        kwargs={"app": self.app, "host": self.host, "port": self.port, "quiet": True})
+        self._thread.start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+
+registry = MetricsRegistry()
+
+SCHEDULER_LAG = registry.histogram(
+    "emyee_scheduler_lag_seconds", "How late timers of the lights controller fire after their deadline.")
+SPOTIFY_REQUEST_SECONDS = registry.histogram(
+    "emyee_spotify_request_seconds", "Duration of Spotify Web API requests.", ("endpoint",))
+SPOTIFY_ERRORS = registry.counter(
+    "emyee_spotify_errors_total", "Failed Spotify Web API polls.", ("kind",))
+DEVICE_COMMAND_SECONDS = registry.histogram(
+    "emyee_device_command_seconds", "Time from queueing a command for a bulb to writing it.", ("device",))
+
+
+def register_pipeline_gauges(events_queue, clock, listener, devices):
+    """
+    Registers the metrics read from the running pipeline at scrape time.
+
+    :param events_queue: The queue between the listener and the lights controller.
+    :param clock: The shared PlaybackClock.
+    :param listener: The SpotifyChangesListener.
+    :param devices: The list of LightDevices, which may grow while running.
+    """
+    registry.gauge("emyee_events_queue_depth", "Events waiting for the lights controller.", events_queue.qsize)
+    registry.gauge("emyee_track_info", "The track currently playing.",
+                   lambda: {(listener.current_track_id,): 1} if listener.current_track_id else {}, ("track_id",))
+    registry.gauge("emyee_playback_position_seconds", "Estimated playback position.", clock.position)
+    registry.gauge("emyee_playback_clock_confidence", "Confidence of the playback position estimate.",
+                   lambda: clock.confidence)
+    registry.gauge("emyee_playback_clock_drift", "Estimated relative drift of the playback rate.", lambda: clock.drift)
+    for name, help_text in (("sent", "Commands written to the bulb."),
+                            ("coalesced", "Commands merged into a pending command."),
+                            ("dropped", "Pending commands replaced by a newer one."),
+                            ("suppressed", "Commands not sent as the bulb already had the state."),
+                            ("failed", "Commands that failed to send.")):
+        registry.gauge(f"emyee_device_commands_{name}_total", help_text,
+                       lambda name=name: {(device.name,): device.stats()[name] for device in list(devices)},
+                       ("device",), kind="counter")
+    registry.gauge("emyee_device_commands_pending", "Commands waiting to be sent to the bulb.",
+                   lambda: {(device.name,): device.stats()["pending"] for device in list(devices)}, ("device",))
+    cache = listener.analysis_cache
+    registry.gauge("emyee_analysis_cache_hits_total", "Audio analyses found in the cache.",
+                   lambda: {("memory",): cache.memory_hits, ("disk",): cache.disk_hits}, ("tier",), kind="counter")
+    registry.gauge("emyee_analysis_cache_misses_total", "Audio analyses that had to be downloaded.",
+                   lambda: cache.misses, kind="counter")
+    registry.gauge("emyee_analysis_cache_memory_items", "Audio analyses kept in memory.", lambda: cache.stats()["memory_items"])
@@ -1,5 +1,7 @@
-from dataclasses import dataclass
-from typing import Dict, Any, Union, List, Tuple
+from dataclasses import dataclass, field
+from typing import Dict, Any, Union, List, Tuple, Optional
+from analysis_model import CompactAnalysis
+from utils import YEELIGHT_DEFAULT_PORT, FRAME_HUE_SPREAD, FRAME_WAVE_DELAY
 
 # Type alias for raw responses from Spotify's API to improve readability
 RawSpotifyResponse = Dict[str, Any]
@@ -13,18 +15,25 @@ class EventSongChanged:
     Represents an event where a new song has started playing.
 
     Attributes:
-        analysis: A dictionary containing the analysis of the current song from Spotify's API.
+        analysis: The compact audio analysis of the current song from Spotify's API.
         progress_time_ms: The progress in seconds of the current song.
+        track_id: The Spotify ID of the track, used to reuse compiled shows.
+        song: The song prepared ahead of time (a song_compiler.PreparedSong), if it was prefetched.
+        detected_at: The time.monotonic() instant the song change was detected.
     """
-    analysis: RawSpotifyResponse
+    analysis: CompactAnalysis
     progress_time_ms: float
+    track_id: Optional[str] = None
+    song: Optional[Any] = None
+    detected_at: Optional[float] = None
 
 @dataclass
 class EventAdjustProgressTime:
     """
-    Represents an event to adjust the start time of the current song.
+    Represents a seek within the current song.
 
-    This can be useful to synchronize the application's state with the actual playback time.
+    Regular progress updates go through the shared PlaybackClock; this event is only queued
+    when the reported position jumps away from the extrapolated one.
 
     Attributes:
         progress_time_ms: The progress in seconds of the current song.
@@ -47,10 +56,48 @@ class Device:
         ip_address: The IP address of the device.
         port: The port number used for communication with the device.
         model: The model identifier of the device.
+        capabilities: The capabilities advertised by the device during discovery.
     """
     ip_address: str
     port: int
     model: str
+    capabilities: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def name(self) -> str:
+        """
+        Identifies the device like its transport: the IP, plus the port if it is not the default one.
+        """
+        return self.ip_address if self.port == YEELIGHT_DEFAULT_PORT else f"{self.ip_address}:{self.port}"
+
+@dataclass
+class DeviceGroup:
+    """
+    Represents a named set of devices, e.g. a room, sharing the same effect settings.
+
+    Attributes:
+        name: The name of the group.
+        devices: The names (IP, or IP:port) of the devices in the group.
+        effect: The transition effect of the group's bulbs ("smooth" or "sudden").
+        hue_spread: Hue difference in degrees between the first and the last device of the group.
+        wave_delay: Delay in song seconds between the first and the last device of the group.
+        worker: The index of the worker process the group runs in. When None, the group goes to the worker with the fewest devices.
+        positions: Where each device sits along the group, from 0 to 1, when the group is split across
+            workers. When None, the devices are spread evenly in order.
+    """
+    name: str
+    devices: List[str] = field(default_factory=list)
+    effect: str = "smooth"
+    hue_spread: int = FRAME_HUE_SPREAD
+    wave_delay: float = FRAME_WAVE_DELAY
+    worker: Optional[int] = None
+    positions: Optional[List[float]] = None
+
+    def includes(self, device_name: str) -> bool:
+        """
+        Returns whether the group lists a device, by name or by IP.
+        """
+        return device_name in self.devices or device_name.split(":")[0] in self.devices
 
 @dataclass
 class ColorTransition:
@@ -0,0 +1,193 @@
+import math
+import time
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from utils import (
+    PROGRESS_CORRECTION_TOLERANCE,
+    SEEK_THRESHOLD,
+    CLOCK_POSITION_GAIN,
+    CLOCK_RATE_GAIN,
+    CLOCK_MAX_DRIFT,
+    CLOCK_INITIAL_NOISE,
+    CLOCK_NOISE_SMOOTHING,
+)
+
+
+@dataclass(frozen=True)
+class ClockState:
+    """
+    The state of a PlaybackClock, to mirror it in another process.
+
+    Attributes:
+        position: The anchored playback position in seconds.
+        anchor_time: The time.monotonic() instant the position was valid at.
+        rate: The estimated playback rate.
+        playing: Whether playback is running.
+        version: Incremented with every correction of the estimate.
+        noise: The smoothed deviation of the reported positions.
+    """
+    position: float
+    anchor_time: float
+    rate: float
+    playing: bool
+    version: int
+    noise: float
+
+
+class PlaybackClock:
+    def __init__(self, tolerance: float = PROGRESS_CORRECTION_TOLERANCE, seek_threshold: float = SEEK_THRESHOLD,
+                 position_gain: float = CLOCK_POSITION_GAIN, rate_gain: float = CLOCK_RATE_GAIN,
+                 max_drift: float = CLOCK_MAX_DRIFT, speed: float = 1.0):
+        """
+        Shared latest-value clock of the playback position, smoothed with an alpha-beta filter.
+
+        The anchor (track position and the time.monotonic() instant it was valid at) and the
+        playback rate are only written when Spotify reports something new; readers extrapolate
+        the current position on demand. Reported positions within seek_threshold of the
+        prediction are treated as noisy measurements: the position moves only part of the way
+        towards them and the rate absorbs the drift between Spotify's clock and ours. Larger
+        jumps, in either direction, are seeks and re-anchor the clock right away.
+
+        :param tolerance: Change in seconds of the estimate above which an update counts as a
+            correction and listeners are notified.
+        :param seek_threshold: Deviation in seconds from the prediction above which a reported
+            position is a seek rather than noise.
+        :param position_gain: Fraction of the deviation applied to the position (alpha).
+        :param rate_gain: Fraction of the deviation per second applied to the rate (beta).
+        :param max_drift: Maximum relative deviation of the estimated rate from the nominal speed.
+        :param speed: The nominal playback rate, above 1 when replaying a session faster than real time.
+        """
+        self.tolerance = tolerance
+        self.seek_threshold = seek_threshold
+        self.position_gain = position_gain
+        self.rate_gain = rate_gain
+        self.max_drift = max_drift
+        self.speed = speed
+        self.playing = False
+        self.version = 0
+        # Whether the last update was a seek
+        self.seeked = False
+        self.rate = speed
+        # Smoothed magnitude of the deviations between reported and predicted positions
+        self.noise = CLOCK_INITIAL_NOISE
+        self._position = 0.0
+        self._anchor_time = 0.0
+        self._listeners: List[Callable[[], None]] = []
+
+    def add_listener(self, callback: Callable[[], None]):
+        """
+        Registers a callback invoked whenever the position estimate is corrected.
+        """
+        self._listeners.append(callback)
+
+    def position(self, at: Optional[float] = None) -> Optional[float]:
+        """
+        Returns the estimated playback position in seconds, or None while stopped.
+
+        :param at: The time.monotonic() instant to estimate the position at. Defaults to now.
+        """
+        if not self.playing:
+            return None
+        if at is None:
+            at = time.monotonic()
+        return self._position + (at - self._anchor_time) * self.rate
+
+    @property
+    def drift(self) -> float:
+        """
+        The estimated relative drift of the playback rate from the nominal speed.
+        """
+        return self.rate / self.speed - 1.0
+
+    @property
+    def confidence(self) -> float:
+        """
+        How much the estimate can be trusted, from 0 (stopped or very noisy) to 1.
+        """
+        if not self.playing:
+            return 0.0
+        return math.exp(-self.noise / self.seek_threshold)
+
+    def reset(self, position: float, at: Optional[float] = None):
+        """
+        Re-anchors the clock without filtering, e.g. when a new track starts.
+
+        :param position: The reported playback position in seconds.
+        :param at: The time.monotonic() instant the position was valid at. Defaults to now.
+        """
+        self._anchor(position, time.monotonic() if at is None else at)
+        self.rate = self.speed
+        self.noise = CLOCK_INITIAL_NOISE
+        self.seeked = False
+        self.version += 1
+        self._notify()
+
+    def update(self, position: float, at: Optional[float] = None) -> bool:
+        """
+        Filters a newly reported playback position into the estimate.
+
+        :param position: The reported playback position in seconds.
+        :param at: The time.monotonic() instant the position was valid at. Defaults to now.
+        :return: True if the update corrected the estimate and listeners were notified.
+        """
+        if at is None:
+            at = time.monotonic()
+        predicted = self.position(at)
+        if predicted is None:
+            self.reset(position, at)
+            return True
+
+        residual = position - predicted
+        self.seeked = abs(residual) > self.seek_threshold
+        if self.seeked:
+            # Keep the drift estimate: it belongs to the clocks, not to the track position
+            self._anchor(position, at)
+            self.noise = CLOCK_INITIAL_NOISE
+        else:
+            elapsed = at - self._anchor_time
+            if elapsed > 0:
+                low, high = self.speed * (1 - self.max_drift), self.speed * (1 + self.max_drift)
+                self.rate = min(max(self.rate + self.rate_gain * residual / elapsed, low), high)
+            self.noise += CLOCK_NOISE_SMOOTHING * (abs(residual) - self.noise)
+            self._anchor(predicted + self.position_gain * residual, at)
+
+        corrected = abs(self._position - predicted) > self.tolerance
+        if corrected:
+            self.version += 1
+            self._notify()
+        return corrected
+
+    def stop(self):
+        """
+        Marks playback as stopped.
+        """
+        if self.playing:
+            self.playing = False
+            self.version += 1
+            self._notify()
+
+    def snapshot(self) -> ClockState:
+        return ClockState(self._position, self._anchor_time, self.rate, self.playing, self.version, self.noise)
+
+    def restore(self, state: ClockState):
+        """
+        Takes over the state of another clock, e.g. the one fed by the listener in the main process.
+        time.monotonic() is system-wide, so anchors stay valid across processes.
+
+        Listeners are notified when the other clock corrected its estimate since the last restore.
+        """
+        corrected = state.version != self.version
+        self._position, self._anchor_time, self.rate = state.position, state.anchor_time, state.rate
+        self.playing, self.version, self.noise = state.playing, state.version, state.noise
+        if corrected:
+            self._notify()
+
+    def _anchor(self, position: float, at: float):
+        self._position = position
+        self._anchor_time = at
+        self.playing = True
+
+    def _notify(self):
+        for callback in self._listeners:
+            callback()
@@ -0,0 +1,80 @@
+import time
+from typing import Optional
+
+from utils import (
+    API_POLL_FAST_INTERVAL,
+    API_POLL_SLOW_INTERVAL,
+    API_POLL_PAUSED_INTERVAL,
+    API_POLL_FAST_WINDOW,
+    API_BACKOFF_BASE,
+    API_BACKOFF_MAX,
+)
+
+
+class PollScheduler:
+    def __init__(self, fast_interval: float = API_POLL_FAST_INTERVAL, slow_interval: float = API_POLL_SLOW_INTERVAL,
+                 paused_interval: float = API_POLL_PAUSED_INTERVAL, fast_window: float = API_POLL_FAST_WINDOW):
+        """
+        Decides how long to wait before the next currently-playing poll.
+
+        Polls fast right after a song change and near the expected end of the track, slowly
+        mid-track or while paused, and backs off on rate limits and errors.
+
+        :param fast_interval: Interval in seconds used around song changes.
+        :param slow_interval: Interval in seconds used mid-track.
+        :param paused_interval: Interval in seconds used while nothing is playing.
+        :param fast_window: Seconds after a change and before the track end during which to poll fast.
+        """
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.paused_interval = paused_interval
+        self.fast_window = fast_window
+        self.last_change_time = float("-inf")
+        self.backoff_until = 0.0
+        self.consecutive_failures = 0
+
+    def record_change(self):
+        """
+        Marks that the playing track (or playback state) just changed.
+        """
+        self.last_change_time = time.monotonic()
+
+    def record_success(self):
+        """
+        Resets the backoff after a successful request.
+        """
+        self.consecutive_failures = 0
+
+    def record_failure(self, retry_after: Optional[float] = None):
+        """
+        Registers a failed or rate-limited request.
+
+        :param retry_after: The delay in seconds requested by the server through Retry-After, if any.
+        """
+        self.consecutive_failures += 1
+        backoff = min(API_BACKOFF_BASE * 2 ** (self.consecutive_failures - 1), API_BACKOFF_MAX)
+        if retry_after is not None:
+            backoff = max(backoff, retry_after)
+        self.backoff_until = time.monotonic() + backoff
+
+    def next_delay(self, is_playing: bool, progress: float = 0, duration: float = 0) -> float:
+        """
+        Returns the number of seconds to wait before polling again.
+
+        :param is_playing: Whether a track is currently playing.
+        :param progress: The playback position of the track in seconds.
+        :param duration: The duration of the track in seconds.
+        """
+        now = time.monotonic()
+        if now < self.backoff_until:
+            return self.backoff_until - now
+
+        if not is_playing:
+            return self.paused_interval
+
+        remaining = duration - progress
+        if now - self.last_change_time < self.fast_window or remaining < self.fast_window:
+            return self.fast_interval
+
+        # Never sleep past the point where the fast window before the track end begins
+        return max(self.fast_interval, min(self.slow_interval, remaining - self.fast_window))
@@ -0,0 +1,156 @@
+from dataclasses import dataclass
+from typing import Any, Dict, List
+
+import numpy as np
+
+from utils import MIN_SEGMENT_DURATION
+
+# Scalar per-segment fields kept from Spotify's audio analysis
+SEGMENT_FIELDS = ("start", "duration", "confidence", "loudness_start", "loudness_max_time", "loudness_max", "loudness_end")
+# Length of the pitches and timbre vectors
+FEATURE_SIZE = 12
+# Times keep double precision; loudness, confidence and the feature vectors fit in single precision
+TIME_FIELDS = ("start", "duration")
+FEATURE_DTYPE = np.float32
+# Bound on the rounding error of group durations taken from a song-long cumulative sum
+CUMSUM_TOLERANCE = 1e-9
+
+
+@dataclass
+class SegmentArrays:
+    """
+    Columnar representation of the segments of a Spotify audio analysis.
+
+    Attributes:
+        start: Start time of each segment in seconds.
+        duration: Duration of each segment in seconds.
+        confidence: Confidence of each segment boundary.
+        loudness_start: Loudness in dB at the start of each segment.
+        loudness_max_time: Offset in seconds of the peak loudness within each segment.
+        loudness_max: Peak loudness in dB of each segment.
+        loudness_end: Loudness in dB at the end of each segment.
+        pitches: Segments x 12 matrix of chroma values.
+        timbre: Segments x 12 matrix of timbre coefficients.
+    """
+    start: np.ndarray
+    duration: np.ndarray
+    confidence: np.ndarray
+    loudness_start: np.ndarray
+    loudness_max_time: np.ndarray
+    loudness_max: np.ndarray
+    loudness_end: np.ndarray
+    pitches: np.ndarray
+    timbre: np.ndarray
+
+    @classmethod
+    def from_segments(cls, segments: List[Dict[str, Any]]) -> "SegmentArrays":
+        """
+        Builds the columnar arrays from a list of segment dictionaries.
+        """
+        scalars = np.array([[seg.get(field, 0.0) for field in SEGMENT_FIELDS] for seg in segments],
+                           dtype=np.float64).reshape(len(segments), len(SEGMENT_FIELDS))
+        columns = {field: scalars[:, i].astype(np.float64 if field in TIME_FIELDS else FEATURE_DTYPE)
+                   for i, field in enumerate(SEGMENT_FIELDS)}
+        pitches = np.array([seg['pitches'] for seg in segments], dtype=FEATURE_DTYPE).reshape(len(segments), FEATURE_SIZE)
+        timbre = np.array([seg['timbre'] for seg in segments], dtype=FEATURE_DTYPE).reshape(len(segments), FEATURE_SIZE)
+        return cls(pitches=pitches, timbre=timbre, **columns)
+
+    def __len__(self):
+        return len(self.start)
+
+    def __getitem__(self, index: int) -> Dict[str, Any]:
+        """
+        Returns a single segment as a dictionary, like the ones in Spotify's audio analysis.
+        """
+        segment = {field: float(getattr(self, field)[index]) for field in SEGMENT_FIELDS}
+        segment['pitches'] = self.pitches[index].tolist()
+        segment['timbre'] = self.timbre[index].tolist()
+        return segment
+
+    def to_segments(self) -> List[Dict[str, Any]]:
+        return [self[i] for i in range(len(self))]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, field).nbytes for field in SEGMENT_FIELDS) + self.pitches.nbytes + self.timbre.nbytes
+
+    @property
+    def linear_loudness(self) -> np.ndarray:
+        """
+        The loudness at the start of each segment converted from decibels to a linear scale.
+        """
+        return 10 ** (self.loudness_start.astype(np.float64) / 20)
+
+
+def merge_short_segments_arrays(segments: SegmentArrays, min_duration: float = MIN_SEGMENT_DURATION) -> SegmentArrays:
+    """
+    Vectorized equivalent of utils.merge_short_segments.
+
+    A segment absorbs the following ones until its duration reaches min_duration. Start time,
+    confidence and peak time come from the first segment of each group, the peak loudness is
+    the maximum, the end loudness comes from the last segment, and the start loudness,
+    pitches and timbre are averaged pairwise in order, exactly like the iterative version.
+
+    :param segments: The segments of the song.
+    :param min_duration: Minimum duration for a segment in seconds.
+    :return: New segment arrays with short segments merged.
+    """
+    n = len(segments)
+    if n == 0:
+        return segments
+
+    # Each group ends at the first segment where the cumulative duration reaches min_duration,
+    # so the start of the group following one starting at i can be computed for every i at once.
+    # Differences of a song-long cumulative sum are off by rounding errors, so where a group
+    # adds up to within CUMSUM_TOLERANCE of min_duration, its end is found with the same
+    # sequential sum as the iterative version instead
+    cumulative = np.cumsum(segments.duration, dtype=np.float64)
+    preceding = np.concatenate(([0.0], cumulative[:-1]))
+    earliest = np.searchsorted(cumulative, preceding + (min_duration - CUMSUM_TOLERANCE), side="left")
+    latest = np.searchsorted(cumulative, preceding + (min_duration + CUMSUM_TOLERANCE), side="left")
+    following = (np.clip(earliest, np.arange(n), n - 1) + 1).tolist()
+    ambiguous = (earliest != latest).tolist()
+    durations = segments.duration.tolist() if any(ambiguous) else []
+    group_starts = []
+    i = 0
+    while i < n:
+        group_starts.append(i)
+        i = _sequential_group_end(durations, i, min_duration) + 1 if ambiguous[i] else following[i]
+    starts = np.array(group_starts)
+    ends = np.append(starts[1:], n) - 1
+
+    # Repeated pairwise averaging weighs the j-th member by 0.5 ** (end - j + 1), and the first by twice that
+    group_of = np.repeat(np.arange(len(starts)), ends - starts + 1)
+    weights = 0.5 ** (ends[group_of] - np.arange(n) + 1)
+    weights[starts] *= 2
+
+    return SegmentArrays(
+        start=segments.start[starts],
+        duration=np.add.reduceat(segments.duration, starts),
+        confidence=segments.confidence[starts],
+        loudness_start=np.add.reduceat(segments.loudness_start * weights, starts).astype(segments.loudness_start.dtype),
+        loudness_max_time=segments.loudness_max_time[starts],
+        loudness_max=np.maximum.reduceat(segments.loudness_max, starts),
+        loudness_end=segments.loudness_end[ends],
+        pitches=np.add.reduceat(segments.pitches * weights[:, None], starts, axis=0).astype(segments.pitches.dtype),
+        timbre=np.add.reduceat(segments.timbre * weights[:, None], starts, axis=0).astype(segments.timbre.dtype),
+    )
+
+
+def _sequential_group_end(durations: List[float], start: int, min_duration: float) -> int:
+    """
+    Returns the last segment of the group starting at start, summing durations in the same
+    order as utils.merge_short_segments so rounding matches it exactly.
+    """
+    end, total = start, durations[start]
+    while total < min_duration and end + 1 < len(durations):
+        end += 1
+        total += durations[end]
+    return end
+
+
+def preprocess_segments(segments: List[Dict[str, Any]], min_duration: float = MIN_SEGMENT_DURATION) -> SegmentArrays:
+    """
+    Converts raw analysis segments to columnar arrays and merges the short ones.
+    """
+    return merge_short_segments_arrays(SegmentArrays.from_segments(segments), min_duration)
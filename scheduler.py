@@ -0,0 +1,92 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Any, Awaitable, Callable, List, Optional
+
+from loguru import logger
+
+from metrics import SCHEDULER_LAG
+
+TimerCallback = Callable[[], Optional[Awaitable[Any]]]
+
+
+class TimerHandle:
+    __slots__ = ("deadline", "callback", "cancelled")
+
+    def __init__(self, deadline: float, callback: TimerCallback):
+        self.deadline = deadline
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class DeadlineScheduler:
+    def __init__(self):
+        """
+        Runs callbacks at monotonic deadlines kept in a timer heap.
+
+        The run loop sleeps exactly until the earliest deadline and only wakes earlier when a
+        timer is added or wake() is called, so there is no polling while nothing is due.
+        """
+        self._heap: List[tuple] = []
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+
+    def call_at(self, deadline: float, callback: TimerCallback) -> TimerHandle:
+        """
+        Schedules a callback at a time.monotonic() deadline.
+
+        :param deadline: The monotonic time at which to run the callback.
+        :param callback: A function, optionally returning an awaitable, to run at the deadline.
+        :return: A handle that can be used to cancel the timer.
+        """
+        handle = TimerHandle(deadline, callback)
+        heapq.heappush(self._heap, (deadline, next(self._counter), handle))
+        if self._heap[0][2] is handle:
+            self.wake()
+        return handle
+
+    def call_later(self, delay: float, callback: TimerCallback) -> TimerHandle:
+        return self.call_at(time.monotonic() + delay, callback)
+
+    def cancel_all(self):
+        for _, _, handle in self._heap:
+            handle.cancel()
+        self._heap.clear()
+
+    def wake(self):
+        """
+        Makes the run loop re-evaluate its next deadline.
+        """
+        self._wakeup.set()
+
+    async def run(self):
+        while True:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            timeout = self._heap[0][0] - time.monotonic()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+
+            _, _, handle = heapq.heappop(self._heap)
+            SCHEDULER_LAG.observe(time.monotonic() - handle.deadline)
+            try:
+                result = handle.callback()
+                if result is not None:
+                    await result
+            except Exception as e:
+                logger.exception(f"Scheduled callback failed: {e}")
@@ -0,0 +1,214 @@
+import asyncio
+import bisect
+import json
+import os
+import time
+import zipfile
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from analysis_cache import AnalysisCache
+from analysis_model import CompactAnalysis
+from command_queue import DeviceCommand
+from latency import LatencyModel
+from playback_clock import PlaybackClock
+from song_preparer import SongPreparer
+from spotify_listener import SpotifyChangesListener
+from tracing import tracer
+from utils import PREFETCH_TRACKS
+
+SESSION_FORMAT_VERSION = 1
+
+
+def compact_playing(response: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Keeps only the fields of a currently-playing response the listener uses.
+    """
+    if not response:
+        return {}
+    item = response.get("item") or {}
+    return {
+        "is_playing": response.get("is_playing", False),
+        "progress_ms": response.get("progress_ms", 0),
+        "item": {"id": item.get("id"), "duration_ms": item.get("duration_ms", 0)},
+    }
+
+
+@dataclass
+class Session:
+    """
+    A recorded run: the currently-playing responses, the analyses of the tracks played and
+    the commands sent to the bulbs, with times in seconds since the start of the recording.
+
+    Sessions are saved as zip files holding playing.json, commands.json and one
+    analyses/<track id>.npz file per track.
+
+    Attributes:
+        playing: (time, response) pairs of the compacted currently-playing responses.
+        commands: (time, device name, command) triples of the commands sent to the bulbs.
+        analyses: The analyses of the tracks played, keyed by track ID.
+    """
+    playing: List[Tuple[float, Dict[str, Any]]] = field(default_factory=list)
+    commands: List[Tuple[float, str, Dict[str, Any]]] = field(default_factory=list)
+    analyses: Dict[str, CompactAnalysis] = field(default_factory=dict)
+    # Times of the playing responses, for bisecting; rebuilt if responses were recorded since
+    _playing_times: List[float] = field(default_factory=list, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self._playing_times = [sample_time for sample_time, _ in self.playing]
+
+    @property
+    def duration(self) -> float:
+        return self.playing[-1][0] if self.playing else 0.0
+
+    def response_at(self, t: float) -> Dict[str, Any]:
+        """
+        Returns the currently-playing response at a session time, extrapolating the progress of
+        the last recorded response while playing.
+        """
+        if len(self._playing_times) != len(self.playing):
+            self._playing_times = [sample_time for sample_time, _ in self.playing]
+        index = bisect.bisect_right(self._playing_times, t) - 1
+        if index < 0:
+            return {}
+        recorded_at, response = self.playing[index]
+        if not response.get("is_playing"):
+            return response
+        progress_ms = response["progress_ms"] + (t - recorded_at) * 1000
+        return {**response, "progress_ms": int(min(progress_ms, response["item"]["duration_ms"]))}
+
+    def track_order(self) -> List[str]:
+        """
+        Returns the IDs of the tracks played, in order of first appearance.
+        """
+        order: List[str] = []
+        for _, response in self.playing:
+            track_id = (response.get("item") or {}).get("id")
+            if track_id is not None and track_id not in order:
+                order.append(track_id)
+        return order
+
+    def upcoming(self, track_id: Optional[str]) -> List[str]:
+        """
+        Returns the tracks played after a track, like the user's queue would have.
+        """
+        order = self.track_order()
+        return order[order.index(track_id) + 1:] if track_id in order else order
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("playing.json", json.dumps({"version": SESSION_FORMAT_VERSION, "playing": self.playing},
+                                                        separators=(",", ":")))
+            archive.writestr("commands.json", json.dumps(self.commands, separators=(",", ":")))
+            for track_id, analysis in self.analyses.items():
+                # The .npz payloads are compressed already
+                archive.writestr(f"analyses/{track_id}.npz", analysis.to_bytes(), compress_type=zipfile.ZIP_STORED)
+        os.replace(tmp_path, path)
+        logger.info(f"Saved session with {len(self.playing)} response(s), {len(self.commands)} command(s) and "
+                    f"{len(self.analyses)} analysis(es) to {path}")
+
+    @classmethod
+    def load(cls, path: str) -> "Session":
+        """
+        Loads a session saved by save.
+
+        :raises ValueError: If the file is not a session of a supported version.
+        """
+        with zipfile.ZipFile(path) as archive:
+            header = json.loads(archive.read("playing.json"))
+            if header.get("version") != SESSION_FORMAT_VERSION:
+                raise ValueError(f"Unsupported session format version {header.get('version')!r} in {path}")
+            session = cls(
+                playing=[(float(t), response) for t, response in header["playing"]],
+                commands=[(float(t), device, command) for t, device, command in json.loads(archive.read("commands.json"))],
+            )
+            for name in archive.namelist():
+                if name.startswith("analyses/") and name.endswith(".npz"):
+                    track_id = name[len("analyses/"):-len(".npz")]
+                    session.analyses[track_id] = CompactAnalysis.from_bytes(archive.read(name))
+        return session
+
+
+class SessionRecorder:
+    def __init__(self, path: str):
+        """
+        Records the Spotify responses, analyses and bulb commands of a run into a Session.
+
+        :param path: The file the session is saved to.
+        """
+        self.path = path
+        self.session = Session()
+        self.started_at = time.monotonic()
+
+    def _now(self, at: Optional[float] = None) -> float:
+        return (time.monotonic() if at is None else at) - self.started_at
+
+    def record_playing(self, response: Dict[str, Any], at: Optional[float] = None):
+        """
+        Records a currently-playing response.
+
+        :param at: The time.monotonic() instant the response was valid at. Defaults to now.
+        """
+        self.session.playing.append((self._now(at), compact_playing(response)))
+
+    def record_analysis(self, track_id: str, analysis: CompactAnalysis):
+        self.session.analyses.setdefault(track_id, analysis)
+
+    def record_command(self, device: str, command: DeviceCommand):
+        self.session.commands.append((self._now(), device, asdict(command)))
+
+    def save(self):
+        self.session.save(self.path)
+
+
+class SessionReplayer(SpotifyChangesListener):
+    def __init__(self, session: Session, events_queue: asyncio.Queue, clock: PlaybackClock, speed: float = 1.0,
+                 latency_model: Optional[LatencyModel] = None, recorder: Optional[SessionRecorder] = None,
+                 preparer: Optional[SongPreparer] = None):
+        """
+        Replays a recorded session straight into the events queue, without any HTTP.
+
+        Polls go through the same logic as the live listener, but the responses come from the
+        session at the replayed time, and the analyses from the session itself.
+
+        :param session: The session to replay.
+        :param events_queue: The queue the song events are put in.
+        :param clock: The playback clock, which should run at the same speed.
+        :param speed: How many times faster than real time to replay the session.
+        """
+        super().__init__(None, None, None, events_queue, clock, latency_model=latency_model,
+                         access_token="replay", recorder=recorder, preparer=preparer,
+                         analysis_cache=AnalysisCache(cache_dir=None))
+        self.session = session
+        self.speed = speed
+        self._started_at: Optional[float] = None
+
+    def session_time(self) -> float:
+        return (time.monotonic() - self._started_at) * self.speed
+
+    async def fetch_spotify_changes(self):
+        self._started_at = time.monotonic()
+        try:
+            while self.session_time() <= self.session.duration:
+                with tracer.span("poll"):
+                    delay = await self._poll(None)
+                await asyncio.sleep(delay / self.speed)
+        finally:
+            if self._prefetch_task is not None:
+                self._prefetch_task.cancel()
+        logger.info(f"Replayed {self.session.duration:.1f}s of session at {self.speed}x")
+
+    async def _get_current_playing(self, session):
+        return self.session.response_at(self.session_time())
+
+    async def _get_audio_analysis(self, session, track_id):
+        return self.session.analyses[track_id]
+
+    async def _prefetch_upcoming(self, session):
+        for track_id in self.session.upcoming(self.current_track_id)[:PREFETCH_TRACKS]:
+            if track_id not in self.prepared_songs and track_id in self.session.analyses:
+                self.prepared_songs[track_id] = await self.preparer.prepare(self.session.analyses[track_id], track_id)
@@ -0,0 +1,144 @@
+import random
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+from brightness_curve import BrightnessCurve
+from analysis_model import CompactAnalysis
+from preprocessing import SegmentArrays, merge_short_segments_arrays
+from timeline import SongTimeline
+from tracing import tracer
+from utils import BAR_CONFIDENCE_THRESHOLD, SHOW_FOLLOW_UP_DELAY, get_vibrant_color
+
+# Entry kinds of a compiled show
+ENTRY_BRIGHTNESS = 0
+ENTRY_COLOR = 1
+
+
+@dataclass
+class CompiledShow:
+    """
+    A song compiled ahead of time into a time-sorted list of light transitions.
+
+    Every entry stores the full light state after it applies, so the state at any playback
+    position is simply the entry preceding it.
+
+    Attributes:
+        times: Song position in seconds at which each entry applies.
+        kinds: ENTRY_BRIGHTNESS or ENTRY_COLOR.
+        durations: Duration of each transition in seconds.
+        brightness: Brightness (0-100) after each entry.
+        hue: Hue (0-359) after each entry.
+        saturation: Saturation (0-100) after each entry.
+    """
+    times: np.ndarray
+    kinds: np.ndarray
+    durations: np.ndarray
+    brightness: np.ndarray
+    hue: np.ndarray
+    saturation: np.ndarray
+
+    def __len__(self):
+        return len(self.times)
+
+
+def compile_song(timeline: SongTimeline, brightness_curve: BrightnessCurve,
+                 bar_confidence: float = BAR_CONFIDENCE_THRESHOLD, rng: Optional[random.Random] = None) -> CompiledShow:
+    """
+    Compiles a song into a CompiledShow.
+
+    Brightness follows the loudness of the upcoming segment and the color changes on every
+    confident bar, with the same timing rules the controller used to apply reactively.
+
+    :param timeline: The indexed timeline of the song.
+    :param brightness_curve: The precomputed brightness of every segment.
+    :param bar_confidence: Minimum bar confidence required to change color.
+    :param rng: Picks the colors. Seed it to compile the same show every time.
+    :return: The compiled show.
+    """
+    segments: SegmentArrays = timeline.items["segments"]
+    bars: np.ndarray = timeline.items["bars"]
+    segment_starts = timeline.starts["segments"]
+    bar_starts = timeline.starts["bars"]
+
+    # Lookups only change when playback crosses a segment or bar start
+    boundaries = np.unique(np.concatenate(([0.0], segment_starts, bar_starts)))
+    next_segment_indexes = np.searchsorted(segment_starts, boundaries, side="right") + 1
+    bar_indexes = np.searchsorted(bar_starts, boundaries, side="right")
+
+    rng = rng or random.Random()
+    entries = []
+    hue, saturation = get_vibrant_color(rng.randint(0, 359), rng)
+    brightness = 0
+    last_bar_index = 0
+    next_boundaries = np.append(boundaries[1:], np.inf)
+    for t, next_t, segment_index, bar_index in zip(boundaries, next_boundaries, next_segment_indexes, bar_indexes):
+        if segment_index >= len(segments) or bar_index >= len(bars):
+            continue
+        bar = bars[bar_index]
+        if bar_index != last_bar_index and bar["confidence"] > bar_confidence:
+            hue, saturation = get_vibrant_color(hue, rng)
+            duration = bar["duration"] - (t - bar["start"])
+            entries.append((t, ENTRY_COLOR, duration, brightness, hue, saturation))
+            last_bar_index = bar_index
+            # The brightness change due at the same time follows right after, as a separate entry
+            # so the color keeps the duration of the bar
+            t += SHOW_FOLLOW_UP_DELAY
+            if t >= next_t:
+                continue
+        if brightness_curve[segment_index] != brightness:
+            brightness = brightness_curve[segment_index]
+            entries.append((t, ENTRY_BRIGHTNESS, segments.duration[segment_index], brightness, hue, saturation))
+
+    columns = list(zip(*entries)) if entries else [()] * 6
+    return CompiledShow(
+        times=np.array(columns[0], dtype=np.float64),
+        kinds=np.array(columns[1], dtype=np.uint8),
+        durations=np.array(columns[2], dtype=np.float32),
+        brightness=np.array(columns[3], dtype=np.uint8),
+        hue=np.array(columns[4], dtype=np.uint16),
+        saturation=np.array(columns[5], dtype=np.uint8),
+    )
+
+
+@dataclass(frozen=True)
+class PreparedSong:
+    """
+    A song with everything the controller needs precomputed from its audio analysis.
+    Immutable, so it can be handed between the preparation pool, the listener and the controller.
+
+    Attributes:
+        track_id: The Spotify ID of the track, if known.
+        analysis: The compact audio analysis.
+        segments: The segments after merging short ones, as columnar arrays.
+        timeline: The indexed timeline of the song.
+        brightness_curve: The precomputed brightness of every segment.
+        show: The compiled light show.
+    """
+    track_id: Optional[str]
+    analysis: CompactAnalysis
+    segments: SegmentArrays
+    timeline: SongTimeline
+    brightness_curve: BrightnessCurve
+    show: CompiledShow
+
+
+def prepare_song(analysis: CompactAnalysis, track_id: Optional[str] = None) -> PreparedSong:
+    """
+    Merges segments, builds the indexes and compiles the show for an audio analysis.
+    The colors are seeded from the track ID, so a track always gets the same show, e.g. when
+    replaying a session.
+
+    :param analysis: The compact audio analysis.
+    :param track_id: The Spotify ID of the track, if known.
+    :return: The prepared song.
+    """
+    with tracer.span("prepare song", track_id=track_id):
+        with tracer.span("merge segments"):
+            segments = merge_short_segments_arrays(analysis.segments)
+        timeline = SongTimeline.from_analysis(analysis, segments)
+        brightness_curve = BrightnessCurve(segments)
+        with tracer.span("compile show"):
+            show = compile_song(timeline, brightness_curve, rng=random.Random(track_id))
+    return PreparedSong(track_id, analysis, segments, timeline, brightness_curve, show)
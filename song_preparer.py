@@ -0,0 +1,70 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from loguru import logger
+
+from analysis_model import CompactAnalysis
+from song_compiler import PreparedSong, prepare_song
+from tracing import tracer
+from utils import SONG_PREPARE_WORKERS
+
+
+class SongPreparer:
+    def __init__(self, workers: int = SONG_PREPARE_WORKERS):
+        """
+        Prepares songs off the event loop, so merging segments and compiling the show never
+        stall the commands going to the bulbs.
+
+        With workers > 0 songs are prepared in a pool of worker processes, which also keeps
+        them from competing for the GIL with the loop. The prepared song is pickled back as a
+        whole, so the controller only ever sees complete songs. Cancelling prepare() drops a
+        queued song right away; one already being prepared finishes in its worker and is
+        discarded, leaving the other workers free for the next track.
+
+        :param workers: The number of worker processes, or 0 to use the loop's default thread pool.
+        """
+        self.workers = workers
+        self._executor: Optional[Executor] = None
+
+    def _create_executor(self) -> Optional[Executor]:
+        if not self.workers:
+            return None
+        # Forking a process running an event loop and threads is unsafe
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def start(self):
+        """
+        Starts the worker processes ahead of the first song change.
+        """
+        if self.workers and self._executor is None:
+            self._executor = self._create_executor()
+            await asyncio.get_running_loop().run_in_executor(self._executor, int)
+
+    async def prepare(self, analysis: CompactAnalysis, track_id: Optional[str] = None) -> PreparedSong:
+        """
+        Prepares a song in the pool.
+
+        :param analysis: The compact audio analysis.
+        :param track_id: The Spotify ID of the track, if known.
+        :return: The prepared song.
+        """
+        loop = asyncio.get_running_loop()
+        if self.workers and self._executor is None:
+            self._executor = self._create_executor()
+        with tracer.span("prepare song (pool)", track_id=track_id):
+            try:
+                return await loop.run_in_executor(self._executor, prepare_song, analysis, track_id)
+            except BrokenProcessPool:
+                # A worker died, e.g. killed for memory; start over with a fresh pool
+                logger.warning(f"Song preparation pool broke, preparing {track_id} in a thread")
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = self._create_executor()
+                return await asyncio.to_thread(prepare_song, analysis, track_id)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -2,85 +2,265 @@ import asyncio
 import aiohttp
 import time
 import sys
-from spotipy.oauth2 import SpotifyOAuth
+from typing import Dict
+from spotipy.oauth2 import SpotifyOAuth, SpotifyOauthError
 from models import EventSongChanged, EventAdjustProgressTime, EventStop
 from loguru import logger
-from spotipy.util import prompt_for_user_token
+from analysis_cache import AnalysisCache
+from analysis_stream import AnalysisStreamParser
+from poll_scheduler import PollScheduler
+from playback_clock import PlaybackClock
+from latency import LatencyModel
+from metrics import SPOTIFY_REQUEST_SECONDS, SPOTIFY_ERRORS
+from tracing import tracer
+from song_compiler import PreparedSong
+from song_preparer import SongPreparer
+from token_manager import SpotifyTokenManager, StaticTokenProvider
 
-from utils import API_REQUEST_INTERVAL, API_AUDIO_ANALYSIS, API_CURRENT_PLAYING, CONTROLLER_TICK, SPOTIFY_SCOPE
-from utils import SPOTIFY_CHANGES_LISTENER_DELAY, SPOTIFY_CHANGES_LISTENER_FAILURE_DELAY, SPOTIFY_REDIRECT_URI
+from utils import API_BASE, API_AUDIO_ANALYSIS, API_CURRENT_PLAYING, API_KEEPALIVE_TIMEOUT, SPOTIFY_SCOPE, SPOTIFY_REDIRECT_URI
+from utils import API_PLAYER_QUEUE, PREFETCH_TRACKS, ANALYSIS_STREAM_CHUNK_SIZE
+
+
+CURRENT_PLAYING_SECONDS = SPOTIFY_REQUEST_SECONDS.labels("currently_playing")
+AUDIO_ANALYSIS_SECONDS = SPOTIFY_REQUEST_SECONDS.labels("audio_analysis")
+PLAYER_QUEUE_SECONDS = SPOTIFY_REQUEST_SECONDS.labels("queue")
+RATE_LIMITED_ERRORS = SPOTIFY_ERRORS.labels("rate_limited")
+REQUEST_ERRORS = SPOTIFY_ERRORS.labels("request")
+UNAUTHORIZED_ERRORS = SPOTIFY_ERRORS.labels("unauthorized")
+
+
+class RateLimitedError(Exception):
+    def __init__(self, retry_after: float | None):
+        super().__init__(f"Spotify API rate limit exceeded (Retry-After: {retry_after})")
+        self.retry_after = retry_after
+
+
+class UnauthorizedError(Exception):
+    pass
 
 
 class SpotifyChangesListener:
-    def __init__(self, user_id, client_id, client_secret, events_queue: asyncio.Queue):
+    def __init__(self, user_id, client_id, client_secret, events_queue: asyncio.Queue, clock: PlaybackClock,
+                 latency_model: LatencyModel | None = None, api_base: str = API_BASE, access_token: str | None = None,
+                 recorder=None, preparer: SongPreparer | None = None, analysis_cache: AnalysisCache | None = None):
+        """
+        Polls Spotify for the current track and progress, feeding the playback clock and the events queue.
+
+        :param api_base: The base URL of the Web API, e.g. a local stand-in serving a recorded session.
+        :param access_token: A fixed access token. When None, the user's token is obtained, prompting
+            if needed, and refreshed in the background by a SpotifyTokenManager.
+        :param recorder: A session_recording.SessionRecorder capturing responses and analyses, if any.
+        :param preparer: Prepares the upcoming tracks. Defaults to one using the loop's thread pool.
+        :param analysis_cache: Where downloaded analyses are cached. Defaults to the one in the user's
+            cache directory; replays pass a memory-only one so they leave no trace on disk.
+        """
         self.user_id = user_id
         self.client_id = client_id
         self.client_secret = client_secret
         self.events_queue = events_queue
+        self.clock = clock
+        self.latency_model = latency_model or LatencyModel(path=None)
+        self.api_base = api_base
+        self.recorder = recorder
         self.current_track_id = None
         self.current_progress = 0  # Initial progress in seconds
         self.last_api_update_time = 0
-        self.last_progress = 0
-        self.headers = {}
-        self.spotify_auth = SpotifyOAuth(client_id=client_id,
-                                         client_secret=client_secret,
-                                         redirect_uri=SPOTIFY_REDIRECT_URI,
-                                         scope=SPOTIFY_SCOPE)
+        self.analysis_cache = analysis_cache or AnalysisCache()
+        self.poll_scheduler = PollScheduler()
+        # Songs prepared ahead of time for the upcoming tracks in the user's queue
+        self.prepared_songs: Dict[str, PreparedSong] = {}
+        self.preparer = preparer or SongPreparer(workers=0)
+        self._prefetch_task: asyncio.Task | None = None
+        self.spotify_auth = None
+        if access_token is None:
+            # Same token cache as spotipy's prompt_for_user_token, so existing logins carry over
+            self.spotify_auth = SpotifyOAuth(client_id=client_id,
+                                             client_secret=client_secret,
+                                             redirect_uri=SPOTIFY_REDIRECT_URI,
+                                             scope=SPOTIFY_SCOPE,
+                                             username=user_id)
+            self.tokens = SpotifyTokenManager(self.spotify_auth)
+        else:
+            self.tokens = StaticTokenProvider(access_token)
 
     async def listen(self):
-        # Start the background task for fetching updates from Spotify
-        asyncio.create_task(self.fetch_spotify_changes())
-        await asyncio.sleep(1)
-        while True:
-            await asyncio.sleep(SPOTIFY_CHANGES_LISTENER_DELAY)
-            new_progress = self.current_progress + time.time() - self.last_api_update_time
-            if self.last_progress > new_progress and self.last_progress - new_progress < SPOTIFY_CHANGES_LISTENER_FAILURE_DELAY:
-                logger.trace("Spotify API request rate limit exceeded. Waiting...")
-                await asyncio.sleep(SPOTIFY_CHANGES_LISTENER_DELAY)
-                continue
-            await self.events_queue.put(EventAdjustProgressTime(new_progress))
-            self.last_progress = new_progress
+        # Progress is only written to the playback clock when Spotify reports something new;
+        # the controller reads it on demand and schedules its own wake-ups.
+        await self.fetch_spotify_changes()
 
     async def fetch_spotify_changes(self):
-        access_token = prompt_for_user_token(
-            self.user_id,
-            SPOTIFY_SCOPE,
-            client_id=self.client_id,
-            client_secret=self.client_secret,
-            redirect_uri=SPOTIFY_REDIRECT_URI,
-        )
-        if not access_token:
-            logger.error("Failed to retrieve Spotify token.")
+        try:
+            await self.tokens.start()
+        except SpotifyOauthError as e:
+            logger.error(f"Failed to retrieve Spotify token: {e}")
             sys.exit(1)
-        self.headers = {'Authorization': f"Bearer {access_token}"}
-        while True:
-            # Ensure enough time has passed before making another API call
-            if time.time() - self.last_api_update_time >= API_REQUEST_INTERVAL:
-                async with aiohttp.ClientSession(headers=self.headers) as session:
-                    before_request = time.time()
-                    current_playing = await self._get_current_playing(session)
-                    if not current_playing.get('is_playing', False):
-                        self.current_track_id = None
-                        await self.events_queue.put(EventStop())
-                        continue
-
-                    self.current_progress = current_playing["progress_ms"] / 1000 - (time.time() - before_request)
-
-                    if current_playing['item']['id'] != self.current_track_id:
-                        self.current_track_id = current_playing['item']['id']
-                        analysis = await self._get_audio_analysis(session, self.current_track_id)
-                        await self.events_queue.put(EventSongChanged(analysis, self.current_progress))
-                    self.last_api_update_time = time.time()
-            await asyncio.sleep(SPOTIFY_CHANGES_LISTENER_DELAY)
+        connector = aiohttp.TCPConnector(limit_per_host=4, keepalive_timeout=API_KEEPALIVE_TIMEOUT)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            try:
+                while True:
+                    with tracer.span("poll"):
+                        delay = await self._poll(session)
+                    await asyncio.sleep(delay)
+            finally:
+                if self._prefetch_task is not None:
+                    self._prefetch_task.cancel()
+                await self.tokens.close()
+
+    async def _poll(self, session) -> float:
+        """
+        Polls the currently playing track once and returns how long to wait before the next poll.
+        """
+        try:
+            before_request = time.monotonic()
+            current_playing = await self._get_current_playing(session)
+            rtt = time.monotonic() - before_request
+            CURRENT_PLAYING_SECONDS.observe(rtt)
+            self.latency_model.record_spotify_rtt(rtt)
+            # Spotify's own timestamp is unreliable (https://github.com/spotify/web-api/issues/640),
+            # so assume the reported progress was sampled halfway through the round-trip
+            sampled_at = before_request + rtt / 2
+            if self.recorder is not None:
+                self.recorder.record_playing(current_playing, at=sampled_at)
+            if not current_playing.get('is_playing', False):
+                if self.current_track_id is not None:
+                    self.current_track_id = None
+                    self.clock.stop()
+                    self.poll_scheduler.record_change()
+                    await self.events_queue.put(EventStop())
+                self.poll_scheduler.record_success()
+                return self.poll_scheduler.next_delay(is_playing=False)
+
+            reported_progress = current_playing["progress_ms"] / 1000
+
+            if current_playing['item']['id'] != self.current_track_id:
+                detected_at = time.monotonic()
+                track_id = current_playing['item']['id']
+                song = self.prepared_songs.pop(track_id, None)
+                if song is not None:
+                    logger.debug(f"Using prefetched song {track_id}")
+                    analysis = song.analysis
+                else:
+                    analysis = await self._get_audio_analysis(session, track_id)
+                if self.recorder is not None:
+                    self.recorder.record_analysis(track_id, analysis)
+                self.current_track_id = track_id
+                self.poll_scheduler.record_change()
+                self.clock.reset(reported_progress, at=sampled_at)
+                self.current_progress = self.clock.position()
+                await self.events_queue.put(EventSongChanged(analysis, self.current_progress, track_id, song, detected_at))
+                self._start_prefetch(session)
+            else:
+                # Small deviations are filtered by the clock; only real seeks resync the lights
+                estimate = self.clock.position(at=sampled_at)
+                self.clock.update(reported_progress, at=sampled_at)
+                self.current_progress = self.clock.position()
+                if self.clock.seeked:
+                    logger.debug(f"Seek detected: {estimate:.2f}s -> {reported_progress:.2f}s")
+                    tracer.instant("seek", position=reported_progress)
+                    await self.events_queue.put(EventAdjustProgressTime(self.current_progress))
+                else:
+                    logger.trace(f"Progress {reported_progress:.3f}s, estimate {estimate:.3f}s, "
+                                 f"drift {self.clock.drift * 1000:+.1f}ms/s, confidence {self.clock.confidence:.2f}")
+            self.last_api_update_time = time.time()
+            self.poll_scheduler.record_success()
+            return self.poll_scheduler.next_delay(
+                is_playing=True,
+                progress=self.current_progress,
+                duration=current_playing['item']['duration_ms'] / 1000,
+            )
+        except RateLimitedError as e:
+            logger.warning(str(e))
+            RATE_LIMITED_ERRORS.inc()
+            self.poll_scheduler.record_failure(e.retry_after)
+        except UnauthorizedError as e:
+            logger.warning(str(e))
+            UNAUTHORIZED_ERRORS.inc()
+            self.poll_scheduler.record_failure()
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, TypeError, ValueError) as e:
+            logger.error(f"Failed to poll Spotify: {e!r}")
+            REQUEST_ERRORS.inc()
+            self.poll_scheduler.record_failure()
+        return self.poll_scheduler.next_delay(is_playing=self.current_track_id is not None)
+
+    def _start_prefetch(self, session):
+        if self._prefetch_task is not None and not self._prefetch_task.done():
+            self._prefetch_task.cancel()
+        self._prefetch_task = asyncio.create_task(self._prefetch_upcoming(session), name="prefetch")
+
+    async def _prefetch_upcoming(self, session):
+        """
+        Fetches and prepares the analyses of the next tracks in the user's playback queue.
+        """
+        try:
+            started = time.monotonic()
+            async with session.get(f"{self.api_base}{API_PLAYER_QUEUE}", headers=self.tokens.headers) as response:
+                self._check_rate_limit(response)
+                response.raise_for_status()
+                queue = (await response.json()).get('queue', [])
+            PLAYER_QUEUE_SECONDS.observe(time.monotonic() - started)
+
+            upcoming = [item['id'] for item in queue if item and item.get('type') == 'track'][:PREFETCH_TRACKS]
+            # Forget songs that are no longer coming up
+            for track_id in list(self.prepared_songs):
+                if track_id not in upcoming:
+                    del self.prepared_songs[track_id]
+
+            for track_id in upcoming:
+                if track_id in self.prepared_songs or track_id == self.current_track_id:
+                    continue
+                analysis = await self._get_audio_analysis(session, track_id)
+                self.prepared_songs[track_id] = await self.preparer.prepare(analysis, track_id)
+                logger.debug(f"Prefetched and prepared upcoming track {track_id}")
+        except RateLimitedError as e:
+            logger.warning(f"Skipping prefetch: {e}")
+            self.poll_scheduler.record_failure(e.retry_after)
+        except (UnauthorizedError, aiohttp.ClientError, asyncio.TimeoutError, KeyError, TypeError, ValueError) as e:
+            logger.warning(f"Failed to prefetch upcoming tracks: {e!r}")
 
     async def _get_current_playing(self, session):
-        async with session.get(API_CURRENT_PLAYING) as response:
+        with tracer.span("currently-playing request"):
+            return await self._request_current_playing(session)
+
+    async def _request_current_playing(self, session):
+        async with session.get(f"{self.api_base}{API_CURRENT_PLAYING}", headers=self.tokens.headers) as response:
+            self._check_rate_limit(response)
+            if response.status == 204:
+                # Nothing is playing
+                return {}
+            response.raise_for_status()
             return await response.json()
 
     async def _get_audio_analysis(self, session, track_id):
-        async with session.get(f"{API_AUDIO_ANALYSIS}{track_id}") as response:
-            return await response.json()
+        analysis = await self.analysis_cache.get(track_id)
+        if analysis is not None:
+            logger.debug(f"Audio analysis cache hit for {track_id} ({self.analysis_cache.stats()})")
+        else:
+            analysis = await self._download_audio_analysis(session, track_id)
+            await self.analysis_cache.put(track_id, analysis)
+        return analysis
+
+    async def _download_audio_analysis(self, session, track_id):
+        with tracer.span("analysis fetch", track_id=track_id):
+            return await self._stream_audio_analysis(session, track_id)
+
+    async def _stream_audio_analysis(self, session, track_id):
+        started = time.monotonic()
+        async with session.get(f"{self.api_base}{API_AUDIO_ANALYSIS}{track_id}", headers=self.tokens.headers) as response:
+            self._check_rate_limit(response)
+            response.raise_for_status()
+            # Parse the body as it arrives, keeping only the fields the effects use
+            parser = AnalysisStreamParser()
+            async for chunk in response.content.iter_chunked(ANALYSIS_STREAM_CHUNK_SIZE):
+                parser.feed(chunk)
+            analysis = parser.close()
+        AUDIO_ANALYSIS_SECONDS.observe(time.monotonic() - started)
+        return analysis
 
-    def _get_start_time(self, current_playing, request_time):
-        # spotify timestamp appears to be incorrect https://github.com/spotify/web-api/issues/640
-        return (request_time + time.time()) / 2 - current_playing['progress_ms'] / 1000
+    def _check_rate_limit(self, response):
+        if response.status == 401:
+            # The token expired or was revoked before the scheduled refresh
+            self.tokens.request_refresh()
+            raise UnauthorizedError("Spotify rejected the access token, refreshing it")
+        if response.status == 429:
+            retry_after = response.headers.get('Retry-After')
+            raise RateLimitedError(float(retry_after) if retry_after else None)
@@ -0,0 +1,106 @@
+import asyncio
+import os
+import types
+
+import numpy as np
+import pytest
+
+from analysis_cache import AnalysisCache, CACHE_SUFFIX
+from analysis_model import CompactAnalysis
+from metrics import registry, register_pipeline_gauges
+from playback_clock import PlaybackClock
+
+
+def make_analysis(tempo: float = 120.0) -> CompactAnalysis:
+    segment = {"start": 0.0, "duration": 0.5, "confidence": 0.5, "loudness_start": -20.0, "loudness_max_time": 0.1,
+               "loudness_max": -10.0, "loudness_end": -25.0, "pitches": [0.5] * 12, "timbre": [1.0] * 12}
+    return CompactAnalysis.from_raw({
+        "track": {"duration": 0.5, "tempo": tempo},
+        "segments": [segment],
+        "bars": [{"start": 0.0, "duration": 0.5, "confidence": 0.9}],
+    })
+
+
+def test_memory_tier_evicts_least_recently_used():
+    async def main():
+        cache = AnalysisCache(cache_dir=None, memory_items=2)
+        await cache.put("a", make_analysis(1))
+        await cache.put("b", make_analysis(2))
+        assert (await cache.get("a")).tempo == 1
+        await cache.put("c", make_analysis(3))
+        assert await cache.get("b") is None
+        assert (await cache.get("a")).tempo == 1
+        assert (await cache.get("c")).tempo == 3
+        assert cache.stats() == {"memory_hits": 3, "disk_hits": 0, "misses": 1, "memory_items": 2}
+
+    asyncio.run(main())
+
+
+def test_disk_round_trip(tmp_path):
+    async def main():
+        analysis = make_analysis()
+        await AnalysisCache(cache_dir=str(tmp_path)).put("track1", analysis)
+        assert os.listdir(tmp_path) == [f"track1{CACHE_SUFFIX}"]
+
+        cache = AnalysisCache(cache_dir=str(tmp_path))
+        cached = await cache.get("track1")
+        assert cache.disk_hits == 1
+        assert cached.tempo == analysis.tempo
+        np.testing.assert_array_equal(cached.segments.timbre, analysis.segments.timbre)
+        np.testing.assert_array_equal(cached.bars, analysis.bars)
+        # Served from memory from now on
+        await cache.get("track1")
+        assert cache.memory_hits == 1
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("corrupt", [lambda data: data[:-1] + bytes([data[-1] ^ 1]), lambda data: b"junk" + data[4:]])
+def test_corrupted_entry_is_rejected_and_removed(tmp_path, corrupt):
+    async def main():
+        await AnalysisCache(cache_dir=str(tmp_path)).put("track1", make_analysis())
+        path = tmp_path / f"track1{CACHE_SUFFIX}"
+        path.write_bytes(corrupt(path.read_bytes()))
+
+        cache = AnalysisCache(cache_dir=str(tmp_path))
+        assert await cache.get("track1") is None
+        assert cache.misses == 1
+        assert not path.exists()
+
+    asyncio.run(main())
+
+
+def test_disk_tier_evicts_oldest_files_over_the_size_limit(tmp_path):
+    async def main():
+        size = len(make_analysis().to_bytes()) + 64
+        cache = AnalysisCache(cache_dir=str(tmp_path), max_bytes=2 * size)
+        for index, track_id in enumerate(("a", "b", "c")):
+            await cache.put(track_id, make_analysis())
+            # Modification times order the eviction
+            os.utime(tmp_path / f"{track_id}{CACHE_SUFFIX}", (index, index))
+        await cache.put("d", make_analysis())
+        assert sorted(os.listdir(tmp_path)) == [f"{track_id}{CACHE_SUFFIX}" for track_id in ("c", "d")]
+
+    asyncio.run(main())
+
+
+def test_invalid_track_id_is_refused(tmp_path):
+    with pytest.raises(ValueError):
+        asyncio.run(AnalysisCache(cache_dir=str(tmp_path)).get("../etc/passwd"))
+
+
+def test_counts_are_exported_as_metrics():
+    async def main():
+        cache = AnalysisCache(cache_dir=None)
+        await cache.put("a", make_analysis())
+        await cache.get("a")
+        await cache.get("b")
+        listener = types.SimpleNamespace(current_track_id=None, analysis_cache=cache)
+        register_pipeline_gauges(asyncio.Queue(), PlaybackClock(), listener, [])
+        return registry.render()
+
+    text = asyncio.run(main())
+    assert 'emyee_analysis_cache_hits_total{tier="memory"} 1.0' in text
+    assert 'emyee_analysis_cache_hits_total{tier="disk"} 0.0' in text
+    assert "emyee_analysis_cache_misses_total 1.0" in text
+    assert "emyee_analysis_cache_memory_items 1.0" in text
@@ -0,0 +1,93 @@
+import json
+import random
+import string
+
+import numpy as np
+import pytest
+
+from analysis_model import CompactAnalysis, EVENT_KINDS
+from analysis_stream import AnalysisStreamParser, COMPACT_THRESHOLD
+from preprocessing import SEGMENT_FIELDS
+
+
+def make_raw_analysis(segments: int = 600, codestring_size: int = 400_000, seed: int = 0):
+    rng = random.Random(seed)
+    start = 0.0
+    raw_segments = []
+    for _ in range(segments):
+        duration = rng.uniform(0.05, 0.5)
+        raw_segments.append({
+            "start": start, "duration": duration, "confidence": rng.random(),
+            "loudness_start": rng.uniform(-40, -5), "loudness_max_time": rng.uniform(0, duration),
+            "loudness_max": rng.uniform(-30, 0), "loudness_end": rng.uniform(-40, -5),
+            "pitches": [rng.random() for _ in range(12)], "timbre": [rng.uniform(-50, 50) for _ in range(12)],
+        })
+        start += duration
+    events = {kind: [{"start": i * 0.5, "duration": 0.5, "confidence": rng.random()} for i in range(int(start / 0.5))]
+              for kind in EVENT_KINDS}
+    # Real codestrings are base64; escapes and non-ASCII characters check the string scanning
+    alphabet = string.ascii_letters + string.digits + '+/= "\\é'
+    codestring = "".join(rng.choice(alphabet) for _ in range(codestring_size))
+    return {
+        "meta": {"analyzer_version": "4.0.0", "detailed_status": 'OK, "fine"'},
+        "track": {"num_samples": 1, "duration": start, "codestring": codestring, "tempo_confidence": 0.5,
+                  "echoprintstring": codestring[:codestring_size // 2], "tempo": 123.5,
+                  "nested": {"duration": 99, "tempo": [1, {"tempo": 2}]}},
+        "segments": raw_segments,
+        **events,
+    }
+
+
+def parse_in_chunks(body: bytes, size: int) -> AnalysisStreamParser:
+    parser = AnalysisStreamParser()
+    for offset in range(0, len(body), size):
+        parser.feed(body[offset:offset + size])
+        # Skipped text is dropped as it is scanned, even inside the unfinished track object
+        assert len(parser._buffer) <= COMPACT_THRESHOLD + 2 * size + 1024
+    return parser
+
+
+def assert_same(analysis: CompactAnalysis, expected: CompactAnalysis):
+    assert analysis.duration == expected.duration
+    assert analysis.tempo == expected.tempo
+    for field in SEGMENT_FIELDS:
+        np.testing.assert_array_equal(getattr(analysis.segments, field), getattr(expected.segments, field))
+    np.testing.assert_array_equal(analysis.segments.pitches, expected.segments.pitches)
+    np.testing.assert_array_equal(analysis.segments.timbre, expected.segments.timbre)
+    for kind in EVENT_KINDS:
+        np.testing.assert_array_equal(analysis[kind], expected[kind])
+
+
+@pytest.mark.parametrize("chunk_size", [1024, 4096, 65536])
+def test_matches_from_raw_with_large_track_in_small_chunks(chunk_size):
+    raw = make_raw_analysis()
+    body = json.dumps(raw, ensure_ascii=False).encode()
+    analysis = parse_in_chunks(body, chunk_size).close()
+    assert_same(analysis, CompactAnalysis.from_raw(raw))
+    assert analysis.tempo == 123.5
+
+
+def test_chunks_split_escapes_and_multibyte_characters():
+    raw = make_raw_analysis(segments=20, codestring_size=2000, seed=1)
+    body = json.dumps(raw, ensure_ascii=False).encode()
+    assert_same(parse_in_chunks(body, 3).close(), CompactAnalysis.from_raw(raw))
+
+
+def test_truncated_response_raises():
+    body = json.dumps(make_raw_analysis(segments=20, codestring_size=100)).encode()
+    parser = parse_in_chunks(body[:len(body) // 2], 512)
+    with pytest.raises(ValueError):
+        parser.close()
+
+
+@pytest.mark.parametrize("tempo", [-7.5, 1.25e2, -3e-05])
+def test_one_byte_chunks_split_every_scalar(tempo):
+    raw = make_raw_analysis(segments=10, codestring_size=300, seed=2)
+    raw["track"]["tempo"] = tempo
+    raw["track"]["duration"] = -raw["track"]["duration"]
+    # Top-level scalars are skipped, and may be cut anywhere too
+    raw = {"version": -1, "ratio": -2.5e-3, "ok": True, "failed": False, "error": None, **raw}
+    body = json.dumps(raw).encode()
+    analysis = parse_in_chunks(body, 1).close()
+    assert_same(analysis, CompactAnalysis.from_raw(raw))
+    assert analysis.tempo == tempo
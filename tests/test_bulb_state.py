@@ -0,0 +1,87 @@
+import pytest
+
+from bulb_state import BulbState
+from command_queue import DeviceCommand
+from utils import BRIGHTNESS_THRESHOLD, BULB_NOTIFICATION_GRACE, HUE_THRESHOLD, SATURATION_THRESHOLD
+from yeelight_transport import hsv_to_yeelight_rgb
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr("bulb_state.time", fake)
+    return fake
+
+
+def known_state(**kwargs) -> BulbState:
+    state = BulbState(**kwargs)
+    state.apply(DeviceCommand("color", brightness=50, hue=200, saturation=80))
+    return state
+
+
+def test_unknown_state_sends_everything():
+    command = DeviceCommand("color", brightness=50, hue=200, saturation=80)
+    assert BulbState().reduce(command) == command
+    assert BulbState().reduce(DeviceCommand("power", power=True)).power is True
+
+
+def test_changes_below_the_thresholds_are_suppressed():
+    state = known_state()
+    assert state.reduce(DeviceCommand("brightness", brightness=50 + BRIGHTNESS_THRESHOLD - 1)) is None
+    assert state.reduce(DeviceCommand("brightness", brightness=50 + BRIGHTNESS_THRESHOLD)) is not None
+    assert state.reduce(DeviceCommand("color", brightness=50, hue=200 + HUE_THRESHOLD - 1,
+                                      saturation=80 - SATURATION_THRESHOLD + 1)) is None
+    assert state.reduce(DeviceCommand("color", brightness=50, hue=200 + HUE_THRESHOLD, saturation=80)) is not None
+    assert state.reduce(DeviceCommand("color", brightness=50, hue=200, saturation=80 + SATURATION_THRESHOLD)) is not None
+
+
+def test_hue_distance_wraps_around():
+    state = BulbState()
+    state.apply(DeviceCommand("color", brightness=50, hue=359, saturation=80))
+    assert state.reduce(DeviceCommand("color", brightness=50, hue=1, saturation=80)) is None
+
+
+def test_commands_are_reduced_to_the_part_that_changes():
+    state = known_state()
+    only_brightness = state.reduce(DeviceCommand("color", brightness=90, hue=201, saturation=80))
+    assert (only_brightness.kind, only_brightness.brightness, only_brightness.hue) == ("brightness", 90, None)
+    only_color = state.reduce(DeviceCommand("color", brightness=50, hue=20, saturation=80))
+    assert (only_color.kind, only_color.brightness, only_color.hue) == ("color", None, 20)
+    white = known_state(supports_color=False).reduce(DeviceCommand("color", brightness=90, hue=20, saturation=80))
+    assert (white.kind, white.hue) == ("brightness", None)
+    assert known_state().reduce(DeviceCommand("power", power=None)) is None
+
+
+def test_notifications_are_ignored_right_after_a_command(clock):
+    state = known_state()
+    state.update_from_props({"bright": "10"})
+    assert state.brightness == 50
+
+    clock.now += BULB_NOTIFICATION_GRACE
+    state.update_from_props({"bright": "10", "power": "off"})
+    assert (state.brightness, state.power) == (10, False)
+    state.update_from_props({"ct": "4000"})
+    assert state.hue is None
+
+
+def test_rgb_notifications_read_back_the_hue_that_was_sent(clock):
+    state = BulbState()
+    clock.now += BULB_NOTIFICATION_GRACE
+    for hue in range(360):
+        state.update_from_props({"rgb": str(hsv_to_yeelight_rgb(hue, 100))})
+        assert (state.hue, state.saturation) == (hue, 100)
+
+
+def test_unreadable_notifications_invalidate_the_state(clock):
+    state = known_state()
+    clock.now += BULB_NOTIFICATION_GRACE
+    state.update_from_props({"bright": "bright"})
+    assert state.brightness is None
@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+from command_queue import CommandQueue, DeviceCommand
+from fake_bulb import FakeBulb
+from yeelight_transport import YeelightTransport
+
+
+async def wait_for_commands(bulb: FakeBulb, count: int, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while len(bulb.received) < count:
+        assert time.monotonic() < deadline, f"Bulb got {len(bulb.received)} of {count} command(s)"
+        await asyncio.sleep(0.01)
+
+
+def sent_commands(bulb: FakeBulb):
+    # Leave out the music mode handshake
+    return [command for _, command in bulb.received if command["method"] != "set_music"]
+
+
+def run_with_queue(test, rate: float = 20):
+    async def main():
+        bulb = FakeBulb()
+        await bulb.start()
+        transport = YeelightTransport(bulb.host, bulb.port)
+        await transport.connect()
+        queue = CommandQueue(transport, rate=rate)
+        try:
+            await test(bulb, queue)
+        finally:
+            await queue.close()
+            await transport.close()
+            await bulb.stop()
+
+    asyncio.run(main())
+
+
+def test_brightness_is_folded_into_pending_color_keeping_the_fade():
+    async def test(bulb, queue):
+        queue.submit(DeviceCommand("color", duration=2.0, brightness=40, hue=120, saturation=80))
+        queue.submit(DeviceCommand("brightness", duration=0.3, brightness=70))
+        await wait_for_commands(bulb, 2)
+        await asyncio.sleep(0.1)
+        commands = sent_commands(bulb)
+        assert [command["method"] for command in commands] == ["start_cf"]
+        duration, _, _, brightness = commands[0]["params"][2].split(",")
+        assert (int(duration), int(brightness)) == (2000, 70)
+        assert queue.stats()["coalesced"] == 1
+
+    run_with_queue(test)
+
+
+def test_longer_brightness_transition_extends_pending_color():
+    async def test(bulb, queue):
+        queue.submit(DeviceCommand("color", duration=0.5, brightness=40, hue=120, saturation=80))
+        queue.submit(DeviceCommand("brightness", duration=1.5, brightness=70))
+        await wait_for_commands(bulb, 2)
+        assert sent_commands(bulb)[0]["params"][2].startswith("1500,")
+
+    run_with_queue(test)
+
+
+def test_pending_brightness_is_merged_into_a_newer_color():
+    async def test(bulb, queue):
+        queue.submit(DeviceCommand("brightness", duration=0.5, brightness=70))
+        queue.submit(DeviceCommand("color", duration=1.0, hue=240, saturation=100))
+        await wait_for_commands(bulb, 2)
+        await asyncio.sleep(0.1)
+        commands = sent_commands(bulb)
+        assert len(commands) == 1
+        assert commands[0]["params"][2].endswith(",70")
+
+    run_with_queue(test)
+
+
+def test_newer_commands_of_the_same_kind_replace_pending_ones():
+    async def test(bulb, queue):
+        for brightness in (10, 30, 50, 70):
+            queue.submit(DeviceCommand("brightness", duration=0.5, brightness=brightness))
+        await wait_for_commands(bulb, 2)
+        await asyncio.sleep(0.1)
+        assert [command["params"][0] for command in sent_commands(bulb)] == [70]
+        assert queue.stats()["dropped"] == 3
+        assert queue.stats()["sent"] == 1
+
+    run_with_queue(test)
+
+
+def test_output_is_paced_to_the_rate():
+    async def test(bulb, queue):
+        started = time.monotonic()
+        brightness = 1
+        while time.monotonic() - started < 0.5:
+            brightness = brightness % 90 + 10
+            queue.submit(DeviceCommand("brightness", duration=0.5, brightness=brightness))
+            await asyncio.sleep(0.005)
+        await asyncio.sleep(0.1)
+        times = [at for at, command in bulb.received if command["method"] != "set_music"]
+        # At most one command per 1/rate seconds, the rest were replaced while waiting
+        assert 5 <= len(times) <= 0.6 * 20 + 1
+        assert min(b - a for a, b in zip(times, times[1:])) > 1 / 20 * 0.8
+        assert queue.stats()["dropped"] > 0
+
+    run_with_queue(test, rate=20)
+
+
+def test_commands_the_bulb_already_has_are_suppressed():
+    async def test(bulb, queue):
+        queue.submit(DeviceCommand("brightness", duration=0.5, brightness=50))
+        await wait_for_commands(bulb, 2)
+        queue.submit(DeviceCommand("brightness", duration=0.5, brightness=51))
+        await asyncio.sleep(0.2)
+        assert len(sent_commands(bulb)) == 1
+        assert queue.stats()["suppressed"] == 1
+
+    run_with_queue(test)
@@ -0,0 +1,67 @@
+import asyncio
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+
+from analysis_model import CompactAnalysis
+from device_groups import GroupBroadcaster, assign_devices, shard_groups
+from frame_renderer import FrameRenderer
+from models import DeviceGroup, EventAdjustProgressTime, EventSongChanged
+from playback_clock import PlaybackClock
+from test_song_compiler import make_raw_analysis
+from utils import DEFAULT_GROUP_NAME
+
+
+def make_devices(count: int):
+    return [SimpleNamespace(name=f"192.168.1.{20 + index}", supports_color=True) for index in range(count)]
+
+
+def test_split_default_group_keeps_the_layout_of_the_whole_group():
+    devices = make_devices(7)
+    groups = [DeviceGroup("desk", ["192.168.1.20"], worker=1), DeviceGroup(DEFAULT_GROUP_NAME, hue_spread=120, wave_delay=0.6)]
+    shards = shard_groups(assign_devices(groups, devices), 3)
+    parts = [(group, group_devices) for shard in shards for group, group_devices in shard
+             if group.name.startswith(DEFAULT_GROUP_NAME)]
+    assert len(parts) == 3
+
+    whole = FrameRenderer(devices[1:], hue_spread=120, wave_delay=0.6)
+    hue_offsets = dict(zip((device.name for device in devices[1:]), whole.hue_offsets))
+    time_offsets = dict(zip((device.name for device in devices[1:]), whole.time_offsets))
+    for group, group_devices in parts:
+        renderer = FrameRenderer(group_devices, group.hue_spread, group.wave_delay, group.positions)
+        assert list(renderer.hue_offsets) == [hue_offsets[device.name] for device in group_devices]
+        np.testing.assert_allclose(renderer.time_offsets, [time_offsets[device.name] for device in group_devices])
+    # Groups that are not split are laid out on their own
+    desk = next(group for shard in shards for group, _ in shard if group.name == "desk")
+    assert desk.positions is None
+
+
+class FakeWorker:
+    def __init__(self):
+        self.messages = []
+
+    def send(self, payload: bytes):
+        self.messages.append(pickle.loads(payload))
+
+
+def test_songs_are_prepared_once_for_all_workers():
+    async def main():
+        events_queue, local_queue = asyncio.Queue(), asyncio.Queue()
+        workers = [FakeWorker(), FakeWorker()]
+        broadcaster = GroupBroadcaster(events_queue, PlaybackClock(), [local_queue], workers, sync_interval=60)
+        task = asyncio.create_task(broadcaster.run())
+        analysis = CompactAnalysis.from_raw(make_raw_analysis())
+        await events_queue.put(EventSongChanged(analysis, 0.0, "4uLU6hMCjMI75M1A2tKUQC"))
+        await events_queue.put(EventAdjustProgressTime(5.0))
+        await events_queue.join()
+        task.cancel()
+        return local_queue.get_nowait(), workers
+
+    local_event, workers = asyncio.run(main())
+    assert local_event.song is not None
+    for worker in workers:
+        (kind, event), (_, seek) = [message for message in worker.messages if message[0] == "event"]
+        assert kind == "event" and isinstance(seek, EventAdjustProgressTime)
+        np.testing.assert_array_equal(event.song.show.times, local_event.song.show.times)
+        np.testing.assert_array_equal(event.song.show.hue, local_event.song.show.hue)
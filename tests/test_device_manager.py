@@ -0,0 +1,29 @@
+import asyncio
+import time
+
+import pytest
+
+from device_manager import DeviceManager
+from device_registry import DeviceRegistry
+from fake_bulb import FakeBulb
+from models import Device
+
+
+@pytest.mark.parametrize("auto_on", [False, True])
+def test_auto_on_turns_bulbs_on_when_connecting(tmp_path, auto_on):
+    async def main():
+        bulb = FakeBulb()
+        bulb.properties["power"] = "off"
+        await bulb.start()
+        manager = DeviceManager(auto_on=auto_on, registry=DeviceRegistry(str(tmp_path / "devices.json")))
+        devices = await manager.initialize_devices([Device(bulb.host, bulb.port, bulb.model)])
+        deadline = time.monotonic() + 1.0
+        while auto_on and bulb.properties["power"] == "off" and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.05)
+        for device in devices:
+            await device.close()
+        await bulb.stop()
+        return len(devices), bulb.properties["power"]
+
+    assert asyncio.run(main()) == (1, "on" if auto_on else "off")
@@ -0,0 +1,101 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from frame_renderer import FrameRenderer
+from song_compiler import ENTRY_BRIGHTNESS, ENTRY_COLOR, CompiledShow
+
+
+def make_devices(count: int, supports_color: bool = True):
+    return [SimpleNamespace(name=f"192.168.1.{20 + index}", supports_color=supports_color) for index in range(count)]
+
+
+def make_show():
+    # A color change at 1s, a brightness change at 2s and another color change at 3s
+    return CompiledShow(
+        times=np.array([1.0, 2.0, 3.0]),
+        kinds=np.array([ENTRY_COLOR, ENTRY_BRIGHTNESS, ENTRY_COLOR], dtype=np.uint8),
+        durations=np.array([1.0, 0.5, 1.0], dtype=np.float32),
+        brightness=np.array([40, 80, 80], dtype=np.uint8),
+        hue=np.array([300, 300, 120], dtype=np.uint16),
+        saturation=np.array([100, 100, 80], dtype=np.uint8),
+    )
+
+
+def make_renderer(devices, hue_spread: int = 90, wave_delay: float = 0.4):
+    renderer = FrameRenderer(devices, hue_spread=hue_spread, wave_delay=wave_delay)
+    renderer.load(make_show())
+    return renderer
+
+
+def positions_at(renderer, progress: float):
+    return renderer.positions(progress, np.zeros(len(renderer.devices)), 1.0)
+
+
+def test_hues_and_delays_spread_along_the_devices():
+    renderer = make_renderer(make_devices(4))
+    np.testing.assert_array_equal(renderer.hue_offsets, [0, 30, 60, 90])
+    np.testing.assert_allclose(renderer.time_offsets, [0, 0.4 / 3, 0.8 / 3, 0.4])
+
+    frame = renderer.render(positions_at(renderer, 1.0))
+    # The change ripples from the first bulb, the others are not there yet
+    np.testing.assert_array_equal(frame.devices, [0])
+    frame = renderer.render(positions_at(renderer, 1.45))
+    np.testing.assert_array_equal(frame.devices, [1, 2, 3])
+    # Hues wrap around
+    np.testing.assert_array_equal(frame.hue, [330, 0, 30])
+    assert frame.full_state.all()
+
+
+def test_single_device_has_no_offsets():
+    renderer = make_renderer(make_devices(1))
+    np.testing.assert_array_equal(renderer.hue_offsets, [0])
+    np.testing.assert_array_equal(renderer.time_offsets, [0])
+
+
+def test_brightness_changes_leave_the_color_alone():
+    renderer = make_renderer(make_devices(2), wave_delay=0.0)
+    renderer.render(positions_at(renderer, 1.0))
+    frame = renderer.render(positions_at(renderer, 2.0))
+    np.testing.assert_array_equal(frame.devices, [0, 1])
+    np.testing.assert_array_equal(frame.brightness, [80, 80])
+    assert not frame.full_state.any()
+    # Nothing is due until the next entry
+    assert len(renderer.render(positions_at(renderer, 2.5))) == 0
+    assert renderer.time_to_next(positions_at(renderer, 2.5)) == 0.5
+
+
+def test_entries_due_together_collapse_and_seeks_resync():
+    renderer = make_renderer(make_devices(2), wave_delay=0.0)
+    frame = renderer.render(positions_at(renderer, 3.5))
+    np.testing.assert_array_equal(frame.index, [2, 2])
+    np.testing.assert_array_equal(frame.hue, [120, 210])
+    assert frame.full_state.all()
+
+    frame = renderer.render(positions_at(renderer, 1.5), resync=True)
+    np.testing.assert_array_equal(frame.index, [0, 0])
+    np.testing.assert_array_equal(frame.hue, [300, 30])
+    np.testing.assert_array_equal(frame.brightness, [40, 40])
+
+
+def test_white_bulbs_only_get_brightness():
+    renderer = make_renderer(make_devices(2, supports_color=False), wave_delay=0.0)
+    frame = renderer.render(positions_at(renderer, 1.0))
+    assert not frame.full_state.any()
+    np.testing.assert_array_equal(frame.brightness, [40, 40])
+
+
+def test_devices_added_later_are_laid_out_again_and_catch_up():
+    devices = make_devices(2)
+    renderer = make_renderer(devices)
+    renderer.render(positions_at(renderer, 1.5))
+    devices.extend(make_devices(3)[2:])
+
+    positions = positions_at(renderer, 1.5)
+    np.testing.assert_array_equal(renderer.hue_offsets, [0, 45, 90])
+    np.testing.assert_allclose(renderer.time_offsets, [0, 0.2, 0.4])
+    frame = renderer.render(positions)
+    # Only the new bulb gets the state the others already have
+    np.testing.assert_array_equal(frame.devices, [2])
+    np.testing.assert_array_equal(frame.hue, [30])
+    assert renderer.rendered.all()
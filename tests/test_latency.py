@@ -0,0 +1,24 @@
+import json
+import pickle
+
+from latency import LatencyModel
+from utils import LATENCY_MIN_SAMPLES
+
+
+def test_worker_samples_are_merged_into_the_saved_profile(tmp_path):
+    worker = LatencyModel(path=None)
+    for index in range(LATENCY_MIN_SAMPLES):
+        worker.record_device_latency("192.168.1.20", 0.05 + index * 0.001)
+    worker.record_device_latency("192.168.1.21", 0.2)
+
+    model = LatencyModel(path=str(tmp_path / "latency.json"))
+    # As sent back over the worker's pipe
+    model.record_device_samples(pickle.loads(pickle.dumps(worker.device_samples())))
+
+    assert model.device_samples() == worker.device_samples()
+    assert model.lead_time("192.168.1.20") == worker.lead_time("192.168.1.20")
+    assert model.lead_time("192.168.1.21") == model.default_lead
+    model.save()
+    profile = json.loads((tmp_path / "latency.json").read_text())
+    assert profile["devices"]["192.168.1.20"]["count"] == LATENCY_MIN_SAMPLES
+    assert profile["devices"]["192.168.1.21"]["count"] == 1
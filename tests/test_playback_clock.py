@@ -0,0 +1,59 @@
+import pytest
+
+from playback_clock import PlaybackClock
+
+
+def make_clock(**kwargs) -> PlaybackClock:
+    clock = PlaybackClock(**kwargs)
+    clock.reset(10.0, at=100.0)
+    return clock
+
+
+def test_small_deviations_are_filtered_not_seeks():
+    clock = make_clock()
+    corrected = clock.update(12.2, at=102.0)
+    assert not clock.seeked
+    # The position only moves part of the way towards the report
+    assert clock.position(at=102.0) == pytest.approx(12.0 + clock.position_gain * 0.2)
+    assert clock.rate > 1.0
+    assert corrected
+
+
+def test_jumps_forward_and_backward_are_seeks():
+    clock = make_clock()
+    clock.rate = 1.01
+    assert clock.update(60.0, at=102.0)
+    assert clock.seeked
+    assert clock.position(at=102.0) == 60.0
+    # The drift estimate survives the seek
+    assert clock.rate == 1.01
+
+    assert clock.update(5.0, at=103.0)
+    assert clock.seeked
+    assert clock.position(at=103.0) == 5.0
+
+
+def test_seek_threshold_is_configurable():
+    clock = make_clock(seek_threshold=2.0)
+    clock.update(13.5, at=102.0)
+    assert not clock.seeked
+    clock.update(30.0, at=103.0)
+    assert clock.seeked
+
+
+def test_seek_notifies_listeners_and_next_update_clears_flag():
+    clock = make_clock()
+    notified = []
+    clock.add_listener(lambda: notified.append(clock.version))
+    clock.update(60.0, at=102.0)
+    assert notified == [clock.version]
+    clock.update(61.0, at=103.0)
+    assert not clock.seeked
+
+
+def test_update_while_stopped_resets():
+    clock = PlaybackClock()
+    assert clock.position() is None
+    assert clock.update(42.0, at=100.0)
+    assert not clock.seeked
+    assert clock.position(at=101.0) == 43.0
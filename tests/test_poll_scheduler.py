@@ -0,0 +1,66 @@
+import types
+
+import pytest
+
+import poll_scheduler
+from poll_scheduler import PollScheduler
+from utils import API_BACKOFF_BASE, API_BACKOFF_MAX
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = types.SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(poll_scheduler, "time", types.SimpleNamespace(monotonic=lambda: now.value))
+    return now
+
+
+def make_scheduler() -> PollScheduler:
+    return PollScheduler(fast_interval=0.25, slow_interval=2.0, paused_interval=3.0, fast_window=5.0)
+
+
+def test_polls_slowly_mid_track_and_while_paused(clock):
+    scheduler = make_scheduler()
+    assert scheduler.next_delay(True, progress=60, duration=200) == 2.0
+    assert scheduler.next_delay(False) == 3.0
+
+
+def test_polls_fast_right_after_a_change(clock):
+    scheduler = make_scheduler()
+    scheduler.record_change()
+    clock.value += 4.9
+    assert scheduler.next_delay(True, progress=60, duration=200) == 0.25
+    clock.value += 0.2
+    assert scheduler.next_delay(True, progress=60, duration=200) == 2.0
+
+
+def test_polls_fast_near_the_end_and_never_sleeps_into_that_window(clock):
+    scheduler = make_scheduler()
+    assert scheduler.next_delay(True, progress=196, duration=200) == 0.25
+    # 5.5 s left: sleep only until the fast window starts
+    assert scheduler.next_delay(True, progress=194.5, duration=200) == pytest.approx(0.5)
+    assert scheduler.next_delay(True, progress=194.9, duration=200) == 0.25
+
+
+def test_backs_off_exponentially_up_to_the_maximum(clock):
+    scheduler = make_scheduler()
+    for failures in range(1, 10):
+        scheduler.record_failure()
+        expected = min(API_BACKOFF_BASE * 2 ** (failures - 1), API_BACKOFF_MAX)
+        assert scheduler.next_delay(True, progress=60, duration=200) == expected
+    # The backoff applies even while paused, and counts down
+    clock.value += 10
+    assert scheduler.next_delay(False) == API_BACKOFF_MAX - 10
+
+    scheduler.record_success()
+    clock.value += API_BACKOFF_MAX
+    assert scheduler.next_delay(True, progress=60, duration=200) == 2.0
+    scheduler.record_failure()
+    assert scheduler.next_delay(True, progress=60, duration=200) == API_BACKOFF_BASE
+
+
+def test_retry_after_extends_the_backoff(clock):
+    scheduler = make_scheduler()
+    scheduler.record_failure(retry_after=30)
+    assert scheduler.next_delay(True, progress=60, duration=200) == 30
+    scheduler.record_failure(retry_after=0.1)
+    assert scheduler.next_delay(True, progress=60, duration=200) == 2 * API_BACKOFF_BASE
@@ -0,0 +1,74 @@
+import random
+
+import numpy as np
+import pytest
+
+from preprocessing import SegmentArrays, SEGMENT_FIELDS, merge_short_segments_arrays
+from utils import MIN_SEGMENT_DURATION, merge_short_segments
+
+
+def make_segments(count: int = 2000, seed: int = 0, resolution=None):
+    rng = random.Random(seed)
+    segments, start = [], 0.0
+    for _ in range(count):
+        duration = rng.uniform(0.03, 0.5)
+        if resolution:
+            # Spotify's fixed decimals make consecutive segments add up to exactly MIN_SEGMENT_DURATION
+            duration = max(1, round(duration / resolution)) * resolution
+        segments.append({
+            "start": start, "duration": duration, "confidence": rng.random(),
+            "loudness_start": rng.uniform(-40, -5), "loudness_max_time": rng.uniform(0, duration),
+            "loudness_max": rng.uniform(-30, 0), "loudness_end": rng.uniform(-40, -5),
+            "pitches": [rng.random() for _ in range(12)], "timbre": [rng.uniform(-50, 50) for _ in range(12)],
+        })
+        start += duration
+    return segments
+
+
+@pytest.mark.parametrize("resolution", [None, 0.01, 0.001])
+@pytest.mark.parametrize("seed", range(10))
+def test_arrays_merge_like_dicts(seed, resolution):
+    segments = make_segments(seed=seed, resolution=resolution)
+    expected = SegmentArrays.from_segments(merge_short_segments(segments))
+    merged = merge_short_segments_arrays(SegmentArrays.from_segments(segments))
+    assert len(merged) == len(expected)
+    for field in SEGMENT_FIELDS:
+        np.testing.assert_allclose(getattr(merged, field), getattr(expected, field), rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(merged.pitches, expected.pitches, rtol=1e-5, atol=1e-5)
+    np.testing.assert_allclose(merged.timbre, expected.timbre, rtol=1e-5, atol=1e-5)
+
+
+def test_groups_adding_up_to_min_duration_are_not_merged_further():
+    # 0.1 + 0.2 is 0.30000000000000004 in floats, 0.3 - 0.1 is 0.19999999999999998
+    durations = [0.1, 0.2, 0.3 - 0.1, 0.1, 0.5]
+    segments = make_segments(count=len(durations))
+    start = 0.0
+    for segment, duration in zip(segments, durations):
+        segment["start"], segment["duration"] = start, duration
+        start += duration
+    merged = merge_short_segments_arrays(SegmentArrays.from_segments(segments), min_duration=0.3)
+    assert len(merged) == len(merge_short_segments(segments, min_duration=0.3)) == 3
+    np.testing.assert_allclose(merged.duration, [0.3, 0.3, 0.5])
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_groups_on_the_boundary_follow_the_sequential_sums(seed):
+    # Decimal durations often add up to about min_duration, deep into a long song where the
+    # cumulative sum has lost the precision to tell which side of it they fall on
+    rng = random.Random(seed)
+    segments = make_segments(count=5000, seed=seed)
+    start = 0.0
+    for segment in segments:
+        segment["start"], segment["duration"] = start, rng.choice((0.05, 0.07, 0.1, 0.13, 0.15, 0.2, 0.3 - 0.1))
+        start += segment["duration"]
+    expected = merge_short_segments(segments)
+    merged = merge_short_segments_arrays(SegmentArrays.from_segments(segments))
+    assert len(merged) == len(expected)
+    np.testing.assert_array_equal(merged.start, [segment["start"] for segment in expected])
+    np.testing.assert_allclose(merged.duration, [segment["duration"] for segment in expected], rtol=0, atol=1e-12)
+
+
+def test_empty_segments():
+    merged = merge_short_segments_arrays(SegmentArrays.from_segments([]), MIN_SEGMENT_DURATION)
+    assert len(merged) == 0
+    assert merged.pitches.shape == (0, 12)
@@ -0,0 +1,90 @@
+import asyncio
+import time
+
+from scheduler import DeadlineScheduler
+
+
+def run_scheduler(test):
+    async def main():
+        scheduler = DeadlineScheduler()
+        task = asyncio.create_task(scheduler.run())
+        try:
+            await test(scheduler)
+        finally:
+            task.cancel()
+
+    asyncio.run(main())
+
+
+def test_timers_fire_in_deadline_order():
+    async def test(scheduler):
+        fired = []
+        now = time.monotonic()
+        for delay in (0.06, 0.02, 0.04, 0.0):
+            scheduler.call_at(now + delay, lambda delay=delay: fired.append((delay, time.monotonic() - now)))
+        await asyncio.sleep(0.1)
+        assert [delay for delay, _ in fired] == [0.0, 0.02, 0.04, 0.06]
+        # Never early
+        assert all(at >= delay for delay, at in fired)
+
+    run_scheduler(test)
+
+
+def test_same_deadline_keeps_insertion_order():
+    async def test(scheduler):
+        fired = []
+        deadline = time.monotonic() + 0.01
+        for index in range(5):
+            scheduler.call_at(deadline, lambda index=index: fired.append(index))
+        await asyncio.sleep(0.05)
+        assert fired == list(range(5))
+
+    run_scheduler(test)
+
+
+def test_earlier_timer_added_while_sleeping_wakes_the_loop():
+    async def test(scheduler):
+        fired = []
+        scheduler.call_later(10.0, lambda: fired.append("late"))
+        await asyncio.sleep(0.01)
+        scheduler.call_later(0.01, lambda: fired.append("early"))
+        await asyncio.sleep(0.05)
+        assert fired == ["early"]
+
+    run_scheduler(test)
+
+
+def test_cancelled_timers_do_not_fire():
+    async def test(scheduler):
+        fired = []
+        first = scheduler.call_later(0.01, lambda: fired.append(1))
+        scheduler.call_later(0.02, lambda: fired.append(2))
+        first.cancel()
+        await asyncio.sleep(0.05)
+        assert fired == [2]
+
+        scheduler.call_later(0.01, lambda: fired.append(3))
+        scheduler.cancel_all()
+        await asyncio.sleep(0.03)
+        assert fired == [2]
+
+    run_scheduler(test)
+
+
+def test_failing_callback_does_not_stop_the_loop_and_awaitables_are_awaited():
+    async def test(scheduler):
+        fired = []
+
+        def fail():
+            raise RuntimeError("boom")
+
+        async def later():
+            await asyncio.sleep(0)
+            fired.append("awaited")
+
+        scheduler.call_later(0.0, fail)
+        scheduler.call_later(0.01, later)
+        await asyncio.sleep(0.05)
+        assert fired == ["awaited"]
+
+    run_scheduler(test)
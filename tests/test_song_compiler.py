@@ -0,0 +1,98 @@
+import random
+
+import numpy as np
+import pytest
+
+from analysis_model import CompactAnalysis
+from song_compiler import ENTRY_BRIGHTNESS, ENTRY_COLOR, prepare_song
+from utils import BAR_CONFIDENCE_THRESHOLD, get_current_item, get_next_item, merge_short_segments
+
+# The baseline controller ticked every millisecond; ticks fall between the 10 ms grid of the analysis
+TICK = 0.001
+TICK_OFFSET = 0.0005
+
+
+def make_raw_analysis(seconds: int = 12, seed: int = 0):
+    rng = random.Random(seed)
+    segments, start = [], 0
+    while start < seconds * 100:
+        duration = rng.randint(3, 60)
+        segments.append({
+            "start": start / 100, "duration": duration / 100, "confidence": rng.random(),
+            "loudness_start": rng.uniform(-40, -5), "loudness_max_time": 0.0,
+            "loudness_max": rng.uniform(-30, 0), "loudness_end": rng.uniform(-40, -5),
+            "pitches": [rng.random() for _ in range(12)], "timbre": [rng.uniform(-50, 50) for _ in range(12)],
+        })
+        start += duration
+    bars, start = [], 0
+    while start < seconds * 100:
+        duration = rng.randint(150, 250)
+        bars.append({"start": start / 100, "duration": duration / 100, "confidence": rng.random()})
+        start += duration
+    return {"track": {"duration": float(seconds), "tempo": 120.0}, "segments": segments, "bars": bars,
+            "beats": [], "tatums": [], "sections": [{"start": 0.0, "duration": float(seconds), "confidence": 1.0}]}
+
+
+def baseline_entries(raw, brightness_curve):
+    """
+    Replays the per-tick lookups of the baseline controller and returns the light changes it made.
+    """
+    segments = merge_short_segments(raw["segments"])
+    index_of = {segment["start"]: index for index, segment in enumerate(segments)}
+    bars = raw["bars"]
+    entries, last_bar, brightness = [], bars[0], 0
+    for tick in range(int(raw["track"]["duration"] / TICK) + 1):
+        t = tick * TICK + TICK_OFFSET
+        next_segment = get_next_item(segments, t)
+        bar = get_current_item(bars, t)
+        if not next_segment or not bar:
+            continue
+        if bar != last_bar and bar["confidence"] > BAR_CONFIDENCE_THRESHOLD:
+            entries.append((t - TICK_OFFSET, ENTRY_COLOR, bar["duration"] - (t - bar["start"]), brightness))
+            last_bar = bar
+        elif brightness_curve[index_of[next_segment["start"]]] != brightness:
+            brightness = brightness_curve[index_of[next_segment["start"]]]
+            entries.append((t - TICK_OFFSET, ENTRY_BRIGHTNESS, next_segment["duration"], brightness))
+    return entries
+
+
+@pytest.mark.parametrize("seed", range(4))
+def test_compiled_entries_match_baseline_lookups(seed):
+    raw = make_raw_analysis(seed=seed)
+    song = prepare_song(CompactAnalysis.from_raw(raw))
+    show = song.show
+    expected = baseline_entries(raw, song.brightness_curve)
+
+    assert len(show) == len(expected)
+    times, kinds, durations, brightness = (np.array(column) for column in zip(*expected))
+    np.testing.assert_allclose(show.times, times, atol=1e-6)
+    np.testing.assert_array_equal(show.kinds, kinds)
+    np.testing.assert_allclose(show.durations, durations, atol=TICK)
+    np.testing.assert_array_equal(show.brightness, brightness)
+
+    # Every color change moves away from the previous color
+    colors = show.kinds == ENTRY_COLOR
+    assert colors.any()
+    hues = show.hue[colors].astype(int)
+    assert all(abs(a - b) >= 30 for a, b in zip(hues, hues[1:]))
+    # Brightness changes keep the current color
+    for index in np.flatnonzero(show.kinds == ENTRY_BRIGHTNESS)[1:]:
+        assert show.hue[index] == show.hue[index - 1]
+
+
+def test_analysis_without_bars_compiles_to_an_empty_show():
+    raw = make_raw_analysis()
+    raw["bars"] = []
+    song = prepare_song(CompactAnalysis.from_raw(raw))
+    assert len(song.show) == 0
+
+
+def test_a_track_always_compiles_to_the_same_show():
+    analysis = CompactAnalysis.from_raw(make_raw_analysis())
+    first = prepare_song(analysis, "4uLU6hMCjMI75M1A2tKUQC").show
+    random.seed(1)
+    second = prepare_song(analysis, "4uLU6hMCjMI75M1A2tKUQC").show
+    np.testing.assert_array_equal(first.hue, second.hue)
+    np.testing.assert_array_equal(first.saturation, second.saturation)
+    other = prepare_song(analysis, "7GhIk7Il098yCjg4BQjzvb").show
+    assert not np.array_equal(first.hue, other.hue)
@@ -0,0 +1,68 @@
+import random
+
+import numpy as np
+import pytest
+
+from analysis_model import EVENT_DTYPE
+from timeline import SongTimeline
+from utils import get_current_item, get_next_item
+
+
+def make_items(count: int = 300, seed: int = 0):
+    rng = random.Random(seed)
+    items, start = [], 0.0
+    for _ in range(count):
+        duration = round(rng.uniform(0.1, 1.0), 3)
+        items.append({"start": start, "duration": duration, "confidence": rng.random()})
+        start += duration
+    return items
+
+
+def playback_times(items, seed: int = 0):
+    """
+    Times of a playback with small steps, landing exactly on starts, and seeks both ways.
+    """
+    rng = random.Random(seed)
+    end = items[-1]["start"] + items[-1]["duration"]
+    times, t = [], -1.0
+    while len(times) < 2000:
+        roll = rng.random()
+        if roll < 0.05:
+            t = rng.uniform(-1.0, end + 1.0)
+        elif roll < 0.1:
+            t = rng.choice(items)["start"]
+        else:
+            t += rng.uniform(0.0, 0.05)
+        times.append(t)
+    return times
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_lookups_match_baseline_across_seeks(seed):
+    items = make_items(seed=seed)
+    timeline = SongTimeline({"bars": list(reversed(items))})
+    for t in playback_times(items, seed):
+        assert timeline.current("bars", t) == get_current_item(items, t)
+        assert timeline.next("bars", t) == get_next_item(items, t)
+
+
+def test_structured_arrays_match_dictionaries():
+    items = make_items()
+    events = np.array([(item["start"], item["duration"], item["confidence"]) for item in items], dtype=EVENT_DTYPE)
+    timeline = SongTimeline({"beats": events})
+    assert timeline.starts["beats"].dtype == np.float64
+    for t in playback_times(items):
+        expected = get_current_item(items, t)
+        current = timeline.current("beats", t)
+        assert (current is None and expected is None) or current["start"] == expected["start"]
+
+
+def test_index_at_after_reset_and_past_the_end():
+    items = make_items(count=20)
+    timeline = SongTimeline({"bars": items})
+    end = items[-1]["start"] + 1.0
+    assert timeline.index_at("bars", end) == len(items)
+    assert timeline.current("bars", end) is None
+    timeline.reset()
+    assert timeline.index_at("bars", -1.0) == 0
+    assert timeline.index_at("bars", items[3]["start"]) == 4
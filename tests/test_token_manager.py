@@ -0,0 +1,95 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from playback_clock import PlaybackClock
+from spotify_listener import SpotifyChangesListener, UnauthorizedError
+from token_manager import SpotifyTokenManager
+
+
+class FakeAuth:
+    """
+    Stands in for SpotifyOAuth, handing out numbered tokens. Only the cached one expires after expires_in.
+    """
+
+    def __init__(self, expires_in: float, fail: int = 0):
+        self.expires_in = expires_in
+        self.fail = fail
+        self.refreshed = []
+        self.cache_handler = SimpleNamespace(get_cached_token=lambda: self._token(0))
+
+    def _token(self, number: int):
+        expires_in = self.expires_in if number == 0 else 3600
+        return {"access_token": f"token {number}", "refresh_token": "refresh", "expires_at": time.time() + expires_in}
+
+    def validate_token(self, token_info):
+        return token_info
+
+    def refresh_access_token(self, refresh_token):
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError("Spotify is down")
+        self.refreshed.append(refresh_token)
+        token_info = self._token(len(self.refreshed))
+        # Spotify does not always rotate the refresh token
+        del token_info["refresh_token"]
+        return token_info
+
+
+def run_with_tokens(test, auth: FakeAuth, refresh_margin: float):
+    async def main():
+        tokens = SpotifyTokenManager(auth, refresh_margin=refresh_margin)
+        await tokens.start()
+        try:
+            await test(tokens)
+        finally:
+            await tokens.close()
+
+    asyncio.run(main())
+
+
+def test_token_is_refreshed_before_it_expires():
+    async def test(tokens):
+        assert tokens.headers == {"Authorization": "Bearer token 0"}
+        headers = tokens.headers
+        await asyncio.sleep(0.05)
+        assert tokens.access_token == "token 0"
+        await asyncio.sleep(0.15)
+        assert tokens.access_token == "token 1"
+        assert tokens.expires_in > 3000
+        # Requests already holding the old headers keep them
+        assert headers == {"Authorization": "Bearer token 0"}
+        assert auth.refreshed == ["refresh"]
+
+    auth = FakeAuth(expires_in=1.1)
+    run_with_tokens(test, auth, refresh_margin=1.0)
+
+
+def test_rejected_token_is_refreshed_right_away():
+    async def test(tokens):
+        listener = SpotifyChangesListener(None, None, None, asyncio.Queue(), PlaybackClock(), access_token="unused")
+        listener.tokens = tokens
+        with pytest.raises(UnauthorizedError):
+            listener._check_rate_limit(SimpleNamespace(status=401, headers={}))
+        await asyncio.sleep(0.05)
+        assert tokens.access_token == "token 1"
+        assert auth.refreshed == ["refresh"]
+
+    auth = FakeAuth(expires_in=3600)
+    run_with_tokens(test, auth, refresh_margin=300)
+
+
+def test_failed_refresh_keeps_the_token_and_retries(monkeypatch):
+    monkeypatch.setattr("token_manager.API_BACKOFF_BASE", 0.05)
+
+    async def test(tokens):
+        tokens.request_refresh()
+        await asyncio.sleep(0.02)
+        assert tokens.access_token == "token 0"
+        await asyncio.sleep(0.1)
+        assert tokens.access_token == "token 1"
+
+    auth = FakeAuth(expires_in=3600, fail=1)
+    run_with_tokens(test, auth, refresh_margin=300)
@@ -0,0 +1,127 @@
+import asyncio
+import time
+
+import pytest
+
+from fake_bulb import FakeBulb
+from yeelight_transport import YeelightError, YeelightTransport
+
+
+async def wait_for_commands(bulb: FakeBulb, count: int, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while len(bulb.received) + len(bulb.dropped) < count:
+        assert time.monotonic() < deadline, f"Bulb got {len(bulb.received)} of {count} command(s)"
+        await asyncio.sleep(0.01)
+
+
+def methods(bulb: FakeBulb):
+    return [command["method"] for _, command in bulb.received]
+
+
+def run_with_bulb(test, **bulb_kwargs):
+    async def main():
+        bulb = FakeBulb(**bulb_kwargs)
+        await bulb.start()
+        transport = YeelightTransport(bulb.host, bulb.port)
+        try:
+            await test(bulb, transport)
+        finally:
+            await transport.close()
+            await bulb.stop()
+
+    asyncio.run(main())
+
+
+def test_music_mode_handshake():
+    async def test(bulb, transport):
+        await transport.connect()
+        assert transport.connected
+        _, command = bulb.received[0]
+        assert command["method"] == "set_music"
+        assert command["params"][0] == 1
+        assert command["params"][2] != bulb.port
+
+        # Commands go over the connection the bulb opened back, without replies
+        await transport.set_brightness(40, duration=0)
+        await transport.set_hsv(120, 80, 60, duration=0.5)
+        await wait_for_commands(bulb, 3)
+        assert methods(bulb) == ["set_music", "set_bright", "start_cf"]
+        assert bulb.properties["bright"] == "60"
+        assert not transport._pending
+
+    run_with_bulb(test)
+
+
+def test_reconnects_after_close():
+    async def test(bulb, transport):
+        await transport.connect()
+        await transport.close()
+        assert not transport.connected
+
+        await transport.set_power(True)
+        await wait_for_commands(bulb, 3)
+        assert transport.connected
+        assert methods(bulb) == ["set_music", "set_music", "set_power"]
+
+    run_with_bulb(test)
+
+
+def test_request_reopens_lost_control_connection():
+    async def test(bulb, transport):
+        await transport.connect()
+        transport._control_writer.close()
+
+        # The music connection is still up, so only the control connection is reopened
+        assert await transport.request("get_prop", ["power"]) == ["on"]
+        assert methods(bulb) == ["set_music", "get_prop"]
+
+    run_with_bulb(test)
+
+
+def test_measure_latency_waits_for_ack():
+    async def test(bulb, transport):
+        await transport.connect()
+        latency = await transport.measure_latency()
+        assert 0.05 <= latency < 1.0
+        assert methods(bulb)[-1] == "get_prop"
+
+    run_with_bulb(test, latency=0.05)
+
+
+def test_props_notifications_are_not_taken_for_acks():
+    async def test(bulb, transport):
+        notified = []
+        transport.on_props = notified.append
+        await transport.connect()
+        await transport.set_brightness(30, duration=0)
+        await wait_for_commands(bulb, 2)
+        assert await transport.request("get_prop", ["bright"]) == ["30"]
+        assert notified == [{"bright": "30"}]
+
+    run_with_bulb(test)
+
+
+def test_dropped_commands_do_not_stall_the_transport():
+    async def test(bulb, transport):
+        await transport.connect()
+        for brightness in range(1, 101):
+            await transport.set_brightness(brightness, duration=0)
+        await wait_for_commands(bulb, 101)
+        assert 0 < len(bulb.dropped) < 100
+        assert len(bulb.received) + len(bulb.dropped) == 101
+        # Requests go over the control connection, which never drops
+        assert await transport.request("get_prop", ["power"]) == ["on"]
+
+    run_with_bulb(test, drop_rate=0.5, seed=1)
+
+
+def test_pending_request_fails_when_bulb_goes_away():
+    async def test(bulb, transport):
+        await transport.connect()
+        request = asyncio.create_task(transport.request("get_prop", ["power"]))
+        await asyncio.sleep(0.05)
+        await bulb.stop()
+        with pytest.raises(YeelightError):
+            await request
+
+    run_with_bulb(test, latency=0.5)
@@ -0,0 +1,114 @@
+import numpy as np
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+from models import RawSpotifyResponse
+from preprocessing import SegmentArrays
+from analysis_model import CompactAnalysis
+
+# Kinds of time-ordered items indexed for every song
+TIMELINE_KINDS = ("segments", "bars", "beats", "tatums", "sections")
+
+# How many items the cursor may step forward linearly before falling back to a binary search
+CURSOR_MAX_STEPS = 8
+
+
+class SongTimeline:
+    def __init__(self, items: Dict[str, Union[Sequence[Dict[str, Any]], SegmentArrays, np.ndarray]], key: str = "start"):
+        """
+        Builds sorted start-time indexes for the time-ordered items of a song, as NumPy
+        arrays the show compiler can also search all at once.
+
+        Lookups follow the semantics of utils.get_current_item / utils.get_next_item: the
+        "current" item is the first one starting strictly after the given time and the
+        "next" item is the one after it.
+
+        :param items: Mapping of kind (e.g. "segments", "bars") to the list of item dictionaries,
+            or to SegmentArrays or structured arrays, which are already sorted by start time.
+        :param key: The dictionary key holding the start time of each item.
+        """
+        self.items: Dict[str, Union[List[Dict[str, Any]], SegmentArrays, np.ndarray]] = {}
+        self.starts: Dict[str, np.ndarray] = {}
+        self._cursors: Dict[str, int] = {}
+        self._cursor_times: Dict[str, float] = {}
+
+        for kind, kind_items in items.items():
+            if isinstance(kind_items, SegmentArrays):
+                self.items[kind] = kind_items
+                self.starts[kind] = np.asarray(kind_items.start, dtype=np.float64)
+            elif isinstance(kind_items, np.ndarray):
+                self.items[kind] = kind_items
+                self.starts[kind] = np.asarray(kind_items[key], dtype=np.float64)
+            else:
+                sorted_items = sorted(kind_items, key=lambda x: x[key])
+                self.items[kind] = sorted_items
+                self.starts[kind] = np.array([item[key] for item in sorted_items], dtype=np.float64)
+            self._cursors[kind] = 0
+            self._cursor_times[kind] = float("-inf")
+
+    @classmethod
+    def from_analysis(cls, analysis: Union[CompactAnalysis, RawSpotifyResponse], segments: Optional[SegmentArrays] = None) -> "SongTimeline":
+        """
+        Creates a timeline from a Spotify audio analysis.
+
+        :param analysis: The compact or raw audio analysis.
+        :param segments: Optional preprocessed segments to index instead of analysis['segments'].
+        :return: A SongTimeline indexing segments, bars, beats, tatums and sections.
+        """
+        items = {kind: analysis.get(kind, []) for kind in TIMELINE_KINDS}
+        if segments is None:
+            segments = items["segments"] if isinstance(items["segments"], SegmentArrays) else SegmentArrays.from_segments(items["segments"])
+        items["segments"] = segments
+        return cls(items)
+
+    def index_at(self, kind: str, current_time: float) -> int:
+        """
+        Returns the index of the first item of the given kind starting after current_time.
+
+        Uses a forward-only cursor during normal playback and a binary search on seeks
+        (backwards jumps or forward jumps longer than a few items).
+
+        :param kind: The kind of item to look up.
+        :param current_time: The playback position in seconds.
+        :return: The index, which equals the number of items if none start after current_time.
+        """
+        starts = self.starts[kind]
+        index = self._cursors[kind]
+
+        if current_time < self._cursor_times[kind]:
+            index = int(np.searchsorted(starts, current_time, side="right"))
+        else:
+            steps = 0
+            while index < len(starts) and starts[index] <= current_time:
+                index += 1
+                steps += 1
+                if steps > CURSOR_MAX_STEPS:
+                    index += int(np.searchsorted(starts[index:], current_time, side="right"))
+                    break
+
+        self._cursors[kind] = index
+        self._cursor_times[kind] = current_time
+        return index
+
+    def current(self, kind: str, current_time: float) -> Optional[Dict[str, Any]]:
+        """
+        Returns the first item of the given kind starting after current_time, or None.
+        """
+        index = self.index_at(kind, current_time)
+        items = self.items[kind]
+        return items[index] if index < len(items) else None
+
+    def next(self, kind: str, current_time: float) -> Optional[Dict[str, Any]]:
+        """
+        Returns the item following the current one of the given kind, or None.
+        """
+        index = self.index_at(kind, current_time) + 1
+        items = self.items[kind]
+        return items[index] if index < len(items) else None
+
+    def reset(self):
+        """
+        Rewinds all cursors, e.g. when the same song is restarted.
+        """
+        for kind in self._cursors:
+            self._cursors[kind] = 0
+            self._cursor_times[kind] = float("-inf")
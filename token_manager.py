@@ -0,0 +1,117 @@
+import asyncio
+import time
+from typing import Any, Dict, Optional
+
+from loguru import logger
+from spotipy.oauth2 import SpotifyOAuth, SpotifyOauthError
+
+from tracing import tracer
+from utils import API_BACKOFF_BASE, API_BACKOFF_MAX, TOKEN_REFRESH_MARGIN
+
+
+class StaticTokenProvider:
+    def __init__(self, access_token: str):
+        """
+        Provides a fixed access token, e.g. for a local stand-in of the Web API.
+        """
+        self.access_token = access_token
+        self.headers = {'Authorization': f"Bearer {access_token}"}
+
+    async def start(self):
+        pass
+
+    def request_refresh(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class SpotifyTokenManager:
+    def __init__(self, auth: SpotifyOAuth, refresh_margin: float = TOKEN_REFRESH_MARGIN):
+        """
+        Keeps a valid Spotify access token without ever blocking the event loop.
+
+        spotipy's OAuth calls are blocking, so they run in a worker thread: once on start,
+        which may prompt the user to log in, and then in the background refresh_margin
+        seconds before the token expires. Readers get the cached token and headers at no cost.
+
+        :param auth: The SpotifyOAuth object handling the authorization flow and token cache.
+        :param refresh_margin: How many seconds before expiry the token is refreshed.
+        """
+        self.auth = auth
+        self.refresh_margin = refresh_margin
+        self.headers: Dict[str, str] = {}
+        self._token_info: Optional[Dict[str, Any]] = None
+        self._refresh_requested = asyncio.Event()
+        self._refresher: Optional[asyncio.Task] = None
+
+    @property
+    def access_token(self) -> Optional[str]:
+        return self._token_info["access_token"] if self._token_info else None
+
+    @property
+    def expires_in(self) -> float:
+        """
+        Seconds until the current token expires.
+        """
+        return self._token_info["expires_at"] - time.time() if self._token_info else 0.0
+
+    async def start(self):
+        """
+        Gets the initial token, from spotipy's cache or by prompting the user, and starts refreshing it.
+
+        :raises SpotifyOauthError: If no token could be obtained.
+        """
+        self._set_token(await asyncio.to_thread(self._initial_token))
+        self._refresher = asyncio.create_task(self._refresh_loop(), name="token refresh")
+
+    def _initial_token(self) -> Dict[str, Any]:
+        token_info = self.auth.validate_token(self.auth.cache_handler.get_cached_token())
+        if not token_info:
+            code = self.auth.get_auth_response()
+            token_info = self.auth.get_access_token(code, as_dict=True, check_cache=False)
+        if not token_info:
+            raise SpotifyOauthError("Failed to retrieve Spotify token.")
+        return token_info
+
+    def _set_token(self, token_info: Dict[str, Any]):
+        self._token_info = token_info
+        # Replaced rather than mutated, so requests already using the old headers are unaffected
+        self.headers = {'Authorization': f"Bearer {token_info['access_token']}"}
+        logger.debug(f"Spotify access token valid for {self.expires_in:.0f}s")
+
+    def request_refresh(self):
+        """
+        Asks for a refresh right away, e.g. after the API rejected the token.
+        """
+        self._refresh_requested.set()
+
+    async def _refresh_loop(self):
+        failures = 0
+        while True:
+            delay = self.expires_in - self.refresh_margin
+            if failures:
+                delay = min(API_BACKOFF_BASE * 2 ** (failures - 1), API_BACKOFF_MAX)
+            try:
+                await asyncio.wait_for(self._refresh_requested.wait(), max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+            self._refresh_requested.clear()
+
+            try:
+                with tracer.span("token refresh"):
+                    token_info = await asyncio.to_thread(self.auth.refresh_access_token, self._token_info["refresh_token"])
+            except Exception as e:
+                failures += 1
+                logger.error(f"Failed to refresh Spotify token ({self.expires_in:.0f}s left): {e!r}")
+                continue
+            failures = 0
+            # Spotify only sometimes rotates the refresh token
+            token_info.setdefault("refresh_token", self._token_info["refresh_token"])
+            self._set_token(token_info)
+
+    async def close(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
@@ -0,0 +1,122 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from loguru import logger
+
+from utils import TRACE_BUFFER_SIZE
+
+
+def _lane() -> str:
+    """
+    Returns the name of the current asyncio task, or of the current thread outside of one.
+    Spans within a task or thread always nest, so each gets its own track in the trace viewer.
+    """
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return task.get_name() if task is not None else threading.current_thread().name
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "lane", "start")
+
+    def __init__(self, tracer: "Tracer", name: str, args: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.lane = _lane()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        self.tracer._events.append((self.name, self.lane, self.start, end - self.start, self.args))
+        return False
+
+
+class Tracer:
+    def __init__(self, capacity: int = TRACE_BUFFER_SIZE):
+        """
+        Records timed spans of the pipeline stages into a ring buffer and dumps them as
+        Chrome trace JSON, which chrome://tracing and ui.perfetto.dev can open.
+
+        Disabled by default: span() then returns a shared no-op context manager, so the
+        instrumentation costs one attribute check per span.
+
+        :param capacity: The number of most recent spans kept.
+        """
+        self.enabled = False
+        self._events = deque(maxlen=capacity)
+
+    def enable(self, capacity: Optional[int] = None):
+        if capacity is not None:
+            self._events = deque(self._events, maxlen=capacity)
+        self.enabled = True
+
+    def span(self, name: str, **args):
+        """
+        Returns a context manager timing the code it wraps.
+
+        :param name: The name of the span, e.g. "poll".
+        :param args: Details shown with the span in the trace viewer.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name, args)
+
+    def instant(self, name: str, **args):
+        """
+        Records a zero-length event, e.g. a detected seek.
+        """
+        if self.enabled:
+            self._events.append((name, _lane(), time.perf_counter_ns(), None, args))
+
+    def events(self) -> List[Dict[str, Any]]:
+        """
+        Returns the buffered spans as Chrome trace events, with one thread per task or thread.
+        """
+        pid = os.getpid()
+        lanes: Dict[str, int] = {}
+        events = []
+        for name, lane, start, duration, args in list(self._events):
+            tid = lanes.setdefault(lane, len(lanes) + 1)
+            event = {"name": name, "pid": pid, "tid": tid, "ts": start / 1000, "args": args}
+            if duration is None:
+                event.update(ph="i", s="t")
+            else:
+                event.update(ph="X", dur=duration / 1000)
+            events.append(event)
+        for lane, tid in lanes.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": lane}})
+        return events
+
+    def dump(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        events = self.events()
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+        logger.info(f"Wrote {len(events)} trace event(s) to {path}")
+
+
+tracer = Tracer()
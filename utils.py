@@ -1,3 +1,4 @@
+import os
 import random
 import aiohttp
 from loguru import logger
@@ -6,15 +7,70 @@ from typing import Dict, Any, List
 
 # Define a type alias for Spotify's raw response for clarity
 RawSpotifyResponse = Dict[str, Any]
-CONTROLLER_TICK = 0.001
+COMMAND_LEAD_TIME = 0.05
+PROGRESS_CORRECTION_TOLERANCE = 0.05
+SEEK_THRESHOLD = 1.0
+# Gains of the alpha-beta filter smoothing reported playback positions
+CLOCK_POSITION_GAIN = 0.3
+CLOCK_RATE_GAIN = 0.05
+CLOCK_MAX_DRIFT = 0.02
+CLOCK_INITIAL_NOISE = 0.1
+CLOCK_NOISE_SMOOTHING = 0.2
 MIN_SEGMENT_DURATION = 0.2
-API_CURRENT_PLAYING = 'https://api.spotify.com/v1/me/player/currently-playing'
-API_AUDIO_ANALYSIS = 'https://api.spotify.com/v1/audio-analysis/'
-SPOTIFY_CHANGES_LISTENER_DELAY = 0.001
-SPOTIFY_CHANGES_LISTENER_FAILURE_DELAY = 1
+BRIGHTNESS_OUTLIER_STD = 2
+BRIGHTNESS_RANGE = (0, 50)
+BAR_CONFIDENCE_THRESHOLD = 0.5
+# Delay after a color change of a brightness change due at the same time, like the former 1 ms controller tick
+SHOW_FOLLOW_UP_DELAY = 0.001
+COMPILED_SHOW_CACHE_SIZE = 4
+SONG_PREPARE_WORKERS = 2
+# Spatial pattern across the devices: hue gradient in degrees and ripple delay in seconds
+FRAME_HUE_SPREAD = 0
+FRAME_WAVE_DELAY = 0.0
+DEFAULT_GROUP_NAME = "default"
+# Interval at which worker processes get the playback clock state between corrections
+CLOCK_SYNC_INTERVAL = 0.25
+WORKER_STOP_TIMEOUT = 5
+LATENCY_WINDOW = 100
+LATENCY_MIN_SAMPLES = 5
+LATENCY_PROBE_INTERVAL = 5
+LEAD_TIME_PERCENTILE = 50
+LATENCY_PROFILE_PATH = os.path.expanduser("~/.cache/emyee/latency.json")
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+TRACE_BUFFER_SIZE = 100_000
+API_BASE = 'https://api.spotify.com/v1'
+API_CURRENT_PLAYING = '/me/player/currently-playing'
+API_AUDIO_ANALYSIS = '/audio-analysis/'
+API_PLAYER_QUEUE = '/me/player/queue'
+PREFETCH_TRACKS = 1
+ANALYSIS_STREAM_CHUNK_SIZE = 64 * 1024
+YEELIGHT_DEFAULT_PORT = 55443
+YEELIGHT_CONNECT_TIMEOUT = 5
+YEELIGHT_MIN_SMOOTH_DURATION = 30
+DEVICE_COMMAND_RATE = 20
+# Smallest changes worth sending to a bulb, below which they are hardly visible
+BRIGHTNESS_THRESHOLD = 2
+HUE_THRESHOLD = 3
+SATURATION_THRESHOLD = 2
+# Seconds after a command during which bulb notifications may still describe older commands
+BULB_NOTIFICATION_GRACE = 1.0
+DEVICE_REGISTRY_PATH = os.path.expanduser("~/.cache/emyee/devices.json")
+DEVICE_DISCOVERY_TIMEOUT = 2
+DEVICE_INIT_TIMEOUT = 5
 SPOTIFY_REDIRECT_URI = 'http://localhost:8000/'
 SPOTIFY_SCOPE = 'user-read-currently-playing,user-read-playback-state'
-API_REQUEST_INTERVAL = 0.5
+API_POLL_FAST_INTERVAL = 0.25
+API_POLL_SLOW_INTERVAL = 2.0
+API_POLL_PAUSED_INTERVAL = 3.0
+API_POLL_FAST_WINDOW = 5.0
+API_BACKOFF_BASE = 1.0
+API_BACKOFF_MAX = 60.0
+API_KEEPALIVE_TIMEOUT = 60
+TOKEN_REFRESH_MARGIN = 300
+ANALYSIS_CACHE_DIR = os.path.expanduser("~/.cache/emyee/analysis")
+ANALYSIS_CACHE_MAX_BYTES = 200 * 1024 * 1024
+ANALYSIS_CACHE_MEMORY_ITEMS = 8
 COLORS = [(255, 102, 129), (204, 0, 203), (232, 62, 62), (102, 0, 102), (0, 0, 204), (59, 0, 104), (0, 0, 102),
           (0, 203, 204), (76, 126, 128), (0, 102, 102), (102, 102, 0), (204, 0, 0), (102, 0, 0), (203, 204, 0),
           (204, 172, 0), (204, 132, 0), (0, 204, 0), (0, 102, 0)]
@@ -32,12 +88,12 @@ VIBRANT_COLOR_PALETTE = [
 
 
 
-def get_vibrant_color(current_hue):
+def get_vibrant_color(current_hue, rng=random):
     palette = VIBRANT_COLOR_PALETTE.copy()
     palette = [color for color in palette if abs(color[0] - current_hue) >= 30]
     if not palette:
         palette = VIBRANT_COLOR_PALETTE  # Reset if no colors are sufficiently different
-    new_color = random.choice(palette)
+    new_color = rng.choice(palette)
     return new_color
 
 
@@ -0,0 +1,230 @@
+import asyncio
+import colorsys
+import itertools
+import json
+import socket
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from tracing import tracer
+from utils import YEELIGHT_DEFAULT_PORT, YEELIGHT_CONNECT_TIMEOUT, YEELIGHT_MIN_SMOOTH_DURATION
+
+
+class YeelightError(Exception):
+    pass
+
+
+def hsv_to_yeelight_rgb(hue: int, saturation: int) -> int:
+    """
+    Converts a hue (0-359) and saturation (0-100) to the packed RGB integer Yeelight expects.
+    Degrees map onto the color wheel like BulbState reads them back from "rgb" notifications.
+    """
+    r, g, b = colorsys.hsv_to_rgb(min(max(hue, 0), 359) / 360.0, min(max(saturation, 0), 100) / 100.0, 1)
+    return (int(round(r * 255)) << 16) + (int(round(g * 255)) << 8) + int(round(b * 255))
+
+
+class YeelightTransport:
+    def __init__(self, ip: str, port: int = YEELIGHT_DEFAULT_PORT, effect: str = "smooth", music_mode: bool = True):
+        """
+        Asyncio-native client for the Yeelight JSON-over-TCP protocol.
+
+        Keeps one persistent control connection per bulb. In music mode the bulb connects back
+        to a short-lived local server and every command is written to that connection without
+        waiting for a reply, so commands are pipelined and not subject to the bulb's quota.
+
+        :param ip: The IP address of the bulb.
+        :param port: The control port of the bulb.
+        :param effect: The default transition effect ("smooth" or "sudden").
+        :param music_mode: Whether to switch the bulb to music mode on connect.
+        """
+        self.ip = ip
+        self.port = port
+        self.effect = effect
+        self.music_mode = music_mode
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._control_reader: Optional[asyncio.StreamReader] = None
+        self._control_writer: Optional[asyncio.StreamWriter] = None
+        self._music_writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._connect_lock = asyncio.Lock()
+        # Called with the changed properties whenever the bulb notifies a state change
+        self.on_props: Optional[Callable[[Dict[str, Any]], None]] = None
+
+    @property
+    def name(self) -> str:
+        """
+        Identifies the bulb in logs and metrics: its IP, plus the port if it is not the default one.
+        """
+        return self.ip if self.port == YEELIGHT_DEFAULT_PORT else f"{self.ip}:{self.port}"
+
+    @property
+    def connected(self) -> bool:
+        writer = self._music_writer if self.music_mode else self._control_writer
+        return writer is not None and not writer.is_closing()
+
+    async def connect(self):
+        """
+        Opens the control connection and, if enabled, switches the bulb to music mode.
+        """
+        async with self._connect_lock:
+            if self.connected:
+                return
+            await self._close_writers()
+            await self._open_control()
+            if self.music_mode:
+                await self._start_music()
+            logger.debug(f"Connected to bulb {self.ip}:{self.port} (music mode: {self.music_mode})")
+
+    async def _open_control(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        self._control_reader, self._control_writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip, self.port), YEELIGHT_CONNECT_TIMEOUT
+        )
+        self._reader_task = asyncio.create_task(self._read_responses(self._control_reader),
+                                                name=f"responses {self.name}")
+
+    async def _start_music(self):
+        local_ip = self._control_writer.get_extra_info("sockname")[0]
+        accepted: asyncio.Future = asyncio.get_running_loop().create_future()
+
+        def on_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            if accepted.done():
+                writer.close()
+            else:
+                accepted.set_result(writer)
+
+        server = await asyncio.start_server(on_connection, host=local_ip, port=0)
+        try:
+            local_port = server.sockets[0].getsockname()[1]
+            await self.request("set_music", [1, local_ip, local_port])
+            self._music_writer = await asyncio.wait_for(accepted, YEELIGHT_CONNECT_TIMEOUT)
+            sock = self._music_writer.get_extra_info("socket")
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        finally:
+            server.close()
+
+    async def close(self):
+        async with self._connect_lock:
+            await self._close_writers()
+
+    async def _close_writers(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        for writer in (self._music_writer, self._control_writer):
+            if writer is not None and not writer.is_closing():
+                writer.close()
+        self._music_writer = None
+        self._control_writer = None
+        self._fail_pending(YeelightError(f"Connection to {self.ip} closed"))
+
+    def _fail_pending(self, error: Exception):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self._pending.clear()
+
+    async def _read_responses(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if message.get("method") == "props":
+                    if self.on_props is not None:
+                        self.on_props(message.get("params", {}))
+                    continue
+                future = self._pending.pop(message.get("id"), None)
+                if future is not None and not future.done():
+                    if "error" in message:
+                        future.set_exception(YeelightError(message["error"]))
+                    else:
+                        future.set_result(message.get("result"))
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            logger.debug(f"Control connection to {self.ip} lost: {e}")
+        self._fail_pending(YeelightError(f"Connection to {self.ip} lost"))
+
+    def _encode(self, method: str, params: List[Any]) -> tuple[int, bytes]:
+        command_id = next(self._ids)
+        command = {"id": command_id, "method": method, "params": params}
+        return command_id, (json.dumps(command, separators=(",", ":")) + "\r\n").encode()
+
+    async def send(self, method: str, params: List[Any]):
+        """
+        Writes a command without waiting for the bulb to reply.
+        """
+        if not self.connected:
+            await self.connect()
+        writer = self._music_writer if self.music_mode else self._control_writer
+        _, data = self._encode(method, params)
+        try:
+            writer.write(data)
+            await writer.drain()
+        except ConnectionError as e:
+            await self.close()
+            raise YeelightError(f"Failed to send {method} to {self.ip}: {e}") from e
+
+    async def request(self, method: str, params: List[Any]) -> Any:
+        """
+        Sends a command over the control connection and waits for its result.
+        """
+        if self._control_writer is None or self._control_writer.is_closing():
+            if self.connected:
+                # Some bulbs drop the control connection once in music mode
+                await self._open_control()
+            else:
+                await self.connect()
+        command_id, data = self._encode(method, params)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[command_id] = future
+        with tracer.span("request", method=method):
+            self._control_writer.write(data)
+            await self._control_writer.drain()
+            try:
+                return await asyncio.wait_for(future, YEELIGHT_CONNECT_TIMEOUT)
+            finally:
+                self._pending.pop(command_id, None)
+
+    async def measure_latency(self) -> float:
+        """
+        Measures the command-to-ack latency of the bulb in seconds with a get_prop round-trip.
+        """
+        started = time.monotonic()
+        await self.request("get_prop", ["power"])
+        return time.monotonic() - started
+
+    def _effect_params(self, duration: float) -> List[Any]:
+        duration_ms = int(duration * 1000)
+        if self.effect == "sudden" or duration_ms < YEELIGHT_MIN_SMOOTH_DURATION:
+            return ["sudden", 0]
+        return ["smooth", duration_ms]
+
+    async def set_brightness(self, brightness: int, duration: float = 0.05):
+        await self.send("set_bright", [min(max(int(brightness), 1), 100)] + self._effect_params(duration))
+
+    async def set_hsv(self, hue: int, saturation: int, brightness: Optional[int] = None, duration: float = 0.05):
+        hue, saturation = min(max(int(hue), 0), 359), min(max(int(saturation), 0), 100)
+        if brightness is None:
+            await self.send("set_hsv", [hue, saturation] + self._effect_params(duration))
+            return
+        brightness = min(max(int(brightness), 1), 100)
+        if self._effect_params(duration)[0] == "sudden":
+            # Without a transition, set_scene changes color and brightness in one plain command
+            await self.send("set_scene", ["hsv", hue, saturation, brightness])
+            return
+        # Like yeelight.Bulb.set_hsv, use a one-step color flow so brightness changes in the same command
+        duration_ms = max(int(duration * 1000), YEELIGHT_MIN_SMOOTH_DURATION)
+        rgb = hsv_to_yeelight_rgb(hue, saturation)
+        await self.send("start_cf", [1, 1, f"{duration_ms},1,{rgb},{brightness}"])
+
+    async def set_power(self, on: bool, duration: float = 0.05):
+        await self.send("set_power", ["on" if on else "off"] + self._effect_params(duration))